@@ -7,32 +7,53 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_mail import Mail
 
-mail = Mail()
-
-def create_app():
-    # ...existing...
-    mail.init_app(app)
-    # ...existing...
-
 db = SQLAlchemy()
 login_manager = LoginManager()
+mail = Mail()
 
-def create_app():
+def create_app(config=None):
+    """The platform app; config overrides settings of app.config.Config (tests, benchmarks)."""
     app = Flask(__name__)
     app.config.from_object('app.config.Config')
+    app.config.update(config or {})
 
+    from . import database
+    database.configure(app)
     db.init_app(app)
+    database.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
+    mail.init_app(app)
 
-    # Register blueprints
-    from .routes import auth, admin, superadmin, training
-    app.register_blueprint(auth.bp)
-    app.register_blueprint(admin.bp)
-    app.register_blueprint(superadmin.bp)
-    app.register_blueprint(training.bp)
-
-    with app.app_context():
-        db.create_all()
+    from .mailer import send_engine
+    from .tracking import event_recorder
+    from .tracking_index import tracking_index
+    from .user_cache import user_cache
+    from .instrumentation import instrumentation
+    from .fragments import fragment_cache
+    from .remediation import remediation_engine
+    from .scheduler import campaign_scheduler
+    from . import aggregates, risk, versioning  # noqa: F401 (versioning registers session hooks)
+    send_engine.init_app(app)
+    event_recorder.init_app(app)
+    event_recorder.subscribe(aggregates.apply_events)
+    event_recorder.subscribe(risk.invalidate)
+    remediation_engine.init_app(app)
+    event_recorder.subscribe(remediation_engine.handle)
+    tracking_index.init_app(app)
+    user_cache.init_app(app)
+    instrumentation.init_app(app)
+    fragment_cache.init_app(app)
+    campaign_scheduler.init_app(app)
+    if app.config.get('SCHEDULER_IN_PROCESS'):
+        campaign_scheduler.start()
+
+    from .commands import register_commands
+    register_commands(app)
+
+    # Blueprints come from the manifest in app.routes. Nothing here touches the database:
+    # the schema is created and migrated with `flask db-upgrade` (app.migrations)
+    from .routes import register_blueprints
+    register_blueprints(app)
 
     return app
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""
+Materialized phishing funnel counters per campaign and per user.
+Updated incrementally as targets are added, sent and tracked; rebuild() recomputes them from scratch.
+"""
+
+from collections import Counter
+
+from sqlalchemy import bindparam, case, func, update
+
+from . import db, upserts, versioning
+from .models import CampaignStats, PhishingTarget, UserPhishingStats
+
+# Tracking event kind -> counter column
+EVENT_COUNTERS = {
+    'open': 'opened',
+    'click': 'clicked',
+    'submit': 'submitted',
+    'report': 'reported',
+}
+
+# A click or a submission on a target counts as one offense, whichever comes first
+OFFENSE_OTHER_COLUMN = {
+    'click': PhishingTarget.data_submitted,
+    'submit': PhishingTarget.link_clicked,
+}
+
+REPEAT_THRESHOLD = 2
+
+
+def _ensure_rows(model, key_column, keys):
+    # ON CONFLICT DO NOTHING: flushes of several processes may create the same rows at once
+    upserts.upsert_many(model, [{key_column.key: k} for k in keys], key=[key_column.key])
+
+
+def _increment(model, key_column, counts, column):
+    """Add counts[key] to model.column for every key, creating zeroed rows as needed."""
+    counts = {k: n for k, n in counts.items() if n}
+    if not counts:
+        return
+    _ensure_rows(model, key_column, list(counts))
+    table = model.__table__
+    stmt = (update(table)
+            .where(table.c[key_column.key] == bindparam('key'))
+            .values({column: table.c[column] + bindparam('n')}))
+    db.session.execute(stmt, [{'key': k, 'n': n} for k, n in counts.items()])
+
+
+def _increment_both(rows, column):
+    versioning.bump('phishing')
+    _increment(CampaignStats, CampaignStats.campaign_id, Counter(r.campaign_id for r in rows), column)
+    _increment(UserPhishingStats, UserPhishingStats.user_id, Counter(r.user_id for r in rows), column)
+
+
+def record_targets(rows):
+    """Count newly created targets; rows need campaign_id and user_id."""
+    _increment_both(rows, 'targeted')
+
+
+def record_sent(rows):
+    """Count targets whose email was just stamped as sent."""
+    _increment_both(rows, 'sent')
+
+
+def apply_events(kind, rows):
+    """Event recorder subscriber: rows are targets stamped for the first time by this event."""
+    _increment_both(rows, EVENT_COUNTERS[kind])
+    other = OFFENSE_OTHER_COLUMN.get(kind)
+    if other is None:
+        return
+    repeat = {tid for (tid,) in db.session.query(PhishingTarget.id)
+              .filter(PhishingTarget.id.in_([r.id for r in rows]), other.isnot(None))}
+    offenders = Counter(r.user_id for r in rows if r.id not in repeat)
+    _increment(UserPhishingStats, UserPhishingStats.user_id, offenders, 'offenses')
+
+
+def _grouped_counts(key):
+    return db.session.query(
+        key,
+        func.count(PhishingTarget.id),
+        func.count(PhishingTarget.email_sent),
+        func.count(PhishingTarget.email_opened),
+        func.count(PhishingTarget.link_clicked),
+        func.count(PhishingTarget.data_submitted),
+        func.count(PhishingTarget.reported_phish),
+        func.sum(case((PhishingTarget.link_clicked.isnot(None) | PhishingTarget.data_submitted.isnot(None), 1),
+                      else_=0)),
+    ).group_by(key)
+
+
+def rebuild():
+    """Recompute every counter from PhishingTarget; returns (campaign rows, user rows)."""
+    fields = ('targeted', 'sent', 'opened', 'clicked', 'submitted', 'reported')
+    campaigns = [dict(zip(('campaign_id',) + fields, row[:7]))
+                 for row in _grouped_counts(PhishingTarget.campaign_id)]
+    users = [dict(zip(('user_id',) + fields + ('offenses',), row))
+             for row in _grouped_counts(PhishingTarget.user_id)]
+    db.session.query(CampaignStats).delete()
+    db.session.query(UserPhishingStats).delete()
+    if campaigns:
+        db.session.execute(CampaignStats.__table__.insert(), campaigns)
+    if users:
+        db.session.execute(UserPhishingStats.__table__.insert(), users)
+    versioning.bump('phishing')
+    db.session.commit()
+    return len(campaigns), len(users)
+
+
+def funnel_totals():
+    """Summed funnel across all campaigns, one row read per campaign."""
+    sums = db.session.query(
+        func.coalesce(func.sum(CampaignStats.targeted), 0),
+        func.coalesce(func.sum(CampaignStats.opened), 0),
+        func.coalesce(func.sum(CampaignStats.clicked), 0),
+        func.coalesce(func.sum(CampaignStats.submitted), 0),
+        func.coalesce(func.sum(CampaignStats.reported), 0),
+    ).one()
+    return dict(zip(('total_targets', 'opened', 'clicked', 'submitted', 'reported'), sums))
+
+
+def repeat_offenders(user_ids=None, threshold=REPEAT_THRESHOLD):
+    """Users with at least `threshold` offenses, optionally limited to user_ids."""
+    query = db.session.query(UserPhishingStats.user_id).filter(UserPhishingStats.offenses >= threshold)
+    if user_ids is not None:
+        query = query.filter(UserPhishingStats.user_id.in_(list(user_ids)))
+    return {uid for (uid,) in query}
@@ -0,0 +1,154 @@
+"""
+Compressed integer bitmaps in the style of Roaring bitmaps.
+
+Values are split by their high 16 bits into containers. A container holds up to ARRAY_MAX low
+halves as a sorted array('H') and switches to a 65536-bit integer bitset beyond that, so sparse
+and dense ranges both stay small. Bitmaps serialize to bytes for storage in a LargeBinary column.
+"""
+
+import struct
+import sys
+from array import array
+from bisect import bisect_left, insort
+
+ARRAY_MAX = 4096
+BITSET_BYTES = 8192
+HEADER = struct.Struct('<I')
+CONTAINER = struct.Struct('<HBI')  # key, kind (0 array, 1 bitset), payload length
+ARRAY, BITSET = 0, 1
+
+
+def _to_bitset(values):
+    data = bytearray(BITSET_BYTES)
+    for v in values:
+        data[v >> 3] |= 1 << (v & 7)
+    return int.from_bytes(data, 'little')
+
+
+def _to_array(bits):
+    values = array('H')
+    for i, byte in enumerate(bits.to_bytes(BITSET_BYTES, 'little')):
+        if byte:
+            base = i << 3
+            values.extend(base | j for j in range(8) if byte >> j & 1)
+    return values
+
+
+class Bitmap:
+    """Set of non-negative integers below 2**32."""
+
+    def __init__(self, values=()):
+        self._containers = {}  # high 16 bits -> array('H') or int bitset
+        for value in sorted(values):
+            self.add(value)
+
+    def add(self, value):
+        key, low = value >> 16, value & 0xFFFF
+        container = self._containers.get(key)
+        if container is None:
+            self._containers[key] = array('H', [low])
+        elif isinstance(container, int):
+            self._containers[key] = container | (1 << low)
+        else:
+            i = bisect_left(container, low)
+            if i < len(container) and container[i] == low:
+                return
+            if len(container) >= ARRAY_MAX:
+                self._containers[key] = _to_bitset(container) | (1 << low)
+            else:
+                insort(container, low)
+
+    def discard(self, value):
+        key, low = value >> 16, value & 0xFFFF
+        container = self._containers.get(key)
+        if container is None:
+            return
+        if isinstance(container, int):
+            container &= ~(1 << low)
+            if container.bit_count() <= ARRAY_MAX:
+                container = _to_array(container)
+            self._containers[key] = container
+        else:
+            i = bisect_left(container, low)
+            if i < len(container) and container[i] == low:
+                del container[i]
+        if not container:
+            del self._containers[key]
+
+    def __contains__(self, value):
+        container = self._containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        i = bisect_left(container, low)
+        return i < len(container) and container[i] == low
+
+    def __len__(self):
+        return sum(c.bit_count() if isinstance(c, int) else len(c) for c in self._containers.values())
+
+    def __iter__(self):
+        for key in sorted(self._containers):
+            container = self._containers[key]
+            lows = _to_array(container) if isinstance(container, int) else container
+            base = key << 16
+            for low in lows:
+                yield base | low
+
+    def _bitsets(self, other):
+        for key in self._containers.keys() | other._containers.keys():
+            mine, theirs = self._containers.get(key), other._containers.get(key)
+            yield (key,
+                   mine if isinstance(mine, int) else _to_bitset(mine or ()),
+                   theirs if isinstance(theirs, int) else _to_bitset(theirs or ()))
+
+    @classmethod
+    def _from_bitsets(cls, pairs):
+        result = cls()
+        for key, bits in pairs:
+            if bits:
+                result._containers[key] = bits if bits.bit_count() > ARRAY_MAX else _to_array(bits)
+        return result
+
+    def __and__(self, other):
+        return self._from_bitsets((k, a & b) for k, a, b in self._bitsets(other))
+
+    def __or__(self, other):
+        return self._from_bitsets((k, a | b) for k, a, b in self._bitsets(other))
+
+    def __sub__(self, other):
+        return self._from_bitsets((k, a & ~b) for k, a, b in self._bitsets(other))
+
+    def to_bytes(self):
+        parts = [HEADER.pack(len(self._containers))]
+        for key in sorted(self._containers):
+            container = self._containers[key]
+            if isinstance(container, int):
+                payload, kind = container.to_bytes(BITSET_BYTES, 'little'), BITSET
+            else:
+                if sys.byteorder == 'big':
+                    container = array('H', container)
+                    container.byteswap()
+                payload, kind = container.tobytes(), ARRAY
+            parts += [CONTAINER.pack(key, kind, len(payload)), payload]
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        result = cls()
+        (count,), offset = HEADER.unpack_from(data), HEADER.size
+        for _ in range(count):
+            key, kind, length = CONTAINER.unpack_from(data, offset)
+            offset += CONTAINER.size
+            payload = data[offset:offset + length]
+            offset += length
+            if kind == BITSET:
+                result._containers[key] = int.from_bytes(payload, 'little')
+            else:
+                values = array('H')
+                values.frombytes(payload)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                result._containers[key] = values
+        return result
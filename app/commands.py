@@ -0,0 +1,130 @@
+"""
+Flask CLI commands for maintenance tasks (run with `flask --app run <command>`).
+"""
+
+import click
+from flask.cli import with_appcontext
+
+
+@click.command('rebuild-phishing-stats')
+@with_appcontext
+def rebuild_phishing_stats():
+    """Recompute per-campaign and per-user phishing funnel counters."""
+    from .aggregates import rebuild
+    campaigns, users = rebuild()
+    click.echo(f'Rebuilt phishing stats for {campaigns} campaigns and {users} users.')
+
+
+@click.command('backfill-survey-stats')
+@click.option('--survey-id', type=int, help='Only recount this survey.')
+@with_appcontext
+def backfill_survey_stats(survey_id):
+    """Recount survey answer tallies from the stored JSON responses."""
+    from .survey_stats import backfill
+    responses = backfill(survey_id)
+    click.echo(f'Counted {responses} survey responses.')
+
+
+@click.command('migrate-survey-answers')
+@click.option('--survey-id', type=int, help='Only migrate this survey.')
+@with_appcontext
+def migrate_survey_answers(survey_id):
+    """Copy JSON survey choices and answers into the normalized survey tables."""
+    from .survey_answers import migrate
+    responses = migrate(survey_id)
+    click.echo(f'Migrated {responses} survey responses.')
+
+
+@click.command('rebuild-policy-bitmaps')
+@with_appcontext
+def rebuild_policy_bitmaps():
+    """Recompute the per-policy acknowledgement bitmaps."""
+    from .compliance import rebuild
+    policies = rebuild()
+    click.echo(f'Rebuilt acknowledgement bitmaps for {policies} policies.')
+
+
+@click.command('check-db-profile')
+@with_appcontext
+def check_db_profile():
+    """Show the engine profile and the settings a live connection actually has."""
+    from flask import current_app
+    from .database import profile_for, settings
+    click.echo(f"profile: {profile_for(current_app.config)}")
+    for name, value in settings().items():
+        click.echo(f'{name}: {value}')
+
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade():
+    """Apply the pending schema migrations."""
+    from .migrations import upgrade
+    revisions = upgrade()
+    click.echo(f"Applied {', '.join(revisions)}." if revisions else 'Schema is up to date.')
+
+
+@click.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Print every plan, not only the regressions.')
+@with_appcontext
+def check_query_plans(verbose):
+    """Fail if a hot query's plan scans a table instead of using an index."""
+    from .query_plans import check
+    results = check()
+    failed = 0
+    for name, (plan, scans) in results.items():
+        if scans:
+            failed += 1
+        if scans or verbose:
+            click.echo(f"{'FAIL' if scans else 'ok'}  {name}")
+            for line in plan:
+                click.echo(f'      {line}')
+    if failed:
+        raise click.ClickException(f'Hot queries scanning a table: {failed}.')
+    click.echo(f'All {len(results)} hot queries use an index.')
+
+
+@click.command('sync-directory')
+@click.argument('export', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ldif']), help='Default: from the file extension.')
+@with_appcontext
+def sync_directory(export, fmt):
+    """Create, update and deactivate users to match a CSV or LDIF directory export."""
+    from .directory import READERS, format_for, sync
+    fmt = fmt or format_for(export.name)
+    if fmt is None:
+        raise click.UsageError('Cannot tell the format from the file name, pass --format.')
+    report = sync(READERS[fmt](export), progress=lambda report: click.echo(
+        f"{report['read']} read, {report['created']} created, {report['updated']} updated", err=True))
+    click.echo(', '.join(f'{count} {outcome}' for outcome, count in sorted(report.items())))
+
+
+@click.command('replay-remediation')
+@with_appcontext
+def replay_remediation():
+    """Rebuild the remediation counters from the phishing history and apply the rules."""
+    from .remediation import remediation_engine
+    report = remediation_engine.replay()
+    click.echo(f"Rebuilt {report['counters']} remediation counters, made {report['assigned']} assignments.")
+
+
+@click.command('run-scheduler')
+@with_appcontext
+def run_scheduler():
+    """Launch phishing campaigns at their scheduled time (runs until interrupted)."""
+    from .scheduler import campaign_scheduler
+    click.echo('Campaign scheduler running, press Ctrl+C to stop.')
+    campaign_scheduler.run()
+
+
+def register_commands(app):
+    app.cli.add_command(rebuild_phishing_stats)
+    app.cli.add_command(backfill_survey_stats)
+    app.cli.add_command(migrate_survey_answers)
+    app.cli.add_command(rebuild_policy_bitmaps)
+    app.cli.add_command(check_db_profile)
+    app.cli.add_command(db_upgrade)
+    app.cli.add_command(check_query_plans)
+    app.cli.add_command(sync_directory)
+    app.cli.add_command(replay_remediation)
+    app.cli.add_command(run_scheduler)
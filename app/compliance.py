@@ -0,0 +1,170 @@
+"""
+Policy compliance from per-policy acknowledgement bitmaps.
+
+Each policy has a Bitmap of the ids of the users who acknowledged it, persisted in
+PolicyAckBitmap and updated by record_ack() in the acknowledging transaction. Percentages,
+"not acknowledged" lists and grid filters are set operations on these bitmaps and on a bitmap
+of all user ids, so they never read the acknowledgement rows.
+
+Every write bumps PolicyAckBitmap.version. Updates are compare-and-swap on the version; a
+conflicting update clears the stored bitmap instead, and the next read rebuilds it from
+PolicyAcknowledgement.
+"""
+
+import threading
+from collections import namedtuple
+from itertools import islice
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db, versioning
+from .bitmaps import Bitmap
+from .models import PolicyAckBitmap, PolicyAcknowledgement, SecurityPolicy, User
+
+PolicySummary = namedtuple('PolicySummary', 'id title acknowledged total percent')
+GridRow = namedtuple('GridRow', 'user acknowledged')
+
+_cache = {}  # policy id -> (version, Bitmap)
+_users = {}  # users data version -> Bitmap of all user ids
+_lock = threading.Lock()
+
+
+def _insert_row(policy_id, data):
+    """Create the policy's row; False if another transaction created it first."""
+    try:
+        with db.session.begin_nested():
+            db.session.execute(PolicyAckBitmap.__table__.insert().values(
+                policy_id=policy_id, data=data, version=1))
+        return True
+    except IntegrityError:
+        return False
+
+
+def record_ack(policy_id, user_id):
+    """Add a user to the policy's bitmap; call in the transaction that adds the acknowledgement."""
+    table = PolicyAckBitmap.__table__
+    row = db.session.execute(select(table.c.data, table.c.version)
+                             .where(table.c.policy_id == policy_id)).first()
+    if row is None:
+        # Nothing stored yet: the first read builds the bitmap from the table, this row included
+        if _insert_row(policy_id, None):
+            return
+        row = (None, None)
+    data, version = row
+    if data is not None:
+        bitmap = Bitmap.from_bytes(data)
+        bitmap.add(user_id)
+        result = db.session.execute(update(table)
+                                    .where(table.c.policy_id == policy_id, table.c.version == version)
+                                    .values(data=bitmap.to_bytes(), version=table.c.version + 1))
+        if result.rowcount == 1:
+            return
+    db.session.execute(update(table).where(table.c.policy_id == policy_id)
+                       .values(data=None, version=table.c.version + 1))
+
+
+def _rebuild(policy_id, version):
+    """Bitmap from PolicyAcknowledgement, stored unless the row changed meanwhile (commits)."""
+    bitmap = Bitmap(uid for (uid,) in db.session.query(PolicyAcknowledgement.user_id)
+                    .filter_by(policy_id=policy_id).distinct())
+    table = PolicyAckBitmap.__table__
+    if version is None:
+        stored = _insert_row(policy_id, bitmap.to_bytes())
+        version = 1
+    else:
+        stored = db.session.execute(update(table)
+                                    .where(table.c.policy_id == policy_id, table.c.version == version)
+                                    .values(data=bitmap.to_bytes(), version=version + 1)).rowcount == 1
+        version += 1
+    db.session.commit()
+    return (version if stored else None), bitmap
+
+
+def policy_bitmaps(policy_ids):
+    """{policy id: Bitmap of the users who acknowledged it}."""
+    versions = dict(db.session.query(PolicyAckBitmap.policy_id, PolicyAckBitmap.version)
+                    .filter(PolicyAckBitmap.policy_id.in_(policy_ids)))
+    result = {}
+    with _lock:
+        for pid in policy_ids:
+            cached = _cache.get(pid)
+            if cached and cached[0] == versions.get(pid):
+                result[pid] = cached[1]
+    stale = [pid for pid in policy_ids if pid not in result]
+    stored = dict(db.session.query(PolicyAckBitmap.policy_id, PolicyAckBitmap.data)
+                  .filter(PolicyAckBitmap.policy_id.in_(stale))) if stale else {}
+    for pid in stale:
+        if stored.get(pid) is not None:
+            version, bitmap = versions.get(pid), Bitmap.from_bytes(stored[pid])
+        else:
+            version, bitmap = _rebuild(pid, versions.get(pid))
+        result[pid] = bitmap
+        if version is not None:
+            with _lock:
+                _cache[pid] = (version, bitmap)
+    return result
+
+
+def user_bitmap():
+    """Bitmap of every user id, cached until users change."""
+    version = versioning.current('users')
+    with _lock:
+        bitmap = _users.get(version)
+    if bitmap is None:
+        bitmap = Bitmap(uid for (uid,) in db.session.query(User.id))
+        with _lock:
+            _users.clear()
+            _users[version] = bitmap
+    return bitmap
+
+
+def summary(policies):
+    """[PolicySummary] with acknowledgement counts over current users."""
+    users = user_bitmap()
+    bitmaps = policy_bitmaps([p.id for p in policies])
+    total = len(users)
+    rows = []
+    for policy in policies:
+        acknowledged = len(bitmaps[policy.id] & users)
+        rows.append(PolicySummary(policy.id, policy.title, acknowledged, total,
+                                  round(acknowledged / total * 100, 1) if total else 0))
+    return rows
+
+
+def _page_of_users(ids, page, per_page):
+    page_ids = list(islice(ids, (page - 1) * per_page, page * per_page))
+    return User.query.filter(User.id.in_(page_ids)).order_by(User.id).all()
+
+
+def missing(policy_id, page=1, per_page=100):
+    """(one page of the users who have not acknowledged the policy, how many there are)."""
+    ids = user_bitmap() - policy_bitmaps([policy_id])[policy_id]
+    return _page_of_users(iter(ids), page, per_page), len(ids)
+
+
+def grid(policies, page=1, per_page=100, incomplete=False):
+    """(one page of GridRow(user, [acknowledged per policy]), number of rows), users by id.
+
+    With incomplete=True only users missing at least one of the policies are listed.
+    """
+    bitmaps = policy_bitmaps([p.id for p in policies])
+    if incomplete:
+        complete = user_bitmap()
+        for bitmap in bitmaps.values():
+            complete = complete & bitmap
+        ids = user_bitmap() - complete
+        users, total = _page_of_users(iter(ids), page, per_page), len(ids)
+    else:
+        total = db.session.query(func.count(User.id)).scalar()
+        users = User.query.order_by(User.id).limit(per_page).offset((page - 1) * per_page).all()
+    return [GridRow(user, [user.id in bitmaps[p.id] for p in policies]) for user in users], total
+
+
+def rebuild():
+    """Recompute every stored bitmap from PolicyAcknowledgement; returns how many policies."""
+    db.session.query(PolicyAckBitmap).delete()
+    db.session.commit()
+    with _lock:
+        _cache.clear()
+    return len(policy_bitmaps([pid for (pid,) in db.session.query(SecurityPolicy.id)]))
@@ -3,16 +3,89 @@ Configuration for Flask app.
 Edit SECRET_KEY and SQLALCHEMY_DATABASE_URI as needed.
 """
 
+import json
 import os
 
 class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY", "replace-this-with-a-secure-key")
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///cybersec_training.db'
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", 'sqlite:///cybersec_training.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Engine profile (app.database): 'sqlite' or 'postgresql', guessed from DATABASE_URL if unset
+    DB_PROFILE = os.environ.get("DB_PROFILE")
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 30000))
+    DB_IDLE_TX_TIMEOUT_MS = int(os.environ.get("DB_IDLE_TX_TIMEOUT_MS", 60000))
     # ...existing config... for mailserver
-    MAIL_SERVER = 'smtp.yourprovider.com'
-    MAIL_PORT = 587
-    MAIL_USE_TLS = True
-    MAIL_USERNAME = 'your@email.com'
-    MAIL_PASSWORD = 'yourpassword'
-    MAIL_DEFAULT_SENDER = 'your@email.com'
\ No newline at end of file
+    MAIL_SERVER = os.environ.get("MAIL_SERVER", 'smtp.yourprovider.com')
+    MAIL_PORT = int(os.environ.get("MAIL_PORT", 587))
+    MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS", "1") == "1"
+    MAIL_USERNAME = os.environ.get("MAIL_USERNAME", 'your@email.com')
+    MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD", 'yourpassword')
+    MAIL_DEFAULT_SENDER = os.environ.get("MAIL_DEFAULT_SENDER", 'your@email.com')
+    # Phishing send engine: SMTP connections kept open, messages/second per connection,
+    # and how many email_sent stamps are committed together
+    MAIL_POOL_SIZE = int(os.environ.get("MAIL_POOL_SIZE", 4))
+    MAIL_RATE_LIMIT = float(os.environ.get("MAIL_RATE_LIMIT", 5))
+    MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE", 200))
+    PHISHING_BASE_URL = os.environ.get("PHISHING_BASE_URL", 'http://localhost:5000')
+    # Tracking events are buffered and written every TRACKING_FLUSH_INTERVAL seconds,
+    # or sooner once TRACKING_BATCH_SIZE events are queued; a batch that fails to be written
+    # TRACKING_MAX_RETRIES times in a row is logged and dropped
+    TRACKING_FLUSH_INTERVAL = float(os.environ.get("TRACKING_FLUSH_INTERVAL", 1.0))
+    TRACKING_BATCH_SIZE = int(os.environ.get("TRACKING_BATCH_SIZE", 500))
+    TRACKING_MAX_RETRIES = int(os.environ.get("TRACKING_MAX_RETRIES", 5))
+    # Unknown tracking keys remembered in memory (Bloom filter) before it is reset, and how often
+    # each worker drops the campaigns other workers closed and loads the ones they launched (seconds)
+    TRACKING_NEGATIVE_CACHE_SIZE = int(os.environ.get("TRACKING_NEGATIVE_CACHE_SIZE", 100000))
+    TRACKING_INDEX_RESYNC_SECONDS = int(os.environ.get("TRACKING_INDEX_RESYNC_SECONDS", 60))
+    # Phishing risk score: weight per opened/clicked/submitted/reported target, score thresholds
+    # for the risk levels, optional half-life (days) for older campaigns, cache lifetime (seconds)
+    RISK_WEIGHTS = {'opened': 1, 'clicked': 3, 'submitted': 5, 'reported': -4}
+    RISK_THRESHOLDS = [(8, 'High'), (4, 'Medium')]
+    RISK_DECAY_HALF_LIFE_DAYS = float(os.environ.get("RISK_DECAY_HALF_LIFE_DAYS", 0)) or None
+    RISK_CACHE_TTL = int(os.environ.get("RISK_CACHE_TTL", 60))
+    # Background report jobs: worker processes, artifact cache directory, how long a
+    # queued/running job may take before a new request replaces it (seconds), and how many
+    # days finished jobs and their artifacts are kept
+    REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", 2))
+    REPORT_CACHE_DIR = os.environ.get("REPORT_CACHE_DIR", os.path.join(os.getcwd(), 'report_cache'))
+    REPORT_JOB_TIMEOUT = int(os.environ.get("REPORT_JOB_TIMEOUT", 1800))
+    REPORT_RETENTION_DAYS = float(os.environ.get("REPORT_RETENTION_DAYS", 7))
+    # Campaign scheduler: run it inside the web process (otherwise use `flask run-scheduler`),
+    # how often to reload pending campaigns (campaigns created in other processes may launch up
+    # to this late), and how long a node's sending lease lasts (seconds)
+    SCHEDULER_IN_PROCESS = os.environ.get("SCHEDULER_IN_PROCESS", "0") == "1"
+    SCHEDULER_RESYNC_SECONDS = int(os.environ.get("SCHEDULER_RESYNC_SECONDS", 60))
+    SCHEDULER_LEASE_SECONDS = int(os.environ.get("SCHEDULER_LEASE_SECONDS", 600))
+    # Cached users for the login manager (app.user_cache); set USER_CACHE_STAMP_DIR to a
+    # directory shared by all workers of a host to invalidate across them
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60))
+    USER_CACHE_STAMP_DIR = os.environ.get("USER_CACHE_STAMP_DIR")
+    # Directory sync (app.directory): entries per chunk, role of users the export gives none
+    DIRECTORY_CHUNK_SIZE = int(os.environ.get("DIRECTORY_CHUNK_SIZE", 1000))
+    DIRECTORY_DEFAULT_ROLE = os.environ.get("DIRECTORY_DEFAULT_ROLE", 'employee')
+    # Remediation rules (app.remediation) as JSON, e.g. [{"name": "repeat-clicker", "events": ["click"],
+    # "count": 2, "days": 90, "module_id": 3}]; unset keeps the built-in click and submission rules
+    REMEDIATION_RULES = json.loads(os.environ.get("REMEDIATION_RULES", "null"))
+    # Per-endpoint latency and query metrics on /metrics (app.instrumentation); METRICS_TOKEN, if
+    # set, is required as a bearer token, and METRICS_DEBUG_HEADER adds a Server-Timing header
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+    METRICS_DEBUG_HEADER = os.environ.get("METRICS_DEBUG_HEADER", "0") == "1"
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+    # Blueprints to register (app.routes.BLUEPRINTS), comma-separated; unset registers them all
+    BLUEPRINTS = [name.strip() for name in os.environ.get("BLUEPRINTS", "").split(",") if name.strip()] or None
+    # Rendered dashboard panels (app.fragments): 'memory' (per process), 'disk' (FRAGMENT_CACHE_DIR,
+    # shared by the workers of a host) or 'none', bounded to FRAGMENT_CACHE_MAX_BYTES
+    FRAGMENT_CACHE_BACKEND = os.environ.get("FRAGMENT_CACHE_BACKEND", 'memory')
+    FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get("FRAGMENT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    FRAGMENT_CACHE_DIR = os.environ.get("FRAGMENT_CACHE_DIR", os.path.join(os.getcwd(), 'fragment_cache'))
+    # Async tracking service (app.tracking_service, `uvicorn tracking_asgi:app`): URL of the database
+    # through an async driver (derived from DATABASE_URL if unset), and how often it drops closed campaigns
+    TRACKING_ASYNC_DATABASE_URL = os.environ.get("TRACKING_ASYNC_DATABASE_URL")
+    TRACKING_SERVICE_RESYNC_SECONDS = int(os.environ.get("TRACKING_SERVICE_RESYNC_SECONDS", 60))
\ No newline at end of file
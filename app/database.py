@@ -0,0 +1,86 @@
+"""
+Database engine profiles.
+
+DATABASE_URL selects the database and DB_PROFILE ('sqlite' or 'postgresql', guessed from the
+URL when unset) the engine settings:
+
+- sqlite: WAL journal, synchronous=NORMAL, a busy timeout and memory-mapped I/O, set on every
+  new connection, so readers no longer block the tracking, training and acknowledgement writers.
+- postgresql: a sized connection pool with pre-ping and recycling, and server-side statement
+  and idle-transaction timeouts.
+"""
+
+from sqlalchemy import event, text
+
+from . import db
+
+PROFILES = ('sqlite', 'postgresql')
+
+
+def profile_for(config):
+    profile = config.get('DB_PROFILE')
+    if not profile:
+        profile = 'postgresql' if config['SQLALCHEMY_DATABASE_URI'].startswith('postgres') else 'sqlite'
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE {profile!r}, expected one of {', '.join(PROFILES)}")
+    return profile
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured profile."""
+    if profile_for(config) == 'sqlite':
+        return {
+            # seconds the driver waits on a locked database; busy_timeout below covers SQLite itself
+            'connect_args': {'timeout': config.get('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000,
+                             'check_same_thread': False},
+        }
+    timeouts = (f"-c statement_timeout={config.get('DB_STATEMENT_TIMEOUT_MS', 30000)} "
+                f"-c idle_in_transaction_session_timeout={config.get('DB_IDLE_TX_TIMEOUT_MS', 60000)}")
+    return {
+        'pool_size': config.get('DB_POOL_SIZE', 10),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 20),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 10),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': True,
+        'connect_args': {'options': timeouts},
+    }
+
+
+def configure(app):
+    """Merge the profile's engine options into the app config; call before db.init_app(app)."""
+    options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(engine_options(app.config), **options)
+
+
+def init_app(app):
+    """Install per-connection settings on the app's engine; call after db.init_app(app)."""
+    if profile_for(app.config) != 'sqlite':
+        return
+    pragmas = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        f"PRAGMA busy_timeout={int(app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}",
+        f"PRAGMA mmap_size={int(app.config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+    )
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    with app.app_context():
+        event.listen(db.engine, 'connect', set_pragmas)
+
+
+def settings():
+    """Effective settings of a live connection, as {name: value}."""
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        names = ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size')
+        return {name: connection.execute(text(f'PRAGMA {name}')).scalar() for name in names}
+    names = ('statement_timeout', 'idle_in_transaction_session_timeout', 'max_connections')
+    result = {name: connection.execute(text(f'SHOW {name}')).scalar() for name in names}
+    pool = db.engine.pool
+    result['pool'] = pool.status() if hasattr(pool, 'status') else type(pool).__name__
+    return result
@@ -0,0 +1,230 @@
+"""
+User directory import and sync.
+
+Streams a CSV or LDIF export of the company directory and makes the user table match it,
+DIRECTORY_CHUNK_SIZE entries at a time, so memory stays flat whatever the size of the export:
+
+- the usernames of a chunk are looked up at once through the unique username index into a dict,
+  the hash index the entries are diffed against;
+- new users are inserted and changed ones updated with executemany statements, every listed user
+  is stamped with the sync's id, and the chunk commits;
+- at the end, directory users the export no longer lists are deactivated (is_active = False).
+
+Only users a sync created or listed are managed: local accounts missing from the export are left
+alone, and superadmins are never created or changed (their entries are counted as protected).
+Active users stay within the active License.user_limit; new or reactivated users beyond it are
+skipped and counted as over_limit, and the seats that this sync's deactivations free are
+available to the next one.
+"""
+
+import base64
+import csv
+import uuid
+from collections import Counter, namedtuple
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import func, select, update
+
+from . import db, upserts, versioning
+from .models import License, User
+from .user_cache import user_cache
+
+Entry = namedtuple('Entry', 'username department role active')
+
+FORMATS = ('csv', 'ldif')
+# Directory users log in through the directory, not with a local password
+UNUSABLE_PASSWORD = '!'
+INACTIVE_VALUES = {'0', 'false', 'no', 'n', 'inactive', 'disabled'}
+# LDIF attribute (lower case) -> Entry field; the first attribute present wins
+LDIF_ATTRIBUTES = {
+    'username': ('uid', 'samaccountname', 'mail'),
+    'department': ('department', 'ou'),
+    'role': ('employeetype',),
+}
+ACCOUNTDISABLE = 0x2  # userAccountControl flag of disabled Active Directory accounts
+
+
+def read_csv(stream):
+    """Entries of a CSV export with a username column and optional department, role and active columns."""
+    for record in csv.DictReader(stream):
+        record = {key.strip().lower(): (value or '').strip() for key, value in record.items() if key}
+        yield Entry(record.get('username', ''), record.get('department') or None, record.get('role') or None,
+                    record.get('active', '').lower() not in INACTIVE_VALUES)
+
+
+def _add_attribute(record, line):
+    name, _, value = line.partition(':')
+    if value.startswith(':'):  # base64 value
+        value = base64.b64decode(value[1:].strip()).decode('utf-8')
+    record.setdefault(name.strip().lower(), value.strip())
+
+
+def _ldif_records(stream):
+    """{attribute: first value} per LDIF record, attribute names lower case."""
+    record, line = {}, None
+    for raw in stream:
+        raw = raw.rstrip('\r\n')
+        if raw.startswith(' ') and line is not None:  # folded line
+            line += raw[1:]
+            continue
+        if line is not None:
+            _add_attribute(record, line)
+        line = None
+        if not raw:
+            if record:
+                yield record
+            record = {}
+        elif not raw.startswith('#'):
+            line = raw
+    if line is not None:
+        _add_attribute(record, line)
+    if record:
+        yield record
+
+
+def read_ldif(stream):
+    """Entries of an LDIF export; records without a username attribute (e.g. groups) are skipped."""
+    for record in _ldif_records(stream):
+        fields = {field: next((record[name] for name in names if record.get(name)), None)
+                  for field, names in LDIF_ATTRIBUTES.items()}
+        if not fields['username']:
+            continue
+        disabled = (int(record.get('useraccountcontrol') or 0) & ACCOUNTDISABLE
+                    or record.get('nsaccountlock', '').lower() == 'true')
+        yield Entry(fields['username'], fields['department'], fields['role'], not disabled)
+
+
+READERS = {'csv': read_csv, 'ldif': read_ldif}
+
+
+def format_for(filename):
+    """'csv' or 'ldif' from a file name, or None."""
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return extension if extension in FORMATS else None
+
+
+def _free_seats():
+    """Active users the license still allows, or None when no license limits them."""
+    license = License.query.filter_by(active=True).first()
+    if license is None:
+        return None
+    active = db.session.query(func.count(User.id)).filter(User.is_active.is_(True)).scalar()
+    return license.user_limit - active
+
+
+def _apply(chunk, run, report, seats):
+    """Diff one chunk of entries against the user table and write it; returns the seats left."""
+    existing = {row.username: row for row in db.session.query(
+        User.id, User.username, User.department, User.role, User.is_active, User.directory_sync)
+        .filter(User.username.in_(chunk))}
+    default_role = current_app.config.get('DIRECTORY_DEFAULT_ROLE', 'employee')
+    inserts, updates, stamps = [], [], []
+    for entry in chunk.values():
+        current = existing.get(entry.username)
+        # An export can neither create, change nor demote a superadmin
+        if entry.role == 'superadmin' or (current is not None and current.role == 'superadmin'):
+            report['protected'] += 1
+            continue
+        if current is None:
+            if entry.active and seats is not None and seats <= 0:
+                report['over_limit'] += 1
+                continue
+            if entry.active and seats is not None:
+                seats -= 1
+            inserts.append({'username': entry.username, 'password_hash': UNUSABLE_PASSWORD,
+                            'role': entry.role or default_role, 'department': entry.department,
+                            'is_active': entry.active, 'directory_sync': run})
+            continue
+        active = entry.active
+        if active and not current.is_active:
+            if seats is not None and seats <= 0:
+                report['over_limit'] += 1
+                active = False
+            elif seats is not None:
+                seats -= 1
+        elif current.is_active and not active and seats is not None:
+            seats += 1
+        # Fields the export leaves empty keep their current value
+        values = {'department': entry.department or current.department, 'role': entry.role or current.role,
+                  'is_active': active}
+        if any(getattr(current, name) != value for name, value in values.items()):
+            updates.append(dict(values, id=current.id, directory_sync=run))
+        elif current.directory_sync != run:
+            stamps.append(current.id)
+            report['unchanged'] += 1
+
+    if inserts:
+        # Inserting against the unique username index: a user created meanwhile is left alone
+        created = upserts.upsert_many(User, inserts, key=['username'])
+        if created < 0:
+            # The driver gave no row count: the users this run created carry its stamp
+            created = (db.session.query(func.count(User.id))
+                       .filter(User.username.in_([row['username'] for row in inserts]), User.directory_sync == run)
+                       .scalar())
+        report['created'] += created
+    if updates:
+        db.session.execute(update(User), updates)
+        report['updated'] += len(updates)
+    if stamps:
+        db.session.execute(update(User).where(User.id.in_(stamps)).values(directory_sync=run)
+                           .execution_options(synchronize_session=False))
+    if updates:
+        versioning.bump('users')
+    db.session.commit()
+    if updates:
+        # Bulk updates skip the ORM events the user cache listens to
+        user_cache.invalidate(*(row['id'] for row in updates))
+    return seats
+
+
+def _deactivate_missing(run, chunk_size):
+    """Deactivate the active directory users this sync did not list; returns how many."""
+    stale = (select(User.id).where(User.directory_sync.isnot(None), User.directory_sync != run,
+                                   User.is_active.is_(True), User.role != 'superadmin')
+             .limit(chunk_size))
+    deactivated = 0
+    while True:
+        ids = db.session.execute(stale).scalars().all()
+        if not ids:
+            return deactivated
+        db.session.execute(update(User).where(User.id.in_(ids)).values(is_active=False)
+                           .execution_options(synchronize_session=False))
+        versioning.bump('users')
+        db.session.commit()
+        user_cache.invalidate(*ids)
+        deactivated += len(ids)
+
+
+def sync(entries, chunk_size=None, progress=None):
+    """Make the user table match an iterable of entries; returns a Counter of what was done.
+
+    progress, if given, is called with the Counter after each chunk.
+    """
+    chunk_size = chunk_size or current_app.config.get('DIRECTORY_CHUNK_SIZE', 1000)
+    run = uuid.uuid4().hex
+    report = Counter()
+    seats = _free_seats()
+    entries = iter(entries)
+    while True:
+        chunk, read = {}, 0
+        for entry in islice(entries, chunk_size):
+            read += 1
+            username = entry.username.strip()
+            if not username or len(username) > 150:
+                report['invalid'] += 1
+            elif username in chunk:
+                report['duplicate'] += 1
+            else:
+                chunk[username] = entry._replace(username=username)
+        report['read'] += read
+        if chunk:
+            seats = _apply(chunk, run, report, seats)
+        if progress:
+            progress(report)
+        if read < chunk_size:
+            break
+    # An export without a single valid entry is more likely a wrong file than an empty directory
+    if report['read'] > report['invalid']:
+        report['deactivated'] = _deactivate_missing(run, chunk_size)
+    return report
@@ -0,0 +1,86 @@
+"""
+Streaming exports of phishing campaign results (CSV or NDJSON, optionally gzipped).
+Rows are read with a server-side cursor and written out in chunks, so memory stays flat.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from . import db
+from .models import PhishingCampaign, PhishingTarget, User
+
+FIELDS = [
+    ('campaign', "Campaign"),
+    ('user', "User"),
+    ('email_sent', "Email Sent"),
+    ('email_opened', "Email Opened"),
+    ('link_clicked', "Link Clicked"),
+    ('data_submitted', "Data Submitted"),
+    ('reported_phish', "Reported as Phish"),
+]
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+YIELD_PER = 1000
+CHUNK_ROWS = 500
+
+
+def result_rows(campaign_ids):
+    """Target rows joined with their user and campaign, fetched YIELD_PER at a time."""
+    return (db.session.query(PhishingCampaign.name, User.username,
+                             PhishingTarget.email_sent, PhishingTarget.email_opened,
+                             PhishingTarget.link_clicked, PhishingTarget.data_submitted,
+                             PhishingTarget.reported_phish)
+            .join(User, User.id == PhishingTarget.user_id)
+            .join(PhishingCampaign, PhishingCampaign.id == PhishingTarget.campaign_id)
+            .filter(PhishingTarget.campaign_id.in_(campaign_ids))
+            .order_by(PhishingTarget.campaign_id, PhishingTarget.id)
+            .yield_per(YIELD_PER))
+
+
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([label for _, label in FIELDS])
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(rows):
+    keys = [key for key, _ in FIELDS]
+    lines = []
+    for row in rows:
+        record = {key: value.isoformat() if hasattr(value, 'isoformat') else value
+                  for key, value in zip(keys, row)}
+        lines.append(json.dumps(record) + '\n')
+        if len(lines) >= CHUNK_ROWS:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(campaign_ids, fmt='csv', gzip=False):
+    """Body chunks for the export in the given format."""
+    chunks = {'csv': csv_chunks, 'ndjson': ndjson_chunks}[fmt](result_rows(campaign_ids))
+    if gzip:
+        return gzip_chunks(chunks)
+    return (chunk.encode('utf-8') for chunk in chunks)
@@ -0,0 +1,216 @@
+"""
+Cache of rendered page fragments, and conditional responses for the dashboards.
+
+fragment_cache.fragment(name, depends, render, *key) returns the HTML of a dashboard panel
+(funnel, risk table, completion chart...). It is cached under the panel name, its key and the
+current version counters (app.versioning) of the data sets it depends on, so any change to that
+data renders it again on the next request, in every worker. The backend is pluggable through
+FRAGMENT_CACHE_BACKEND:
+
+- 'memory' (default): an LRU per process, bounded to FRAGMENT_CACHE_MAX_BYTES;
+- 'disk': files in FRAGMENT_CACHE_DIR shared by the workers of a host, the least recently used
+  removed once they add up to more than FRAGMENT_CACHE_MAX_BYTES;
+- 'none', or any object with get(key), set(key, value) and clear().
+
+@conditional gives a view's 200 responses a strong ETag (a hash of the body) and answers a
+matching If-None-Match with 304 Not Modified, without the body.
+"""
+
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from flask import make_response, request
+from markupsafe import Markup
+
+from . import versioning
+
+
+class MemoryBackend:
+    """Least recently used fragments of this process, up to max_bytes in total."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self.size += len(value) - (len(old) if old is not None else 0)
+            self._entries[key] = value
+            while self.size > self.max_bytes:
+                self.size -= len(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class DiskBackend:
+    """Fragments as files of a directory shared by processes; reads refresh a file's mtime.
+
+    Each process keeps an estimate of the directory size; when it goes over max_bytes the
+    directory is scanned and the files least recently used removed down to 90% of it.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                stored_key, _, value = f.read().partition(b'\n')
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value.decode() if stored_key == key.encode() else None
+
+    def set(self, key, value):
+        data = key.encode() + b'\n' + value.encode()
+        if len(data) > self.max_bytes:
+            return
+        # Written aside and renamed, so readers in other processes never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and not entry.name.startswith('.tmp-'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue  # removed by another process meanwhile
+        self.size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                try:
+                    os.remove(entry.path)
+                except (FileNotFoundError, IsADirectoryError):
+                    pass
+            self.size = 0
+
+
+class NullBackend:
+    """Caches nothing: every fragment is rendered."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+BACKENDS = {
+    'memory': lambda config: MemoryBackend(config['FRAGMENT_CACHE_MAX_BYTES']),
+    'disk': lambda config: DiskBackend(config['FRAGMENT_CACHE_DIR'], config['FRAGMENT_CACHE_MAX_BYTES']),
+    'none': lambda config: NullBackend(),
+}
+
+
+class FragmentCache:
+    """Rendered fragments keyed on their data versions, in a pluggable backend."""
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_BACKEND', 'memory')
+        app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.config.setdefault('FRAGMENT_CACHE_DIR', os.path.join(app.instance_path, 'fragments'))
+        app.extensions['fragment_cache'] = self
+        backend = app.config['FRAGMENT_CACHE_BACKEND']
+        if isinstance(backend, str):
+            if backend not in BACKENDS:
+                raise ValueError(f"FRAGMENT_CACHE_BACKEND must be one of {', '.join(BACKENDS)} or a backend object")
+            backend = BACKENDS[backend](app.config)
+        self.backend = backend
+
+    def fragment(self, name, depends, render, *key):
+        """HTML of a fragment, from the cache or from render() (then stored).
+
+        depends names the data sets (app.versioning) the fragment shows; key holds whatever else
+        it varies with, such as the page number or the user.
+        """
+        versions = versioning.current(*depends)
+        cache_key = f"{name}:{key!r}:{dict(zip(depends, versions))!r}"
+        html = self.backend.get(cache_key)
+        if html is not None:
+            self.hits += 1
+            return Markup(html)
+        self.misses += 1
+        html = str(render())
+        self.backend.set(cache_key, html)
+        return Markup(html)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'backend': type(self.backend).__name__,
+                'size': getattr(self.backend, 'size', None)}
+
+
+fragment_cache = FragmentCache()
+
+
+def conditional(view):
+    """Strong ETag on the view's 200 responses; 304 when the client already has that body."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if request.method not in ('GET', 'HEAD') or response.status_code != 200 or response.is_streamed:
+            return response
+        response.add_etag()
+        # Pages differ per user: browsers may keep them, but must revalidate before each use
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    return wrapper
@@ -0,0 +1,245 @@
+"""
+Per-endpoint request and database instrumentation (opt-in with METRICS_ENABLED).
+
+For every request it records, under the endpoint that served it:
+
+- the latency, in a histogram with METRICS_BUCKETS (seconds);
+- the SQL statements executed and their time, from the engine's cursor events, with the
+  statements per request in a histogram too, which is where N+1 query patterns show up;
+- the ORM rows loaded and the rows changed by writes.
+
+/metrics serves them in the Prometheus text format, with the user cache, fragment cache and
+tracking queue figures, to anyone if METRICS_TOKEN is unset and otherwise to "Authorization:
+Bearer <token>". With METRICS_DEBUG_HEADER every response also carries a Server-Timing header
+with its own numbers. The hot path only reads the clock and bumps counters of a per-thread
+object that is reused across requests (no allocations), and takes one lock per request.
+Statements run outside a request (background threads) are not counted. Counters are per process.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, request
+from sqlalchemy import event
+
+from . import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class EndpointStats:
+    """Counters of one endpoint."""
+
+    __slots__ = ('statuses', 'latency', 'latency_sum', 'queries', 'query_total', 'db_seconds', 'rows')
+
+    def __init__(self, latency_buckets):
+        self.statuses = {}
+        self.latency = [0] * (len(latency_buckets) + 1)  # per bucket, last one is +Inf
+        self.latency_sum = 0.0
+        self.queries = [0] * (len(QUERY_BUCKETS) + 1)
+        self.query_total = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+
+
+class RequestStats:
+    """What the current request has done so far; one per thread, reused by its requests."""
+
+    __slots__ = ('active', 'start', 'queries', 'db_seconds', 'rows', 'query_start')
+
+    def __init__(self):
+        self.active = False
+
+    def begin(self):
+        self.active = True
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+        self.query_start = 0.0
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Instrumentation:
+    """Request latency and database metrics per endpoint, served on /metrics."""
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._rows_listener = False
+        self.latency_buckets = LATENCY_BUCKETS
+        self.debug_header = False
+        self.token = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('METRICS_DEBUG_HEADER', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_BUCKETS', LATENCY_BUCKETS)
+        app.extensions['instrumentation'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        self.latency_buckets = tuple(sorted(app.config['METRICS_BUCKETS']))
+        self.debug_header = app.config['METRICS_DEBUG_HEADER']
+        self.token = app.config['METRICS_TOKEN']
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(db.engine, 'after_cursor_execute', self._after_cursor_execute)
+        if not self._rows_listener:
+            event.listen(db.Model, 'load', self._loaded, propagate=True)
+            self._rows_listener = True
+
+    # --- hot path ---
+
+    def _stats(self):
+        """This thread's RequestStats if a request is being measured, else None."""
+        stats = getattr(self._local, 'stats', None)
+        return stats if stats is not None and stats.active else None
+
+    def _start(self):
+        stats = getattr(self._local, 'stats', None)
+        if stats is None:
+            stats = self._local.stats = RequestStats()
+        stats.begin()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None and stats.active:
+            stats.query_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None and stats.active:
+            stats.db_seconds += time.perf_counter() - stats.query_start
+            stats.queries += 1
+            if cursor.rowcount > 0:  # rows changed by a write; -1 for SELECTs
+                stats.rows += cursor.rowcount
+
+    def _loaded(self, target, context):
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None and stats.active:
+            stats.rows += 1
+
+    def _finish(self, response):
+        stats = self._stats()
+        if stats is None:
+            return response
+        stats.active = False
+        seconds = time.perf_counter() - stats.start
+        self._record(request.endpoint or 'unmatched', response.status_code, seconds, stats)
+        if self.debug_header:
+            response.headers['Server-Timing'] = (
+                f'app;dur={seconds * 1000:.1f}, '
+                f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries, {stats.rows} rows"')
+        return response
+
+    def _teardown(self, exc):
+        # Requests that raised never reach after_request
+        stats = self._stats()
+        if stats is not None:
+            stats.active = False
+            self._record(request.endpoint or 'unmatched', 500, time.perf_counter() - stats.start, stats)
+
+    def _record(self, endpoint, status, seconds, stats):
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = EndpointStats(self.latency_buckets)
+            entry.statuses[status] = entry.statuses.get(status, 0) + 1
+            entry.latency[bisect_left(self.latency_buckets, seconds)] += 1
+            entry.latency_sum += seconds
+            entry.queries[bisect_left(QUERY_BUCKETS, stats.queries)] += 1
+            entry.query_total += stats.queries
+            entry.db_seconds += stats.db_seconds
+            entry.rows += stats.rows
+
+    # --- export ---
+
+    def snapshot(self):
+        """{endpoint: EndpointStats} copied under the lock."""
+        with self._lock:
+            copies = {}
+            for endpoint, entry in self._endpoints.items():
+                copy = EndpointStats(self.latency_buckets)
+                for name in EndpointStats.__slots__:
+                    value = getattr(entry, name)
+                    setattr(copy, name, value.copy() if isinstance(value, (list, dict)) else value)
+                copies[endpoint] = copy
+            return copies
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def render(self, extensions=None):
+        """All metrics in the Prometheus text exposition format."""
+        endpoints = sorted(self.snapshot().items())
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+
+        def histogram(name, buckets, counts, total, labels):
+            samples, cumulative = [], 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                samples.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            samples.append(f'{name}_sum{{{labels}}} {total}')
+            samples.append(f'{name}_count{{{labels}}} {cumulative}')
+            return samples
+
+        metric('app_requests_total', 'counter', 'Requests served, per endpoint and status.',
+               [f'app_requests_total{{endpoint="{_label(e)}",status="{status}"}} {n}'
+                for e, stats in endpoints for status, n in sorted(stats.statuses.items())])
+        metric('app_request_duration_seconds', 'histogram', 'Request latency per endpoint.',
+               [sample for e, stats in endpoints for sample in histogram(
+                   'app_request_duration_seconds', self.latency_buckets, stats.latency,
+                   round(stats.latency_sum, 6), f'endpoint="{_label(e)}"')])
+        metric('app_request_db_queries', 'histogram', 'SQL statements per request, per endpoint.',
+               [sample for e, stats in endpoints for sample in histogram(
+                   'app_request_db_queries', QUERY_BUCKETS, stats.queries, stats.query_total,
+                   f'endpoint="{_label(e)}"')])
+        metric('app_db_query_seconds_total', 'counter', 'Time spent executing SQL, per endpoint.',
+               [f'app_db_query_seconds_total{{endpoint="{_label(e)}"}} {round(stats.db_seconds, 6)}'
+                for e, stats in endpoints])
+        metric('app_db_rows_total', 'counter', 'ORM rows loaded plus rows changed by writes, per endpoint.',
+               [f'app_db_rows_total{{endpoint="{_label(e)}"}} {stats.rows}' for e, stats in endpoints])
+
+        extensions = extensions or {}
+        if 'user_cache' in extensions:
+            stats = extensions['user_cache'].stats()
+            for name in ('hits', 'misses', 'invalidations'):
+                metric(f'app_user_cache_{name}_total', 'counter', f'User cache {name}.',
+                       [f'app_user_cache_{name}_total {stats[name]}'])
+            metric('app_user_cache_size', 'gauge', 'Users in the cache.', [f"app_user_cache_size {stats['size']}"])
+        if 'fragment_cache' in extensions:
+            stats = extensions['fragment_cache'].stats()
+            for name in ('hits', 'misses'):
+                metric(f'app_fragment_cache_{name}_total', 'counter', f'Fragment cache {name}.',
+                       [f'app_fragment_cache_{name}_total {stats[name]}'])
+        if 'event_recorder' in extensions:
+            metric('app_tracking_events_pending', 'gauge', 'Tracking events queued, not yet written.',
+                   [f"app_tracking_events_pending {extensions['event_recorder'].pending()}"])
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        if self.token and request.headers.get('Authorization') != f'Bearer {self.token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(self.render(current_app.extensions), mimetype='text/plain; version=0.0.4')
+
+
+instrumentation = Instrumentation()
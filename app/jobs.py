@@ -0,0 +1,263 @@
+"""
+Background report jobs (training progress, policy acknowledgements, phishing results).
+
+Each request is hashed together with the version counters of the data it reads. The hash is
+both the job id and the artifact file name, so repeat requests are served from disk until the
+data changes. Rendering happens in a bounded pool of worker processes. Jobs and artifacts older
+than REPORT_RETENTION_DAYS are pruned after each job.
+"""
+
+import csv
+import functools
+import hashlib
+import json
+import os
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from flask import Flask, current_app, render_template
+from sqlalchemy import delete, update
+
+from . import db, upserts, versioning
+from .models import (ReportJob, SecurityPolicy, PolicyAcknowledgement, TrainingModule,
+                     User, UserProgress)
+
+FORMATS = {
+    'pdf': 'application/pdf',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+}
+
+USER_CHUNK = 1000
+
+_executor = None
+
+
+# --- Report tables: (title, header, rows) ---
+
+def _users(params):
+    query = User.query.order_by(User.username)
+    if params.get('department'):
+        query = query.filter(User.department == params['department'])
+    if params.get('role'):
+        query = query.filter(User.role == params['role'])
+    return query
+
+
+def _user_chunks(params):
+    chunk = []
+    for user in _users(params).yield_per(USER_CHUNK):
+        chunk.append(user)
+        if len(chunk) == USER_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def training_table(params):
+    modules = TrainingModule.query.order_by(TrainingModule.title).all()
+
+    def rows():
+        for users in _user_chunks(params):
+            done = set(db.session.query(UserProgress.user_id, UserProgress.module_id)
+                       .filter(UserProgress.user_id.in_([u.id for u in users]),
+                               UserProgress.completed.is_(True)))
+            for user in users:
+                yield [user.username] + ['Yes' if (user.id, m.id) in done else 'No' for m in modules]
+
+    return "Training Progress Report", ["Username"] + [m.title for m in modules], rows()
+
+
+def policy_table(params):
+    policies = SecurityPolicy.query.order_by(SecurityPolicy.upload_date).all()
+
+    def rows():
+        for users in _user_chunks(params):
+            acks = {(a.user_id, a.policy_id): a.acknowledged_at for a in PolicyAcknowledgement.query
+                    .filter(PolicyAcknowledgement.user_id.in_([u.id for u in users]))}
+            for user in users:
+                yield [user.username] + [acks.get((user.id, p.id)) or '' for p in policies]
+
+    return "Policy Acknowledgement Report", ["Username"] + [p.title for p in policies], rows()
+
+
+def phishing_table(params):
+    from .export import FIELDS, result_rows
+    return ("Phishing Campaign Results", [label for _, label in FIELDS],
+            (list(row) for row in result_rows(params['campaign_ids'])))
+
+
+REPORTS = {
+    # kind -> (table builder, data sets it depends on)
+    'training': (training_table, ('progress', 'modules', 'users')),
+    'policy': (policy_table, ('policy_acks', 'policies', 'users')),
+    'phishing': (phishing_table, ('phishing', 'users')),
+}
+
+
+# --- Writers ---
+
+def write_csv(path, title, header, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def write_xlsx(path, title, header, rows):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError("XLSX reports need openpyxl (pip install openpyxl)")
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title[:31])
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def write_pdf(path, title, header, rows):
+    try:
+        from weasyprint import HTML
+    except ImportError:
+        raise RuntimeError("PDF reports need WeasyPrint (pip install weasyprint)")
+    html = render_template('admin/report_pdf.html', title=title, header=header, rows=rows)
+    HTML(string=html).write_pdf(path)
+
+
+WRITERS = {'csv': write_csv, 'xlsx': write_xlsx, 'pdf': write_pdf}
+
+
+# --- Jobs ---
+
+def job_key(kind, fmt, params):
+    """Hash of the request and of the current versions of the data it reads."""
+    versions = versioning.current(*REPORTS[kind][1])
+    payload = json.dumps([kind, fmt, params, versions], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def artifact_path(job):
+    return os.path.join(current_app.config['REPORT_CACHE_DIR'], f"{job.id}.{job.fmt}")
+
+
+def submit(kind, fmt, params):
+    """Return the job for this request, queuing it unless a fresh one already exists."""
+    key = job_key(kind, fmt, params)
+    job = db.session.get(ReportJob, key)
+    timeout = timedelta(seconds=current_app.config['REPORT_JOB_TIMEOUT'])
+    if job is not None:
+        if job.status == 'done' and os.path.exists(artifact_path(job)):
+            return job
+        if job.status in ('queued', 'running') and job.created_at > datetime.utcnow() - timeout:
+            return job
+        # Only the request that still sees this stale job replaces it
+        db.session.execute(delete(ReportJob).where(ReportJob.id == key, ReportJob.created_at == job.created_at))
+        db.session.expunge(job)
+    # ON CONFLICT DO NOTHING: of concurrent identical requests, one queues the job, the others get it
+    queued = upserts.upsert(ReportJob, {'id': key, 'kind': kind, 'fmt': fmt, 'status': 'queued',
+                                        'params': json.dumps(params, sort_keys=True),
+                                        'created_at': datetime.utcnow()}, key=['id'])
+    db.session.commit()
+    if queued:
+        future = _get_executor().submit(run_job, key)
+        future.add_done_callback(functools.partial(_job_done, current_app._get_current_object(), key))
+    return db.session.get(ReportJob, key)
+
+
+def prune():
+    """Delete jobs finished over REPORT_RETENTION_DAYS ago and any file that old; returns files removed."""
+    days = current_app.config['REPORT_RETENTION_DAYS']
+    db.session.execute(delete(ReportJob).where(ReportJob.finished_at < datetime.utcnow() - timedelta(days=days)))
+    db.session.commit()
+    directory = current_app.config['REPORT_CACHE_DIR']
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - days * 86400
+    removed = 0
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue  # removed by another worker meanwhile
+    return removed
+
+
+def _job_done(app, job_id, future):
+    """Fail a job whose worker raised outside run_job's own error handling (setup, first query)."""
+    global _executor
+    exc = None if future.cancelled() else future.exception()
+    if exc is None:
+        return
+    app.logger.error('Report job %s crashed', job_id, exc_info=exc)
+    if isinstance(exc, BrokenProcessPool):
+        _executor = None  # the next job starts a new pool
+    with app.app_context():
+        db.session.execute(update(ReportJob)
+                           .where(ReportJob.id == job_id, ReportJob.status.in_(('queued', 'running')))
+                           .values(status='failed', error=str(exc)[:500], finished_at=datetime.utcnow()))
+        db.session.commit()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn, not fork: workers must not share the parent's database connections. They get
+        # the parent's effective settings, create_app() overrides included
+        _executor = ProcessPoolExecutor(max_workers=current_app.config['REPORT_WORKERS'],
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker, initargs=(dict(current_app.config),))
+    return _executor
+
+
+_worker_app = None
+
+
+def _init_worker(config):
+    """Worker process setup: the database and templates only. Not create_app(), which may start
+    the campaign scheduler and send engine in every worker."""
+    global _worker_app
+    from . import database
+    app = Flask(__package__)
+    app.config.update(config)
+    database.configure(app)
+    db.init_app(app)
+    database.init_app(app)
+    _worker_app = app
+
+
+def run_job(job_id):
+    """Render one job; runs in a worker process (or inline when called directly)."""
+    app = _worker_app or current_app._get_current_object()
+    with app.app_context():
+        job = db.session.get(ReportJob, job_id)
+        if job is None:
+            return
+        job.status = 'running'
+        db.session.commit()
+        try:
+            build, _ = REPORTS[job.kind]
+            title, header, rows = build(json.loads(job.params))
+            path = artifact_path(job)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            WRITERS[job.fmt](path + '.tmp', title, header, rows)
+            os.replace(path + '.tmp', path)
+            job.status = 'done'
+        except Exception as exc:
+            db.session.rollback()
+            job = db.session.get(ReportJob, job_id)
+            job.status = 'failed'
+            job.error = str(exc)[:500]
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        try:
+            prune()
+        except Exception:
+            app.logger.exception('Failed to prune old report artifacts')
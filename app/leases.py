@@ -0,0 +1,61 @@
+"""
+Database row leases on PhishingCampaign, so only one app node ever launches a campaign.
+
+A node claims a campaign with a single conditional UPDATE, keeps renewing the lease while it
+has chunks queued (before each chunk, and on a heartbeat while staggered chunks wait), and
+releases it when done. A lease that expires (the node died) can be claimed by
+another node, which resumes with the targets that have no email_sent yet.
+"""
+
+import os
+import socket
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, or_, update
+
+from . import db
+from .models import PhishingCampaign
+
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _expiry():
+    return datetime.utcnow() + timedelta(seconds=current_app.config['SCHEDULER_LEASE_SECONDS'])
+
+
+def claimable():
+    """Campaigns not launched yet, or launched by a node whose lease has expired."""
+    return or_(PhishingCampaign.launched.isnot(True),
+               and_(PhishingCampaign.lease_owner.isnot(None),
+                    PhishingCampaign.lease_expires < datetime.utcnow()))
+
+
+def claim(campaign_id):
+    """Mark the campaign launched and leased to this node; False if another node has it."""
+    result = db.session.execute(
+        update(PhishingCampaign)
+        .where(PhishingCampaign.id == campaign_id, claimable())
+        .values(launched=True, lease_owner=NODE_ID, lease_expires=_expiry())
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def renew(campaign_id):
+    """Extend this node's lease; False if the lease is no longer ours (it expired and was claimed)."""
+    result = db.session.execute(
+        update(PhishingCampaign)
+        .where(PhishingCampaign.id == campaign_id, PhishingCampaign.lease_owner == NODE_ID)
+        .values(lease_expires=_expiry())
+        .execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+
+def release(campaign_id):
+    db.session.execute(
+        update(PhishingCampaign)
+        .where(PhishingCampaign.id == campaign_id, PhishingCampaign.lease_owner == NODE_ID)
+        .values(lease_owner=None, lease_expires=None)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
@@ -0,0 +1,243 @@
+"""
+Background send engine for phishing campaigns.
+Sends through a pool of persistent SMTP connections and stamps email_sent in batches.
+"""
+
+import itertools
+import smtplib
+import threading
+import time
+import queue
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import update
+
+from . import aggregates, db, leases, mail, phishing_templates
+from .models import PhishingTarget, User
+
+
+def tracking_urls(tracking_key):
+    base = current_app.config['PHISHING_BASE_URL'].rstrip('/')
+    return (f"{base}/phishing/phish/pixel/{tracking_key}.gif",
+            f"{base}/phishing/phish/{tracking_key}")
+
+
+def send_phishing_email(connection, compiled, username, tracking_key):
+    """Send one phishing email rendered from a phishing_templates.CompiledTemplate."""
+    pixel_url, landing_url = tracking_urls(tracking_key)
+    connection.send(compiled.render(username, pixel_url, landing_url))
+
+
+class SendEngine:
+    """Queues campaign targets and sends them from MAIL_POOL_SIZE worker threads."""
+
+    def __init__(self, app=None):
+        self.app = None
+        # (not_before, seq, job): staggered chunks wait in the queue until they are due
+        self._jobs = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._progress = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        self._heartbeat_thread = None
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_POOL_SIZE', 4)
+        app.config.setdefault('MAIL_RATE_LIMIT', 5)  # messages per second per connection
+        app.config.setdefault('MAIL_BATCH_SIZE', 200)
+        app.config.setdefault('MAIL_CHUNK_SIZE', 50)
+        app.config.setdefault('MAIL_IDLE_TIMEOUT', 30)
+        app.config.setdefault('PHISHING_BASE_URL', 'http://localhost:5000')
+        app.config.setdefault('SCHEDULER_LEASE_SECONDS', 600)
+        app.extensions['send_engine'] = self
+        self.app = app
+
+    def enqueue(self, campaign, target_ids, window=0):
+        """Queue the given targets of a campaign, spread evenly over `window` seconds."""
+        chunk_size = self.app.config['MAIL_CHUNK_SIZE']
+        with self._lock:
+            counts = self._progress.setdefault(campaign.id, Counter())
+            counts['total'] += len(target_ids)
+        starts = range(0, len(target_ids), chunk_size)
+        now = time.time()
+        for n, i in enumerate(starts):
+            job = (campaign.id, campaign.template_id, target_ids[i:i + chunk_size])
+            self._put(job, now + window * n / len(starts))
+        self._start_workers()
+        return len(target_ids)
+
+    def _put(self, job, not_before=0):
+        self._jobs.put((not_before, next(self._seq), job))
+
+    def progress(self, campaign_id):
+        with self._lock:
+            counts = Counter(self._progress.get(campaign_id, ()))
+        return {
+            'sent': counts['sent'],
+            'failed': counts['failed'],
+            'pending': counts['total'] - counts['sent'] - counts['failed'],
+        }
+
+    def _count(self, campaign_id, key, n=1):
+        with self._lock:
+            self._progress.setdefault(campaign_id, Counter())[key] += n
+
+    def _start_workers(self):
+        with self._lock:
+            self._workers = [t for t in self._workers if t.is_alive()]
+            for _ in range(self.app.config['MAIL_POOL_SIZE'] - len(self._workers)):
+                worker = threading.Thread(target=self._run, name='phishing-sender', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='lease-heartbeat',
+                                                          daemon=True)
+                self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        """Renew the leases of campaigns with targets still queued here, so that the lease does
+        not expire while staggered chunks wait for their turn and another node claims them."""
+        with self.app.app_context():
+            while True:
+                time.sleep(self.app.config['SCHEDULER_LEASE_SECONDS'] / 3)
+                with self._lock:
+                    campaign_ids = [cid for cid, counts in self._progress.items()
+                                    if counts['total'] - counts['sent'] - counts['failed'] > 0]
+                try:
+                    for campaign_id in campaign_ids:
+                        leases.renew(campaign_id)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('Failed to renew campaign leases')
+                finally:
+                    db.session.remove()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                job = self._next_job()
+                try:
+                    # Keep the connection open while there is work, close it when idle.
+                    with mail.connect() as connection:
+                        while job is not None:
+                            current, job = job, None
+                            self._send_chunk(connection, *current)
+                            job = self._next_job(self.app.config['MAIL_IDLE_TIMEOUT'])
+                except Exception as e:
+                    # The chunk requeued what it had not sent; back off and carry on
+                    if isinstance(e, OSError):
+                        current_app.logger.exception('SMTP connection failed, reconnecting')
+                    else:
+                        current_app.logger.exception('Failed to send a campaign chunk, retrying')
+                    db.session.rollback()
+                    if job is not None:
+                        self._put(job)
+                    time.sleep(1)
+                finally:
+                    db.session.remove()
+
+    def _next_job(self, timeout=None):
+        """Next due job, or None if none becomes due within timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                not_before, seq, job = self._jobs.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            delay = not_before - time.time()
+            if delay <= 0:
+                return job
+            self._jobs.put((not_before, seq, job))
+            time.sleep(min(delay, 1.0, remaining or 1.0))
+
+    def _throttle(self):
+        interval = 1.0 / self.app.config['MAIL_RATE_LIMIT']
+        now = time.monotonic()
+        next_send = getattr(self._local, 'next_send', now)
+        if next_send > now:
+            time.sleep(next_send - now)
+        self._local.next_send = max(now, next_send) + interval
+
+    def _send_chunk(self, connection, campaign_id, template_id, target_ids):
+        # The lease may have expired and another node claimed the campaign: its targets are then
+        # that node's to send
+        if not leases.renew(campaign_id):
+            db.session.rollback()
+            current_app.logger.warning('Lost the lease on campaign %s, dropping %d queued targets',
+                                       campaign_id, len(target_ids))
+            self._count(campaign_id, 'total', -len(target_ids))
+            return
+        db.session.commit()
+        rows, stamps, done = None, [], 0
+        try:
+            template = phishing_templates.compiled(template_id)
+            if template is None:
+                current_app.logger.error('Phishing template %s is gone, dropping campaign %s chunk',
+                                         template_id, campaign_id)
+                self._count(campaign_id, 'failed', len(target_ids))
+                return
+            rows = (db.session.query(PhishingTarget.id, PhishingTarget.campaign_id, PhishingTarget.user_id,
+                                     PhishingTarget.tracking_key, User.username)
+                    .join(User, User.id == PhishingTarget.user_id)
+                    .filter(PhishingTarget.id.in_(target_ids), PhishingTarget.email_sent.is_(None))
+                    .all())
+            self._count(campaign_id, 'total', len(rows) - len(target_ids))
+            batch_size = self.app.config['MAIL_BATCH_SIZE']
+            for row in rows:
+                self._throttle()
+                try:
+                    send_phishing_email(connection, template, row.username, row.tracking_key)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                    self._count(campaign_id, 'failed')
+                else:
+                    stamps.append((row, datetime.utcnow()))
+                done += 1
+                if len(stamps) >= batch_size:
+                    self._stamp(campaign_id, stamps)
+                    stamps = []
+            self._stamp(campaign_id, stamps)
+        except Exception:
+            # Connection dropped or database error: requeue what was not sent, and stamp what was
+            # so that it is never sent again
+            remaining = target_ids if rows is None else [row.id for row in rows[done:]]
+            if remaining:
+                self._put((campaign_id, template_id, remaining))
+            self._stamp_after_error(campaign_id, stamps)
+            raise
+        if self.progress(campaign_id)['pending'] <= 0:
+            leases.release(campaign_id)
+
+    def _stamp(self, campaign_id, stamps):
+        if not stamps:
+            return
+        db.session.execute(update(PhishingTarget), [
+            {'id': row.id, 'email_sent': sent_at} for row, sent_at in stamps
+        ])
+        aggregates.record_sent([row for row, _ in stamps])
+        leases.renew(campaign_id)
+        db.session.commit()
+        self._count(campaign_id, 'sent', len(stamps))
+
+    def _stamp_after_error(self, campaign_id, stamps, attempts=3):
+        for attempt in range(attempts):
+            db.session.rollback()
+            try:
+                self._stamp(campaign_id, stamps)
+                return
+            except Exception:
+                time.sleep(attempt + 1)
+        db.session.rollback()
+        current_app.logger.error('Could not stamp %d delivered emails of campaign %s (targets %s)',
+                                 len(stamps), campaign_id, [row.id for row, _ in stamps])
+
+
+send_engine = SendEngine()
@@ -0,0 +1,129 @@
+"""
+Schema migrations.
+
+upgrade() (`flask db-upgrade`) creates the tables missing from the database from the models, then
+applies the pending revisions in order. Revisions make the changes to existing tables that
+create_all() cannot, Alembic style: each has an upgrade function, and the ones a database has
+received are recorded in the schema_revision table. Every upgrade is idempotent, so a new database
+simply runs them all.
+"""
+
+from sqlalchemy import case, delete, func, inspect, select, update
+from sqlalchemy.schema import CreateColumn
+
+from . import aggregates, db, versioning
+from .models import (PhishingTarget, PolicyAcknowledgement, RemediationAssignment, SchemaRevision, User,
+                     UserProgress)
+
+REVISIONS = []  # (id, description, upgrade function), in order
+
+
+def revision(id, description):
+    def register(upgrade):
+        REVISIONS.append((id, description, upgrade))
+        return upgrade
+    return register
+
+
+def applied():
+    SchemaRevision.__table__.create(db.session.connection(), checkfirst=True)
+    return {rid for (rid,) in db.session.query(SchemaRevision.id)}
+
+
+def pending():
+    done = applied()
+    return [(rid, description) for rid, description, _ in REVISIONS if rid not in done]
+
+
+def upgrade():
+    """Create missing tables and apply the pending revisions, each in its own transaction; returns their ids."""
+    done = applied()
+    db.metadata.create_all(db.session.connection())
+    db.session.commit()
+    upgraded = []
+    for rid, description, function in REVISIONS:
+        if rid in done:
+            continue
+        function(db.session.connection())
+        db.session.add(SchemaRevision(id=rid))
+        db.session.commit()
+        upgraded.append(rid)
+    return upgraded
+
+
+def _dedupe(model, *columns, where=True):
+    """Delete all but the oldest row of each group of rows sharing the columns; returns the count."""
+    table = model.__table__
+    keep = select(func.min(table.c.id)).where(where).group_by(*(table.c[name] for name in columns))
+    return db.session.execute(delete(table).where(where, table.c.id.notin_(keep))).rowcount
+
+
+def _add_column(connection, model, name):
+    """Add a model column that the database's table does not have yet."""
+    table = model.__table__
+    if name in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        return
+    spec = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+    connection.exec_driver_sql(
+        f'ALTER TABLE {connection.dialect.identifier_preparer.format_table(table)} ADD COLUMN {spec}')
+
+
+def _create_indexes(connection, *names):
+    """Create the named model indexes that the database does not have yet."""
+    indexes = {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+
+@revision('0001', 'baseline schema')
+def _baseline(connection):
+    db.metadata.create_all(connection)
+
+
+@revision('0002', 'hot-path indexes and uniqueness')
+def _hot_path_indexes(connection):
+    # The unique indexes cannot be built over duplicates: a completion recorded on any duplicate
+    # progress row moves to the kept one, and the other rows go
+    table = UserProgress.__table__
+    completed = func.max(case((table.c.completed.is_(True), 1), else_=0))
+    done = select(func.min(table.c.id)).group_by(table.c.user_id, table.c.module_id).having(completed == 1)
+    db.session.execute(update(table).where(table.c.id.in_(done)).values(completed=True))
+    progress = _dedupe(UserProgress, 'user_id', 'module_id')
+    acks = _dedupe(PolicyAcknowledgement, 'user_id', 'policy_id')
+    targets = _dedupe(PhishingTarget, 'campaign_id', 'user_id')
+    if progress:
+        versioning.bump('progress', connection=connection)
+    if acks:
+        versioning.bump('policy_acks', connection=connection)
+
+    _create_indexes(connection, 'uq_user_progress_user_module', 'uq_phishing_target_campaign_user',
+                    'ix_phishing_target_user', 'uq_policy_ack_user_policy', 'ix_policy_ack_policy',
+                    'ix_remediation_user_completed', 'ix_survey_question_survey',
+                    'ix_survey_response_survey_completed', 'ix_survey_response_user')
+    if targets:
+        aggregates.rebuild()  # the funnel counters still count the deleted targets; commits
+
+
+@revision('0003', 'one open remediation assignment per user')
+def _open_remediation(connection):
+    _dedupe(RemediationAssignment, 'user_id', where=RemediationAssignment.completed.is_(False))
+    # Replaced by a per-rule index in 0005, so no longer declared on the model
+    connection.exec_driver_sql('CREATE UNIQUE INDEX IF NOT EXISTS uq_remediation_open_user '
+                               'ON remediation_assignment (user_id) WHERE completed = false')
+
+
+@revision('0004', 'directory sync stamp on users')
+def _directory_sync(connection):
+    _add_column(connection, User, 'directory_sync')
+
+
+@revision('0005', 'remediation rules')
+def _remediation_rules(connection):
+    _add_column(connection, RemediationAssignment, 'rule')
+    _add_column(connection, RemediationAssignment, 'module_id')
+    # Assignments made before the rules engine came from what are now its default rules
+    table = RemediationAssignment.__table__
+    for rule, reason in (('clicked', 'Clicked phishing link'), ('submitted', 'Submitted data to phishing form')):
+        db.session.execute(update(table).where(table.c.rule == '', table.c.reason == reason).values(rule=rule))
+    connection.exec_driver_sql('DROP INDEX IF EXISTS uq_remediation_open_user')
+    _create_indexes(connection, 'uq_remediation_open_user_rule')
@@ -1,7 +1,12 @@
 """
 SQLAlchemy models for users, roles, licensing, features, modules, and progress.
+
+Indexes follow the routes' lookups. Uniqueness is declared as unique indexes rather than table
+constraints so app.migrations can add it to existing tables, SQLite included.
 """
 
+import uuid
+
 from . import db
 from flask_login import UserMixin
 from datetime import datetime
@@ -12,6 +17,9 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     role = db.Column(db.String(50), nullable=False)  # 'superadmin' or 'admin'
     is_active = db.Column(db.Boolean, default=True)
+    department = db.Column(db.String(100))
+    # Id of the last directory sync that listed the user (app.directory); NULL for local accounts
+    directory_sync = db.Column(db.String(32))
 
 class License(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -30,6 +38,7 @@ class TrainingModule(db.Model):
     content = db.Column(db.Text, nullable=False)
 
 class UserProgress(db.Model):
+    __table_args__ = (db.Index('uq_user_progress_user_module', 'user_id', 'module_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     module_id = db.Column(db.Integer, db.ForeignKey('training_module.id'))
@@ -48,21 +57,19 @@ class PhishingCampaign(db.Model):
     name = db.Column(db.String(150))
     template_id = db.Column(db.Integer, db.ForeignKey('phishing_template.id'))
     scheduled_time = db.Column(db.DateTime)
+    launch_time = db.synonym('scheduled_time')
     launched = db.Column(db.Boolean, default=False)
+    send_window_minutes = db.Column(db.Integer, default=0)  # spread sending over this window
+    # Node currently sending the campaign and until when it holds it (see app.leases)
+    lease_owner = db.Column(db.String(100))
+    lease_expires = db.Column(db.DateTime)
+    closed = db.Column(db.Boolean, default=False)  # no more tracking once closed
 
 class PhishingTarget(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    campaign_id = db.Column(db.Integer, db.ForeignKey('phishing_campaign.id'))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    email_sent = db.Column(db.DateTime)
-    email_opened = db.Column(db.DateTime)
-    link_clicked = db.Column(db.DateTime)
-    data_submitted = db.Column(db.DateTime)
-    reported_phish = db.Column(db.DateTime)
-
-import uuid
-
-class PhishingTarget(db.Model):
+    __table_args__ = (
+        db.Index('uq_phishing_target_campaign_user', 'campaign_id', 'user_id', unique=True),
+        db.Index('ix_phishing_target_user', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey('phishing_campaign.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -73,12 +80,53 @@ class PhishingTarget(db.Model):
     reported_phish = db.Column(db.DateTime)
     tracking_key = db.Column(db.String(64), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
 
+class DataVersion(db.Model):
+    """Change counter per data set, used to key caches (see app.versioning)."""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class CampaignStats(db.Model):
+    """Funnel counters per campaign, maintained by app.aggregates."""
+    campaign_id = db.Column(db.Integer, db.ForeignKey('phishing_campaign.id'), primary_key=True)
+    targeted = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    opened = db.Column(db.Integer, nullable=False, default=0)
+    clicked = db.Column(db.Integer, nullable=False, default=0)
+    submitted = db.Column(db.Integer, nullable=False, default=0)
+    reported = db.Column(db.Integer, nullable=False, default=0)
+
+class UserPhishingStats(db.Model):
+    """Funnel counters per user, maintained by app.aggregates."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    targeted = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    opened = db.Column(db.Integer, nullable=False, default=0)
+    clicked = db.Column(db.Integer, nullable=False, default=0)
+    submitted = db.Column(db.Integer, nullable=False, default=0)
+    reported = db.Column(db.Integer, nullable=False, default=0)
+    offenses = db.Column(db.Integer, nullable=False, default=0)  # targets clicked or submitted
+
 class RemediationAssignment(db.Model):
+    __table_args__ = (
+        db.Index('ix_remediation_user_completed', 'user_id', 'completed'),
+        # At most one open assignment per user and rule (app.remediation inserts against it)
+        db.Index('uq_remediation_open_user_rule', 'user_id', 'rule', unique=True,
+                 sqlite_where=db.text('completed = false'), postgresql_where=db.text('completed = false')),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     reason = db.Column(db.String(255))
     assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed = db.Column(db.Boolean, default=False)
+    rule = db.Column(db.String(50), nullable=False, default='', server_default='')  # remediation rule name
+    module_id = db.Column(db.Integer, db.ForeignKey('training_module.id'))  # training to complete, if any
+
+class RemediationCounter(db.Model):
+    """Tracking events per user, kind and day, counted for the remediation rules (see app.remediation)."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True)  # 'open', 'click', 'submit' or 'report'
+    day = db.Column(db.Date, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 class SecuritySurvey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -86,34 +134,52 @@ class SecuritySurvey(db.Model):
     description = db.Column(db.Text)
 
 class SurveyQuestion(db.Model):
+    __table_args__ = (db.Index('ix_survey_question_survey', 'survey_id'),)
     id = db.Column(db.Integer, primary_key=True)
-    survey_id = db.Column(db.Integer, db.ForeignKey('securitysurvey.id'), nullable=False)
+    survey_id = db.Column(db.Integer, db.ForeignKey('security_survey.id'), nullable=False)
     question = db.Column(db.Text)
     choices = db.Column(db.Text)  # JSON: ["Yes", "No", "Sometimes"]
 
 class SurveyResponse(db.Model):
+    __table_args__ = (
+        db.Index('ix_survey_response_survey_completed', 'survey_id', 'completed_at'),
+        db.Index('ix_survey_response_user', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    survey_id = db.Column(db.Integer, db.ForeignKey('securitysurvey.id'), nullable=False)
+    survey_id = db.Column(db.Integer, db.ForeignKey('security_survey.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     answers = db.Column(db.Text)  # JSON: {"q1": "Yes", "q2": "No"}
     completed_at = db.Column(db.DateTime, default=datetime.utcnow)
-class SecuritySurvey(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(255))
-    description = db.Column(db.Text)
 
-class SurveyQuestion(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    survey_id = db.Column(db.Integer, db.ForeignKey('securitysurvey.id'), nullable=False)
-    question = db.Column(db.Text)
-    choices = db.Column(db.Text)  # JSON: ["Yes", "No", "Sometimes"]
-
-class SurveyResponse(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    survey_id = db.Column(db.Integer, db.ForeignKey('securitysurvey.id'), nullable=False)
+class SurveyChoice(db.Model):
+    """One choice of a survey question; normalized from SurveyQuestion.choices (see app.survey_answers)."""
+    __table_args__ = (db.UniqueConstraint('question_id', 'label'),)
+    id = db.Column(db.Integer, primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('survey_question.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    label = db.Column(db.String(255), nullable=False)
+
+class SurveyResponseItem(db.Model):
+    """One chosen answer of a response; the normalized form of SurveyResponse.answers."""
+    __table_args__ = (
+        db.Index('ix_survey_item_question_choice', 'question_id', 'choice_id', 'response_id'),
+        db.Index('ix_survey_item_survey_user', 'survey_id', 'user_id'),
+    )
+    response_id = db.Column(db.Integer, db.ForeignKey('survey_response.id'), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('survey_question.id'), primary_key=True)
+    choice_id = db.Column(db.Integer, db.ForeignKey('survey_choice.id'), primary_key=True)
+    # Copied from the response so segment queries need no join through it
+    survey_id = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    answers = db.Column(db.Text)  # JSON: {"q1": "Yes", "q2": "No"}
-    completed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SurveyAnswerCount(db.Model):
+    """Answer tally per question and choice, overall and per respondent segment (see app.survey_stats)."""
+    question_id = db.Column(db.Integer, db.ForeignKey('survey_question.id'), primary_key=True)
+    dimension = db.Column(db.String(20), primary_key=True)  # 'all', 'department', 'role' or 'risk'
+    segment = db.Column(db.String(150), primary_key=True, default='')  # '' for 'all'
+    choice = db.Column(db.String(255), primary_key=True)
+    survey_id = db.Column(db.Integer, index=True, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 class SecurityPolicy(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -122,7 +188,34 @@ class SecurityPolicy(db.Model):
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
 
 class PolicyAcknowledgement(db.Model):
+    __table_args__ = (
+        db.Index('uq_policy_ack_user_policy', 'user_id', 'policy_id', unique=True),
+        db.Index('ix_policy_ack_policy', 'policy_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    policy_id = db.Column(db.Integer, db.ForeignKey('securitypolicy.id'), nullable=False)
-    acknowledged_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    policy_id = db.Column(db.Integer, db.ForeignKey('security_policy.id'), nullable=False)
+    acknowledged_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PolicyAckBitmap(db.Model):
+    """Bitmap of the ids of the users who acknowledged a policy (see app.compliance)."""
+    policy_id = db.Column(db.Integer, db.ForeignKey('security_policy.id'), primary_key=True)
+    data = db.Column(db.LargeBinary)  # app.bitmaps.Bitmap bytes; NULL when it has to be rebuilt
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+class ReportJob(db.Model):
+    """Background report request; id is the hash of its parameters and data versions (see app.jobs)."""
+    id = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # 'training', 'policy' or 'phishing'
+    fmt = db.Column(db.String(10), nullable=False)  # 'pdf', 'xlsx' or 'csv'
+    params = db.Column(db.Text)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+
+class SchemaRevision(db.Model):
+    """Schema migration applied to this database (see app.migrations)."""
+    id = db.Column(db.String(50), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
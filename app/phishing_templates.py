@@ -0,0 +1,130 @@
+"""
+Compiled phishing templates.
+
+Subject, HTML and text bodies are compiled once per template version and the MIME skeleton of
+the message is prebuilt as bytes. Rendering a recipient only evaluates the merge fields
+(username, pixel_url, landing_url) and fills the results into the skeleton. Templates are
+compiled in a Jinja sandbox that sees nothing but those fields.
+"""
+
+import base64
+import threading
+import time
+import uuid
+from email.header import Header
+from email.utils import formatdate
+
+from flask import current_app
+from flask_mail import BadHeaderError, sanitize_address
+from jinja2.sandbox import SandboxedEnvironment
+
+from . import db, versioning
+from .models import PhishingTemplate
+
+MERGE_FIELDS = ('username', 'pixel_url', 'landing_url')
+PIXEL_IMG = '<img src="{{ pixel_url }}" width="1" height="1" alt="">'
+CRLF = b'\r\n'
+
+# Any logged-in user can edit templates: not the app's Jinja environment, whose globals hold
+# config, request and url_for, but a sandbox with no globals at all
+_env = SandboxedEnvironment()
+_env.globals.clear()
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _body(text):
+    return base64.encodebytes(text.encode('utf-8')).replace(b'\n', CRLF)
+
+
+def _header(value):
+    if '\r' in value or '\n' in value:
+        raise BadHeaderError(value)
+    return value if value.isascii() else Header(value, 'utf-8').encode()
+
+
+class CompiledTemplate:
+    """One template version, compiled, with its MIME parts ready to be filled in."""
+
+    def __init__(self, template, sender):
+        self.id = template.id
+        self.subject = _env.from_string(template.subject or '')
+        self.html = _env.from_string((template.body_html or '') + PIXEL_IMG)
+        self.text = _env.from_string(template.body_text or '')
+        self.sender = sanitize_address(sender)
+        self.domain = self.sender.rpartition('@')[2].strip('>') or 'localhost'
+        boundary = f'=_{uuid.uuid4().hex}'.encode()
+        self._head = (f'From: {self.sender}\r\n'
+                      'MIME-Version: 1.0\r\n'
+                      f'Content-Type: multipart/alternative; boundary="{boundary.decode()}"\r\n'
+                      '\r\n').encode()
+        part = b'Content-Type: text/%s; charset="utf-8"\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+        self._text_part = b'--' + boundary + CRLF + part % b'plain'
+        self._html_part = b'--' + boundary + CRLF + part % b'html'
+        self._tail = b'--' + boundary + b'--' + CRLF
+
+    def render(self, username, pixel_url, landing_url):
+        """Rendered message for one recipient, ready for Connection.send."""
+        fields = dict(username=username, pixel_url=pixel_url, landing_url=landing_url)
+        subject = self.subject.render(fields)
+        # usernames are the users' email addresses
+        headers = (f'To: {_header(username)}\r\n'
+                   f'Subject: {_header(subject)}\r\n'
+                   f'Date: {formatdate()}\r\n'
+                   f'Message-ID: <{uuid.uuid4().hex}@{self.domain}>\r\n').encode()
+        raw = b''.join((
+            headers, self._head,
+            self._text_part, _body(self.text.render(fields)),
+            self._html_part, _body(self.html.render(fields)),
+            self._tail,
+        ))
+        return RenderedMessage(self.sender, username, subject, raw)
+
+
+class RenderedMessage:
+    """Already serialized message; quacks enough like flask_mail.Message for Connection.send."""
+
+    mail_options = ()
+    rcpt_options = ()
+
+    def __init__(self, sender, recipient, subject, raw):
+        self.sender = sender
+        self.recipients = [recipient]
+        self.send_to = {recipient}
+        self.subject = subject
+        self.date = time.time()
+        self.raw = raw
+
+    def has_bad_headers(self):
+        return False  # checked while rendering
+
+    def as_bytes(self):
+        return self.raw
+
+    def as_string(self):
+        return self.raw.decode('utf-8')
+
+
+def compiled(template_id):
+    """Compiled template for the current version of a PhishingTemplate (None if it is gone)."""
+    key = (template_id, versioning.current('phishing_templates'))
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+    template = db.session.get(PhishingTemplate, template_id)
+    if template is None:
+        return None
+    result = CompiledTemplate(template, current_app.extensions['mail'].default_sender)
+    with _cache_lock:
+        for stale in [k for k in _cache if k[0] == template_id]:
+            del _cache[stale]
+        _cache[key] = result
+    return result
+
+
+def invalidate(template_id=None):
+    """Drop compiled templates of this process; other workers notice the version bump."""
+    with _cache_lock:
+        for key in [k for k in _cache if template_id is None or k[0] == template_id]:
+            del _cache[key]
@@ -0,0 +1,56 @@
+"""
+Query-plan checks for the hot lookups.
+
+Each entry is the main query of a route or background job with representative parameters.
+check() has the live database explain them and reports the ones that scan a table instead of
+searching an index; `flask check-query-plans` runs it and exits non-zero on a regression.
+On PostgreSQL sequential scans are disabled for the check, since on small tables the planner
+prefers them even when an index is usable.
+"""
+
+from sqlalchemy import select
+
+from . import db
+from .models import (PhishingTarget, PolicyAcknowledgement, RemediationAssignment, SurveyQuestion,
+                     SurveyResponse, UserProgress)
+
+HOT_QUERIES = {
+    'training.index': lambda: select(UserProgress.module_id).filter_by(user_id=1, completed=True),
+    'training.view': lambda: select(UserProgress).filter_by(user_id=1, module_id=1),
+    'policy.policy_list': lambda: select(PolicyAcknowledgement.policy_id).filter_by(user_id=1),
+    'policy.policy_view': lambda: select(PolicyAcknowledgement).filter_by(user_id=1, policy_id=1),
+    'compliance.rebuild': lambda: select(PolicyAcknowledgement.user_id).filter_by(policy_id=1).distinct(),
+    'phishing.campaign_results': lambda: select(PhishingTarget).filter_by(campaign_id=1),
+    'phishing.tracking': lambda: select(PhishingTarget.id).filter_by(tracking_key='key'),
+    'risk.scores_for_users': lambda: select(PhishingTarget.id).where(PhishingTarget.user_id.in_([1, 2])),
+    'remediation.open_for_user': lambda: select(RemediationAssignment).filter_by(user_id=1, completed=False),
+    'survey.survey_take': lambda: select(SurveyQuestion).filter_by(survey_id=1),
+    'survey.survey_results': lambda: (select(SurveyResponse).filter_by(survey_id=1)
+                                      .order_by(SurveyResponse.completed_at.desc()).limit(50)),
+}
+
+
+def explain(statement):
+    """The plan of a statement on the session's database, as a list of lines."""
+    connection = db.session.connection()
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    if connection.dialect.name == 'sqlite':
+        return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+    connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    return [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + sql)]
+
+
+def table_scans(plan):
+    """Plan lines that read a whole table (or all of one of its indexes) rather than searching."""
+    # SQLite: "SCAN t", "SCAN t USING COVERING INDEX ix"; PostgreSQL: "Seq Scan on t"
+    return [line for line in plan if line.startswith('SCAN ') or 'Seq Scan' in line]
+
+
+def check():
+    """{query name: (plan lines, table scan lines)} for every hot query."""
+    results = {}
+    for name, build in HOT_QUERIES.items():
+        plan = explain(build())
+        results[name] = (plan, table_scans(plan))
+    db.session.rollback()
+    return results
@@ -0,0 +1,174 @@
+"""
+Remediation rules engine.
+
+Subscribed to the tracking event recorder: every batch of first opens, clicks, submissions or
+reports adds to per-user day counters (RemediationCounter), and the rules that count that kind of
+event are evaluated for the batch's users only, against the rolling window of each rule. Users who
+meet a rule get a RemediationAssignment, all of the batch's in one statement; a user has at most
+one open assignment per rule, and completing the rule's training module closes it.
+
+Rules come from REMEDIATION_RULES, a list of dicts such as
+
+    {'name': 'repeat-clicker', 'events': ['click'], 'count': 2, 'days': 90, 'module_id': 3,
+     'reason': 'Clicked two phishing links within 90 days'}
+
+meaning "at least 2 clicks in the last 90 days: assign training module 3". replay() (`flask
+replay-remediation`) rebuilds the counters from the phishing history and assigns what the rules
+call for without a later assignment already covering it, e.g. after the rules change.
+"""
+
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, insert, select, update
+
+from . import db, upserts
+from .models import PhishingTarget, RemediationAssignment, RemediationCounter
+from .tracking import COLUMNS
+
+Rule = namedtuple('Rule', 'name events count days module_id reason')
+
+# What remediation did before it had rules: one assignment for any click, one for any submission
+DEFAULT_RULES = [
+    {'name': 'clicked', 'events': ['click'], 'count': 1, 'days': 1, 'reason': 'Clicked phishing link'},
+    {'name': 'submitted', 'events': ['submit'], 'count': 1, 'days': 1, 'reason': 'Submitted data to phishing form'},
+]
+# Condition of the unique index that allows one open assignment per user and rule
+OPEN_REMEDIATION = db.text('completed = false')
+CHUNK_SIZE = 1000
+
+
+def parse_rules(specs):
+    """Rules from their dict form; raises ValueError on an invalid one."""
+    rules = []
+    for spec in specs:
+        events = tuple(spec.get('events') or ())
+        rule = Rule(spec.get('name'), events, int(spec.get('count', 1)), int(spec.get('days', 1)),
+                    spec.get('module_id'), spec.get('reason'))
+        if not rule.name or len(rule.name) > 50 or rule.name in {r.name for r in rules}:
+            raise ValueError(f"Remediation rule needs a unique name of up to 50 characters: {spec!r}")
+        if not events or not set(events) <= set(COLUMNS):
+            raise ValueError(f"Remediation rule {rule.name!r}: events must be among {', '.join(COLUMNS)}")
+        if rule.count < 1 or rule.days < 1:
+            raise ValueError(f"Remediation rule {rule.name!r}: count and days must be at least 1")
+        if not rule.reason:
+            rule = rule._replace(reason=f"{rule.count} x {'/'.join(events)} within {rule.days} days")
+        rules.append(rule)
+    return rules
+
+
+class RemediationEngine:
+    """Evaluates the remediation rules on tracking events and assigns remediation in batches."""
+
+    def __init__(self, app=None):
+        self.rules = parse_rules(DEFAULT_RULES)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REMEDIATION_RULES', None)
+        app.extensions['remediation'] = self
+        self.rules = parse_rules(app.config['REMEDIATION_RULES'] or DEFAULT_RULES)
+
+    @property
+    def kinds(self):
+        """Event kinds counted by at least one rule."""
+        return {kind for rule in self.rules for kind in rule.events}
+
+    def handle(self, kind, rows):
+        """Recorder subscriber: count the newly stamped targets and assign what the rules call for."""
+        if kind not in self.kinds:
+            return 0
+        today = datetime.utcnow().date()
+        per_user = Counter(row.user_id for row in rows)
+        upserts.upsert_many(RemediationCounter,
+                            [{'user_id': uid, 'kind': kind, 'day': today, 'count': n} for uid, n in per_user.items()],
+                            key=['user_id', 'kind', 'day'], increment=['count'])
+        rules = [rule for rule in self.rules if kind in rule.events]
+        met = self._met(rules, list(per_user), today)
+        return self.assign([(uid, rule) for rule in rules for uid in met[rule.name]])
+
+    def _totals(self, rules, user_ids, today):
+        """{(user_id, rule name): (events in the rule's window, last day with one)}."""
+        totals = {}
+        for days in {rule.days for rule in rules}:
+            kinds = {kind for rule in rules if rule.days == days for kind in rule.events}
+            rows = (db.session.query(RemediationCounter.user_id, RemediationCounter.kind,
+                                     func.sum(RemediationCounter.count), func.max(RemediationCounter.day))
+                    .filter(RemediationCounter.user_id.in_(user_ids), RemediationCounter.kind.in_(kinds),
+                            RemediationCounter.day >= today - timedelta(days=days - 1))
+                    .group_by(RemediationCounter.user_id, RemediationCounter.kind))
+            for uid, event, count, last in rows:
+                for rule in rules:
+                    if rule.days == days and event in rule.events:
+                        total, latest = totals.get((uid, rule.name), (0, last))
+                        totals[uid, rule.name] = (total + count, max(latest, last))
+        return totals
+
+    def _met(self, rules, user_ids, today):
+        """{rule name: [user ids]} of the users meeting each rule."""
+        totals = self._totals(rules, user_ids, today)
+        return {rule.name: [uid for uid in user_ids if totals.get((uid, rule.name), (0,))[0] >= rule.count]
+                for rule in rules}
+
+    def assign(self, assignments):
+        """Assign (user_id, rule) pairs in one statement, skipping users with the rule already open."""
+        if not assignments:
+            return 0
+        return upserts.upsert_many(RemediationAssignment, [
+            {'user_id': uid, 'rule': rule.name, 'module_id': rule.module_id, 'reason': rule.reason,
+             'completed': False} for uid, rule in assignments
+        ], key=['user_id', 'rule'], where=OPEN_REMEDIATION)
+
+    def complete_module(self, user_id, module_id):
+        """Close the user's open assignments of a training module."""
+        db.session.execute(update(RemediationAssignment)
+                           .where(RemediationAssignment.user_id == user_id,
+                                  RemediationAssignment.module_id == module_id,
+                                  RemediationAssignment.completed.is_(False))
+                           .values(completed=True).execution_options(synchronize_session=False))
+
+    def replay(self, chunk_size=CHUNK_SIZE):
+        """Rebuild the counters from PhishingTarget and assign what the rules call for; commits.
+
+        A user meeting a rule is only assigned if no assignment of the rule was made on or after
+        the last day counted towards it, so remediation already done is not handed out again.
+        Returns a Counter with the counter rows written and the assignments made.
+        """
+        report = Counter()
+        today = datetime.utcnow().date()
+        since = today - timedelta(days=max(rule.days for rule in self.rules) - 1)
+        db.session.execute(RemediationCounter.__table__.delete())
+        for kind in sorted(self.kinds):
+            column = getattr(PhishingTarget, COLUMNS[kind])
+            day = func.date(column)
+            counts = (select(PhishingTarget.user_id, db.literal(kind), day, func.count())
+                      .where(column >= datetime.combine(since, datetime.min.time()))
+                      .group_by(PhishingTarget.user_id, day))
+            report['counters'] += db.session.execute(insert(RemediationCounter).from_select(
+                ['user_id', 'kind', 'day', 'count'], counts)).rowcount
+        db.session.commit()
+
+        last_id = 0
+        while True:
+            user_ids = [uid for (uid,) in db.session.query(RemediationCounter.user_id).distinct()
+                        .filter(RemediationCounter.user_id > last_id)
+                        .order_by(RemediationCounter.user_id).limit(chunk_size)]
+            if not user_ids:
+                return report
+            last_id = user_ids[-1]
+            totals = self._totals(self.rules, user_ids, today)
+            latest = (db.session.query(RemediationAssignment.user_id, RemediationAssignment.rule,
+                                       func.max(RemediationAssignment.assigned_at))
+                      .filter(RemediationAssignment.user_id.in_(user_ids))
+                      .group_by(RemediationAssignment.user_id, RemediationAssignment.rule))
+            assigned = {(uid, rule): when.date() for uid, rule, when in latest if when}
+            due = [(uid, rule) for rule in self.rules for uid in user_ids
+                   if totals.get((uid, rule.name), (0,))[0] >= rule.count
+                   and assigned.get((uid, rule.name), date.min) < totals[uid, rule.name][1]]
+            written = self.assign(due)
+            report['assigned'] += len(due) if written < 0 else written
+            db.session.commit()
+
+
+remediation_engine = RemediationEngine()
@@ -0,0 +1,101 @@
+"""
+Training completion report computed with grouped SQL.
+Results are cached per filter/page and keyed on the progress, module and user version counters.
+"""
+
+import threading
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import and_, func, true
+
+from . import db, versioning
+from .models import TrainingModule, User, UserProgress
+
+UserRow = namedtuple('UserRow', 'id username department role completed percent')
+ModuleRow = namedtuple('ModuleRow', 'id title completed percent')
+Report = namedtuple('Report', 'users modules total_users total_modules page per_page')
+
+CACHE_SIZE = 128
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _user_filter(department=None, role=None, user_id=None):
+    criteria = []
+    if department:
+        criteria.append(User.department == department)
+    if role:
+        criteria.append(User.role == role)
+    if user_id:
+        criteria.append(User.id == user_id)
+    return and_(true(), *criteria)
+
+
+def _module_filter(module_id=None):
+    return TrainingModule.id == module_id if module_id else true()
+
+
+def _percent(done, total):
+    return round(done / total * 100, 1) if total else 0
+
+
+def _build(page, per_page, department, role, user_id, module_id):
+    users = _user_filter(department, role, user_id)
+    modules = _module_filter(module_id)
+    total_users = db.session.query(func.count(User.id)).filter(users).scalar()
+    total_modules = db.session.query(func.count(TrainingModule.id)).filter(modules).scalar()
+
+    module_ids = db.session.query(TrainingModule.id).filter(modules)
+    user_ids = db.session.query(User.id).filter(users)
+
+    # Completed modules per user, for one page of users
+    completed = func.count(func.distinct(UserProgress.module_id))
+    user_rows = (db.session.query(User.id, User.username, User.department, User.role, completed)
+                 .outerjoin(UserProgress, and_(UserProgress.user_id == User.id,
+                                               UserProgress.completed.is_(True),
+                                               UserProgress.module_id.in_(module_ids)))
+                 .filter(users)
+                 .group_by(User.id)
+                 .order_by(User.username)
+                 .limit(per_page).offset((page - 1) * per_page))
+
+    # Completing users per module, across every filtered user
+    completed = func.count(func.distinct(UserProgress.user_id))
+    module_rows = (db.session.query(TrainingModule.id, TrainingModule.title, completed)
+                   .outerjoin(UserProgress, and_(UserProgress.module_id == TrainingModule.id,
+                                                 UserProgress.completed.is_(True),
+                                                 UserProgress.user_id.in_(user_ids)))
+                   .filter(modules)
+                   .group_by(TrainingModule.id)
+                   .order_by(TrainingModule.title))
+
+    return Report(
+        users=[UserRow(*row, _percent(row[-1], total_modules)) for row in user_rows],
+        modules=[ModuleRow(*row, _percent(row[-1], total_users)) for row in module_rows],
+        total_users=total_users,
+        total_modules=total_modules,
+        page=page,
+        per_page=per_page,
+    )
+
+
+def training_report(page=1, per_page=100, department=None, role=None, user_id=None, module_id=None):
+    """Completion percentages for one page of users and for every (filtered) module."""
+    args = (page, per_page, department, role, user_id, module_id)
+    key = (args, versioning.current('progress', 'modules', 'users'))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    report = _build(*args)
+    with _cache_lock:
+        _cache[key] = report
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return report
+
+
+def departments():
+    return [d for (d,) in db.session.query(User.department).filter(User.department.isnot(None))
+            .distinct().order_by(User.department)]
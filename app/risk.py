@@ -0,0 +1,140 @@
+"""
+User phishing risk scores, computed in SQL and cached until the phishing data changes.
+
+Cached scores are keyed on the 'phishing' and 'users' data versions (app.versioning), read before
+the scores are computed, so every worker drops them as soon as new events commit.
+
+Each opened/clicked/submitted/reported target adds its weight from RISK_WEIGHTS. With
+RISK_DECAY_HALF_LIFE_DAYS set, a campaign's contribution halves for every half-life of age.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import case, func, literal
+
+from . import db, versioning
+from .models import PhishingCampaign, PhishingTarget, User, UserPhishingStats
+
+DEFAULT_WEIGHTS = {'opened': 1, 'clicked': 3, 'submitted': 5, 'reported': -4}
+DEFAULT_THRESHOLDS = [(8, 'High'), (4, 'Medium')]
+DECAY_BANDS = 8  # older campaigns keep the weight of the last band
+MAX_PER_PAGE = 200
+CACHE_SIZE = 256  # cached score sets per process; the oldest go first
+
+TARGET_COLUMNS = {
+    'opened': PhishingTarget.email_opened,
+    'clicked': PhishingTarget.link_clicked,
+    'submitted': PhishingTarget.data_submitted,
+    'reported': PhishingTarget.reported_phish,
+}
+
+RankedUser = namedtuple('RankedUser', 'id username score')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _config():
+    config = current_app.config
+    weights = dict(DEFAULT_WEIGHTS, **config.get('RISK_WEIGHTS', {}))
+    return weights, config.get('RISK_DECAY_HALF_LIFE_DAYS'), config.get('RISK_CACHE_TTL', 60)
+
+
+def risk_level(score):
+    for threshold, level in current_app.config.get('RISK_THRESHOLDS', DEFAULT_THRESHOLDS):
+        if score >= threshold:
+            return level
+    return "Low"
+
+
+def settings_key():
+    """What scores depend on besides the phishing data: the settings, and the time when they decay."""
+    weights, half_life, ttl = _config()
+    thresholds = tuple(map(tuple, current_app.config.get('RISK_THRESHOLDS', DEFAULT_THRESHOLDS)))
+    return tuple(sorted(weights.items())), thresholds, half_life, int(time.time() // max(ttl, 1)) if half_life else None
+
+
+def invalidate(*_):
+    """Drop the cached scores of this process; also registered as an event recorder subscriber."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def _cached(key, compute):
+    weights, half_life, ttl = _config()
+    version = versioning.current('phishing', 'users')
+    key = (key, tuple(sorted(weights.items())), half_life, version)
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+    value = compute(weights, half_life)
+    with _cache_lock:
+        for stale in [k for k in _cache if k[-1] != version]:
+            del _cache[stale]
+        while len(_cache) >= CACHE_SIZE:
+            del _cache[next(iter(_cache))]
+        _cache[key] = (now + ttl, value)
+    return value
+
+
+def _score_query(weights, half_life):
+    """(user_id, score) rows; the caller adds filters, ordering and limits."""
+    if not half_life:
+        # No decay: a weighted sum of the maintained per-user counters
+        score = sum(getattr(UserPhishingStats, name) * weight for name, weight in weights.items())
+        return db.session.query(UserPhishingStats.user_id.label('user_id'), score.label('score'))
+
+    per_target = sum(case((column.isnot(None), weights[name]), else_=0)
+                     for name, column in TARGET_COLUMNS.items())
+    now = datetime.utcnow()
+    bands = [(PhishingCampaign.scheduled_time >= now - timedelta(days=half_life * (i + 1)), 0.5 ** i)
+             for i in range(DECAY_BANDS)]
+    decay = case((PhishingCampaign.scheduled_time.is_(None), literal(1.0)), *bands,
+                 else_=0.5 ** DECAY_BANDS)
+    score = func.sum(per_target * decay)
+    return (db.session.query(PhishingTarget.user_id.label('user_id'), score.label('score'))
+            .join(PhishingCampaign, PhishingCampaign.id == PhishingTarget.campaign_id)
+            .group_by(PhishingTarget.user_id))
+
+
+def scores_for_campaign(campaign_id):
+    """{user_id: score} for every user targeted by the campaign."""
+    def compute(weights, half_life):
+        query = _score_query(weights, half_life).subquery()
+        targeted = db.session.query(PhishingTarget.user_id).filter_by(campaign_id=campaign_id)
+        rows = db.session.query(query.c.user_id, query.c.score).filter(query.c.user_id.in_(targeted))
+        return {uid: round(score or 0, 2) for uid, score in rows}
+
+    return _cached(('campaign', campaign_id), compute)
+
+
+def scores_for_users(user_ids):
+    """{user_id: score} for the given users (uncached); users never targeted are left out."""
+    weights, half_life, _ = _config()
+    query = _score_query(weights, half_life).subquery()
+    rows = db.session.query(query.c.user_id, query.c.score).filter(query.c.user_id.in_(user_ids))
+    return {uid: round(score or 0, 2) for uid, score in rows}
+
+
+def top_users(page=1, per_page=50):
+    """One page of the riskiest users as ([RankedUser], number of users with a score).
+
+    page is at least 1 and per_page between 1 and MAX_PER_PAGE; other values are clamped.
+    """
+    page, per_page = max(page, 1), min(max(per_page, 1), MAX_PER_PAGE)
+    def compute(weights, half_life):
+        query = _score_query(weights, half_life).subquery()
+        total = db.session.query(func.count()).select_from(query).scalar()
+        rows = (db.session.query(User.id, User.username, query.c.score)
+                .join(query, query.c.user_id == User.id)
+                .order_by(query.c.score.desc(), User.id)
+                .limit(per_page).offset((page - 1) * per_page))
+        return [RankedUser(uid, username, round(score or 0, 2)) for uid, username, score in rows], total
+
+    return _cached(('top', page, per_page), compute)
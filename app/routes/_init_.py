@@ -1 +1,25 @@
-# Makes routes a package
\ No newline at end of file
+"""
+Route blueprints.
+
+BLUEPRINTS is the manifest create_app() registers from: modules of this package, each exposing a
+Blueprint as `bp`. A module is only imported when its blueprint is registered, and none of them
+touches the database at import. The BLUEPRINTS setting narrows the list down, e.g. to
+"auth,phishing" for workers that only serve tracking hits; auth, which loads the logged-in user,
+is always registered.
+"""
+
+from importlib import import_module
+
+BLUEPRINTS = ('auth', 'admin', 'superadmin', 'training', 'phishing', 'survey', 'policy', 'password')
+
+
+def register_blueprints(app):
+    """Register the blueprints of app.config['BLUEPRINTS'] (default: all); returns their names."""
+    names = app.config.get('BLUEPRINTS') or BLUEPRINTS
+    unknown = set(names) - set(BLUEPRINTS)
+    if unknown:
+        raise ValueError(f"Unknown blueprints: {', '.join(sorted(unknown))} (known: {', '.join(BLUEPRINTS)})")
+    names = ['auth'] + [name for name in BLUEPRINTS if name in names and name != 'auth']
+    for name in names:
+        app.register_blueprint(import_module(f'{__package__}.{name}').bp)
+    return names
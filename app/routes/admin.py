@@ -1,46 +1,112 @@
+"""
+Admin dashboard and reporting routes.
+"""
+
+import os
+from flask import Blueprint, render_template, request, jsonify, url_for, send_file, abort
+from flask_login import login_required, current_user
+from app import db, jobs, reports
+from app.fragments import conditional, fragment_cache
+from app.models import ReportJob
+
+bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+@bp.route('/dashboard')
+@login_required
+@conditional
+def dashboard():
+    if current_user.role not in ['admin', 'superadmin']:
+        return "Access denied", 403
+    # Completion per module, cached until progress, modules or users change (app.fragments)
+    completion = fragment_cache.fragment('admin.completion', ('progress', 'modules', 'users'), _completion)
+    return render_template('admin/dashboard.html', completion=completion)
+
+def _completion():
+    result = reports.training_report(per_page=1)
+    return render_template('admin/dashboard_completion.html', modules=result.modules,
+                           total_users=result.total_users, total_modules=result.total_modules)
+
 @bp.route('/report')
 @login_required
 def report():
     if current_user.role not in ['admin', 'superadmin']:
         return "Access denied", 403
-    user_id = request.args.get('user_id', type=int)
-    module_id = request.args.get('module_id', type=int)
-
-    users = User.query.all()
-    modules = TrainingModule.query.all()
-    progress = UserProgress.query.all()
-    progress_dict = {(p.user_id, p.module_id): p.completed for p in progress}
-
-    filtered_users = [u for u in users if (not user_id) or (u.id == user_id)]
-    filtered_modules = [m for m in modules if (not module_id) or (m.id == module_id)]
-
-    # Calculate completion percentages
-    user_completion = {}
-    for user in filtered_users:
-        total = len(filtered_modules)
-        completed = sum(1 for m in filtered_modules if progress_dict.get((user.id, m.id), False))
-        percent = (completed / total * 100) if total else 0
-        user_completion[user.id] = percent
-
-    module_completion = {}
-    for module in filtered_modules:
-        total = len(filtered_users)
-        completed = sum(1 for u in filtered_users if progress_dict.get((u.id, module.id), False))
-        percent = (completed / total * 100) if total else 0
-        module_completion[module.id] = percent
-
-    # After computing user_completion and module_completion
-	user_labels = [user.username for user in filtered_users]
-	user_data = [user_completion[user.id] for user in filtered_users]
-	module_labels = [module.title for module in filtered_modules]
-	module_data = [module_completion[module.id] for module in filtered_modules]
+    filters = dict(
+        department=request.args.get('department') or None,
+        role=request.args.get('role') or None,
+        user_id=request.args.get('user_id', type=int),
+        module_id=request.args.get('module_id', type=int),
+    )
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 100, type=int)
+
+    # Completion percentages are computed in SQL and cached until progress changes
+    result = reports.training_report(page, per_page, **filters)
+
+    user_labels = [row.username for row in result.users]
+    user_data = [row.percent for row in result.users]
+    module_labels = [row.title for row in result.modules]
+    module_data = [row.percent for row in result.modules]
 
     return render_template(
        'admin/report.html',
-       # ...other context...
+       report=result,
+       filters=filters,
+       departments=reports.departments(),
        user_labels=user_labels,
        user_data=user_data,
        module_labels=module_labels,
        module_data=module_data
-)
-   
\ No newline at end of file
+    )
+
+# --- Background report jobs ---
+
+@bp.route('/reports/<kind>', methods=['POST'])
+@login_required
+def report_job_submit(kind):
+    if current_user.role not in ['admin', 'superadmin']:
+        return "Access denied", 403
+    fmt = request.form.get('format', 'pdf')
+    if kind not in jobs.REPORTS or fmt not in jobs.FORMATS:
+        abort(404)
+    if kind == 'phishing':
+        params = {'campaign_ids': sorted(request.form.getlist('campaign_id', type=int))}
+    else:
+        params = {'department': request.form.get('department') or None,
+                  'role': request.form.get('role') or None}
+    job = jobs.submit(kind, fmt, params)
+    return jsonify(_job_status(job)), 202
+
+@bp.route('/reports/jobs/<job_id>')
+@login_required
+def report_job_status(job_id):
+    if current_user.role not in ['admin', 'superadmin']:
+        return "Access denied", 403
+    job = db.session.get(ReportJob, job_id) or abort(404)
+    return jsonify(_job_status(job))
+
+@bp.route('/reports/jobs/<job_id>/download')
+@login_required
+def report_job_download(job_id):
+    if current_user.role not in ['admin', 'superadmin']:
+        return "Access denied", 403
+    job = db.session.get(ReportJob, job_id) or abort(404)
+    path = jobs.artifact_path(job)
+    if job.status != 'done' or not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype=jobs.FORMATS[job.fmt], as_attachment=True,
+                     download_name=f"{job.kind}_report.{job.fmt}")
+
+def _job_status(job):
+    status = {
+        'id': job.id,
+        'kind': job.kind,
+        'format': job.fmt,
+        'status': job.status,
+        'status_url': url_for('admin.report_job_status', job_id=job.id),
+    }
+    if job.status == 'done':
+        status['download_url'] = url_for('admin.report_job_download', job_id=job.id)
+    if job.error:
+        status['error'] = job.error
+    return status
\ No newline at end of file
@@ -7,12 +7,14 @@ from flask_login import login_user, logout_user, login_required
 from werkzeug.security import generate_password_hash, check_password_hash
 from app.models import User
 from app import db, login_manager
+from app.user_cache import user_cache
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Served from the process-wide user cache; ORM updates to a user invalidate it
+    return user_cache.get(int(user_id))
 
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -9,10 +9,6 @@ bp = Blueprint('password', __name__, url_prefix='/password')
 def best_practices():
     return render_template('password/best_practices.html')
 
-@bp.route('/check', methods=['GET', 'POST'])
-@login_required
-def password_check():
-
 @bp.route('/check', methods=['GET', 'POST'])
 @login_required
 def password_check():
@@ -1,10 +1,13 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort, Response, stream_with_context
 from flask_login import login_required, current_user
 from app.models import PhishingTemplate, PhishingCampaign, PhishingTarget, User
-from app import db
-from flask import send_file
-import io
-from datetime import datetime
+from app import db, aggregates, export, phishing_templates, risk, targeting
+from app.fragments import conditional, fragment_cache
+from app.mailer import send_engine
+from app.tracking import event_recorder
+from app.tracking_index import tracking_index
+from app.scheduler import campaign_scheduler, launch_campaign
+from datetime import datetime, timedelta, timezone
 
 
 bp = Blueprint('phishing', __name__, url_prefix='/phishing')
@@ -21,6 +24,7 @@ def templates_edit(template_id):
         template.body_html = request.form['body_html']
         template.body_text = request.form['body_text']
         db.session.commit()
+        phishing_templates.invalidate(template_id)
         flash('Template updated.')
         return redirect(url_for('phishing.templates_list'))
     return render_template('phishing/templates_edit.html', template=template)
@@ -51,36 +55,62 @@ def campaigns_add():
         name = request.form['name']
         template_id = int(request.form['template_id'])
         selected_user_ids = request.form.getlist('user_ids')
-        launch_time = datetime.strptime(request.form['launch_time'], "%Y-%m-%dT%H:%M")
-        campaign = PhishingCampaign(name=name, template_id=template_id, launch_time=launch_time)
+        launch_time = _form_time_utc(request.form['launch_time'], request.form.get('tz_offset', type=int))
+        send_window = request.form.get('send_window_minutes', 0, type=int)
+        campaign = PhishingCampaign(name=name, template_id=template_id, launch_time=launch_time,
+                                    send_window_minutes=send_window)
         db.session.add(campaign)
         db.session.commit()
-        for user_id in selected_user_ids:
-            target = PhishingTarget(campaign_id=campaign.id, user_id=int(user_id))
-            db.session.add(target)
-        db.session.commit()
-        flash('Phishing campaign created.')
+        # Explicit user ids, or a selector: role, department, or every active user
+        if selected_user_ids:
+            added = targeting.add_targets(campaign.id, user_ids=selected_user_ids)
+        else:
+            added = targeting.add_targets(campaign.id,
+                                          role=request.form.get('target_role') or None,
+                                          department=request.form.get('target_department') or None,
+                                          all_active=bool(request.form.get('target_all_active')))
+        campaign_scheduler.schedule(campaign.id, campaign.scheduled_time)
+        flash(f'Phishing campaign created with {added} targets.')
         return redirect(url_for('phishing.campaigns_list'))
     return render_template('phishing/campaigns_add.html', templates=templates, users=users)
 
+def _form_time_utc(value, offset_minutes=None):
+    """A datetime-local form value as naive UTC, the way scheduled times are stored and compared.
+
+    offset_minutes is the browser's Date.getTimezoneOffset(); without it the value is taken to be
+    in the server's local time.
+    """
+    local = datetime.strptime(value, "%Y-%m-%dT%H:%M")
+    if offset_minutes is not None:
+        return local + timedelta(minutes=offset_minutes)
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
 @bp.route('/campaigns/<int:campaign_id>/launch', methods=['POST'])
 @login_required
 def campaign_launch(campaign_id):
     campaign = PhishingCampaign.query.get_or_404(campaign_id)
-    targets = PhishingTarget.query.filter_by(campaign_id=campaign_id).all()
-    template = PhishingTemplate.query.get(campaign.template_id)
-    for target in targets:
-        if not target.tracking_key:
-            # generate if not present (if using migration)
-            import uuid
-            target.tracking_key = str(uuid.uuid4())
-        send_phishing_email(target, template)
-        target.email_sent = datetime.utcnow()
-    campaign.launched = True
+    if not launch_campaign(campaign):
+        flash('Phishing campaign is already launched.')
+        return redirect(url_for('phishing.campaigns_list'))
+    flash(f'Phishing campaign launched, {send_engine.progress(campaign_id)["pending"]} emails queued.')
+    return redirect(url_for('phishing.campaigns_list'))
+
+@bp.route('/campaigns/<int:campaign_id>/close', methods=['POST'])
+@login_required
+def campaign_close(campaign_id):
+    campaign = PhishingCampaign.query.get_or_404(campaign_id)
+    campaign.closed = True
     db.session.commit()
-    flash('Phishing campaign launched and emails sent.')
+    tracking_index.evict_campaign(campaign_id)
+    flash('Phishing campaign closed; further opens and clicks are ignored.')
     return redirect(url_for('phishing.campaigns_list'))
 
+@bp.route('/campaigns/<int:campaign_id>/progress')
+@login_required
+def campaign_progress(campaign_id):
+    PhishingCampaign.query.get_or_404(campaign_id)
+    return jsonify(send_engine.progress(campaign_id))
+
 # --- Campaign Results ---
 
 @bp.route('/campaigns/<int:campaign_id>/results')
@@ -89,183 +119,97 @@ def campaign_results(campaign_id):
     campaign = PhishingCampaign.query.get_or_404(campaign_id)
     targets = PhishingTarget.query.filter_by(campaign_id=campaign_id).all()
     users = {u.id: u for u in User.query.all()}
-    return render_template('phishing/campaigns_results.html', campaign=campaign, targets=targets, users=users)
-
-# Assuming you have all PhishingTarget entries for all campaigns
+    return render_template('phishing/campaigns_results.html', campaign=campaign, targets=targets, users=users,
+                           repeat_offenders=aggregates.repeat_offenders(users),
+                           user_risk=risk.scores_for_campaign(campaign_id), risk_level=risk.risk_level)
 
-from collections import Counter
+# --- Tracking ---
+# Keys are resolved through the in-memory tracking index, so repeat hits and unknown keys never
+# reach the database. First hits are queued on the event recorder and written in batches.
 
-all_targets = PhishingTarget.query.all()
-offender_counts = Counter()
-
-for t in all_targets:
-    if t.link_clicked or t.data_submitted:
-        offender_counts[t.user_id] += 1
-
-REPEAT_THRESHOLD = 2  # Set your threshold for "repeat"
-repeat_offenders = {user_id for user_id, count in offender_counts.items() if count >= REPEAT_THRESHOLD}
-
-# You would then continue with endpoints for sending emails, tracking, and a landing page.
-
-@bp.route('/phish/<key>', methods=['GET', 'POST'])
-def landing(key):
-    target = PhishingTarget.query.filter_by(tracking_key=key).first_or_404()
-    # Log the click if not already logged
-    if not target.link_clicked:
-        target.link_clicked = datetime.utcnow()
-        db.session.commit()
-    # Render a generic "login" page or data entry form (for realism)
-    if request.method == 'POST':
-        target.data_submitted = datetime.utcnow()
-        db.session.commit()
-        return render_template('phishing/thank_you.html')
-    return render_template('phishing/landing.html', target=target)
-
-@bp.route('/phish/pixel/<key>.gif')
-def pixel(key):
-    target = PhishingTarget.query.filter_by(tracking_key=key).first()
-    if target and not target.email_opened:
-        target.email_opened = datetime.utcnow()
-        db.session.commit()
-    # 1x1 transparent GIF
-    gif_bytes = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xFF\xFF\xFF!\xF9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
-    return send_file(io.BytesIO(gif_bytes), mimetype='image/gif')
+# 1x1 transparent GIF
+PIXEL_GIF = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xFF\xFF\xFF!\xF9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+REPORT_THANKS = "Thank you for reporting this email as phishing. You made the right choice!"
+SUBMIT_THANKS = "Thank you for your response."
 
 @bp.route('/phish/<key>', methods=['GET', 'POST'])
 def landing(key):
-    target = PhishingTarget.query.filter_by(tracking_key=key).first_or_404()
-    from datetime import datetime
-    # Log click
-    if not target.link_clicked:
-        target.link_clicked = datetime.utcnow()
-        db.session.commit()
+    if tracking_index.resolve(key, confirm=True) is None:
+        abort(404)
+    # Log click (only the first one is kept)
+    if tracking_index.first_hit(key, 'click'):
+        event_recorder.record('click', key)
     # Handle "Report as Phish"
     if request.method == 'POST' and request.form.get('report_phish') == 'yes':
-        target.reported_phish = datetime.utcnow()
-        db.session.commit()
-        return render_template('phishing/thank_you.html', message="Thank you for reporting this email as phishing. You made the right choice!")
+        if tracking_index.first_hit(key, 'report'):
+            event_recorder.record('report', key)
+        return render_template('phishing/thank_you.html', message=REPORT_THANKS)
     # Handle fake form submission
     if request.method == 'POST':
-        target.data_submitted = datetime.utcnow()
-        db.session.commit()
-        return render_template('phishing/thank_you.html', message="Thank you for your response.")
-    return render_template('phishing/landing.html', target=target)
+        if tracking_index.first_hit(key, 'submit'):
+            event_recorder.record('submit', key)
+        return render_template('phishing/thank_you.html', message=SUBMIT_THANKS)
+    return render_template('phishing/landing.html')
 
-def assign_remediation(user_id, reason):
-    already_assigned = RemediationAssignment.query.filter_by(user_id=user_id, completed=False).first()
-    if not already_assigned:
-        remediation = RemediationAssignment(user_id=user_id, reason=reason)
-        db.session.add(remediation)
-        db.session.commit()
-
-# In your click or submit handling logic:
-if not target.link_clicked:
-    target.link_clicked = datetime.utcnow()
-    assign_remediation(target.user_id, "Clicked phishing link")
-    db.session.commit()
-if request.method == 'POST' and not target.data_submitted:
-    target.data_submitted = datetime.utcnow()
-    assign_remediation(target.user_id, "Submitted data to phishing form")
-    db.session.commit()
-
-user_risk = {}
-for user in users.values():
-    targets = [t for t in all_targets if t.user_id == user.id]
-    score = 0
-    for t in targets:
-        if t.email_opened: score += 1
-        if t.link_clicked: score += 3
-        if t.data_submitted: score += 5
-        if t.reported_phish: score -= 4
-    user_risk[user.id] = score
-
-# Optionally, define risk levels:
-def risk_level(score):
-    if score >= 8:
-        return "High"
-    elif score >= 4:
-        return "Medium"
-    else:
-        return "Low"
-
-import csv
-from flask import Response
+@bp.route('/phish/pixel/<key>.gif')
+def pixel(key):
+    if tracking_index.first_hit(key, 'open'):
+        event_recorder.record('open', key)
+    return Response(PIXEL_GIF, mimetype='image/gif', headers={'Cache-Control': 'no-store'})
 
-@bp.route('/campaigns/<int:campaign_id>/export/csv')
+@bp.route('/campaigns/<int:campaign_id>/export/<fmt>')
 @login_required
-def campaign_export_csv(campaign_id):
-    campaign = PhishingCampaign.query.get_or_404(campaign_id)
-    targets = PhishingTarget.query.filter_by(campaign_id=campaign_id).all()
-    users = {u.id: u for u in User.query.all()}
-
-    def generate():
-        data = csv.writer()
-        data.writerow(["User", "Email Sent", "Email Opened", "Link Clicked", "Data Submitted", "Reported as Phish"])
-        for t in targets:
-            data.writerow([
-                users[t.user_id].username,
-                t.email_sent, t.email_opened, t.link_clicked, t.data_submitted, t.reported_phish
-            ])
-        yield data.getvalue()
+def campaign_export(campaign_id, fmt):
+    PhishingCampaign.query.get_or_404(campaign_id)
+    return _export_response([campaign_id], fmt, f"campaign_{campaign_id}_results")
 
+@bp.route('/campaigns/export/<fmt>')
+@login_required
+def campaigns_export(fmt):
+    # e.g. /phishing/campaigns/export/ndjson?campaign_id=1&campaign_id=2&gzip=1
+    campaign_ids = request.args.getlist('campaign_id', type=int)
+    if not campaign_ids:
+        abort(400)
+    return _export_response(campaign_ids, fmt, "campaigns_results")
+
+def _export_response(campaign_ids, fmt, basename):
+    if fmt not in export.FORMATS:
+        abort(404)
+    compress = request.args.get('gzip', type=int) == 1
+    filename = f"{basename}.{fmt}" + (".gz" if compress else "")
     headers = {
-        "Content-Disposition": f"attachment; filename=campaign_{campaign_id}_results.csv"
+        "Content-Disposition": f"attachment; filename={filename}"
     }
-    return Response(generate(), mimetype='text/csv', headers=headers)	
+    body = stream_with_context(export.stream(campaign_ids, fmt, gzip=compress))
+    mimetype = 'application/gzip' if compress else export.FORMATS[fmt]
+    return Response(body, mimetype=mimetype, headers=headers)
 
 @bp.route('/dashboard')
 @login_required
+@conditional
 def dashboard():
-    from collections import Counter
-    from app.models import PhishingTarget, User
-
-    all_targets = PhishingTarget.query.all()
-    users = {u.id: u for u in User.query.all()}
-
-    # Aggregate counts
-    total_targets = len(all_targets)
-    opened = sum(1 for t in all_targets if t.email_opened)
-    clicked = sum(1 for t in all_targets if t.link_clicked)
-    submitted = sum(1 for t in all_targets if t.data_submitted)
-    reported = sum(1 for t in all_targets if t.reported_phish)
-
-    # Repeat offenders
-    offender_counts = Counter()
-    for t in all_targets:
-        if t.link_clicked or t.data_submitted:
-            offender_counts[t.user_id] += 1
-    REPEAT_THRESHOLD = 2
-    repeat_offenders = {user_id for user_id, count in offender_counts.items() if count >= REPEAT_THRESHOLD}
-
-    # User risk score
-    user_risk = {}
-    for user in users.values():
-        targets = [t for t in all_targets if t.user_id == user.id]
-        score = 0
-        for t in targets:
-            if t.email_opened: score += 1
-            if t.link_clicked: score += 3
-            if t.data_submitted: score += 5
-            if t.reported_phish: score -= 4
-        user_risk[user.id] = score
-
-    def risk_level(score):
-        if score >= 8:
-            return "High"
-        elif score >= 4:
-            return "Medium"
-        else:
-            return "Low"
-
+    # Funnel numbers come from the maintained counters, risk scores from app.risk. Both panels
+    # are cached until the phishing counters (or users) change (app.fragments)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), risk.MAX_PER_PAGE)
+    funnel = fragment_cache.fragment(
+        'phishing.funnel', ('phishing',),
+        lambda: render_template('phishing/dashboard_funnel.html', **aggregates.funnel_totals()))
+    risk_table = fragment_cache.fragment(
+        'phishing.risk', ('phishing', 'users'), lambda: _risk_table(page, per_page),
+        page, per_page, risk.settings_key())
+    return render_template('phishing/dashboard.html', funnel=funnel, risk_table=risk_table)
+
+def _risk_table(page, per_page):
+    ranked, total_users = risk.top_users(page, per_page)
+    users = {u.id: u for u in ranked}
     return render_template(
-        'phishing/dashboard.html',
-        total_targets=total_targets,
-        opened=opened,
-        clicked=clicked,
-        submitted=submitted,
-        reported=reported,
+        'phishing/dashboard_risk.html',
         users=users,
-        user_risk=user_risk,
-        risk_level=risk_level,
-        repeat_offenders=repeat_offenders
-    )
+        user_risk={u.id: u.score for u in ranked},
+        risk_level=risk.risk_level,
+        repeat_offenders=aggregates.repeat_offenders(users),
+        page=page,
+        per_page=per_page,
+        total_users=total_users,
+    )
\ No newline at end of file
@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 from app.models import SecurityPolicy, PolicyAcknowledgement, User
-from app import db
+from app import db, compliance, upserts
 
 bp = Blueprint('policy', __name__, url_prefix='/policies')
 
@@ -17,21 +17,39 @@ def policy_list():
 @login_required
 def policy_view(policy_id):
     policy = SecurityPolicy.query.get_or_404(policy_id)
-    acknowledged = PolicyAcknowledgement.query.filter_by(user_id=current_user.id, policy_id=policy_id).first()
-    if request.method == 'POST' and not acknowledged:
-        ack = PolicyAcknowledgement(user_id=current_user.id, policy_id=policy_id)
-        db.session.add(ack)
+    if request.method == 'POST':
+        # Inserted at most once however often it is posted (app.upserts)
+        if upserts.upsert(PolicyAcknowledgement, {'user_id': current_user.id, 'policy_id': policy_id},
+                          key=['user_id', 'policy_id']):
+            compliance.record_ack(policy_id, current_user.id)
         db.session.commit()
         flash('Policy acknowledged!')
         return redirect(url_for('policy.policy_list'))
+    acknowledged = PolicyAcknowledgement.query.filter_by(user_id=current_user.id, policy_id=policy_id).first()
     return render_template('policy/view.html', policy=policy, acknowledged=bool(acknowledged))
 
 @bp.route('/acknowledgements/')
 @login_required
 def acknowledgements():
-    # Admin view: list of all users & which policies they've acknowledged
-    policies = SecurityPolicy.query.all()
-    users = User.query.all()
-    acks = PolicyAcknowledgement.query.all()
+    # Admin view: compliance per policy and one page of the user x policy grid (app.compliance)
+    policies = SecurityPolicy.query.order_by(SecurityPolicy.upload_date).all()
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 100, type=int)
+    incomplete = request.args.get('incomplete', type=int) == 1
+    rows, total_users = compliance.grid(policies, page, per_page, incomplete=incomplete)
+    acks = PolicyAcknowledgement.query.filter(PolicyAcknowledgement.user_id.in_([row.user.id for row in rows]))
     ack_map = {(a.user_id, a.policy_id): a.acknowledged_at for a in acks}
-    return render_template('policy/acknowledgements.html', policies=policies, users=users, ack_map=ack_map)
\ No newline at end of file
+    return render_template('policy/acknowledgements.html', policies=policies, summary=compliance.summary(policies),
+                           rows=rows, ack_map=ack_map, page=page, per_page=per_page, total_users=total_users,
+                           incomplete=incomplete)
+
+@bp.route('/acknowledgements/<int:policy_id>/missing/')
+@login_required
+def acknowledgements_missing(policy_id):
+    # Users who have not acknowledged the policy yet
+    policy = SecurityPolicy.query.get_or_404(policy_id)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 100, type=int)
+    users, total_users = compliance.missing(policy_id, page, per_page)
+    return render_template('policy/missing.html', policy=policy, users=users, page=page, per_page=per_page,
+                           total_users=total_users)
\ No newline at end of file
@@ -2,14 +2,42 @@
 Super Admin dashboard and superadmin-only features.
 """
 
-from flask import Blueprint, render_template
+import io
+
+from flask import Blueprint, render_template, jsonify, request, abort
 from flask_login import login_required, current_user
+from app import directory
+from app.fragments import conditional
+from app.user_cache import user_cache
 
 bp = Blueprint('superadmin', __name__, url_prefix='/superadmin')
 
 @bp.route('/dashboard')
 @login_required
+@conditional
 def dashboard():
     if current_user.role != 'superadmin':
         return "Access denied", 403
-    return render_template('superadmin/dashboard.html')
\ No newline at end of file
+    return render_template('superadmin/dashboard.html')
+
+@bp.route('/user-cache')
+@login_required
+def user_cache_stats():
+    if current_user.role != 'superadmin':
+        return "Access denied", 403
+    return jsonify(user_cache.stats())
+
+@bp.route('/directory-sync', methods=['POST'])
+@login_required
+def directory_sync():
+    # Upload a CSV or LDIF directory export; users are created, updated and deactivated to match
+    if current_user.role != 'superadmin':
+        return "Access denied", 403
+    upload = request.files.get('export')
+    if upload is None:
+        abort(400)
+    fmt = request.form.get('format') or directory.format_for(upload.filename or '')
+    if fmt not in directory.FORMATS:
+        abort(400)
+    report = directory.sync(directory.READERS[fmt](io.TextIOWrapper(upload.stream, encoding='utf-8-sig')))
+    return jsonify(report)
\ No newline at end of file
@@ -1,16 +1,63 @@
+"""
+Security survey routes: taking a survey and viewing its results.
+"""
+
+import json
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort
+from flask_login import login_required, current_user
+from app.models import SecuritySurvey, SurveyQuestion, SurveyResponse
+from app import db, survey_answers, survey_stats
+
+bp = Blueprint('survey', __name__)
+
+RESPONSES_PER_PAGE = 50
+
+@bp.app_template_filter('fromjson')
+def fromjson(value):
+    return json.loads(value or 'null')
+
+@bp.route('/survey/<int:survey_id>/', methods=['GET', 'POST'])
+@login_required
+def survey_take(survey_id):
+    survey = SecuritySurvey.query.get_or_404(survey_id)
+    questions = SurveyQuestion.query.filter_by(survey_id=survey_id).all()
+    if request.method == 'POST':
+        answers = {f'q{q.id}': request.form.get(f'q{q.id}') for q in questions}
+        response = SurveyResponse(survey_id=survey_id, user_id=current_user.id, answers=json.dumps(answers))
+        db.session.add(response)
+        db.session.flush()
+        survey_answers.record_response(response, answers)
+        survey_stats.record_response(survey_id, current_user, answers)
+        db.session.commit()
+        flash('Thank you for completing the survey.')
+        return redirect(url_for('survey.survey_take', survey_id=survey_id))
+    return render_template('survey/take.html', survey=survey, questions=questions)
+
 @bp.route('/survey/<int:survey_id>/results/')
 @login_required
 def survey_results(survey_id):
     survey = SecuritySurvey.query.get_or_404(survey_id)
     questions = SurveyQuestion.query.filter_by(survey_id=survey_id).all()
-    responses = SurveyResponse.query.filter_by(survey_id=survey_id).all()
-    # Aggregate counts for each answer
-    analytics = {q.id: {} for q in questions}
-    for r in responses:
-        ans = json.loads(r.answers)
-        for q in questions:
-            val = ans.get(f'q{q.id}')
-            if val not in analytics[q.id]:
-                analytics[q.id][val] = 0
-            analytics[q.id][val] += 1
-    return render_template('survey/results.html', survey=survey, questions=questions, analytics=analytics, responses=responses)
\ No newline at end of file
+    # Counts are maintained on submit (app.survey_stats); ?by=department|role|risk adds a cross-tab
+    analytics = survey_stats.tallies(survey_id)
+    by = request.args.get('by')
+    if by and by not in survey_stats.DIMENSIONS:
+        abort(400)
+    crosstab, segments = survey_stats.crosstab(survey_id, by) if by else ({}, [])
+    # Drill-down: ?q=<question id>&answer=<choice> keeps only respondents who gave that answer
+    question_id = request.args.get('q', type=int)
+    answer = request.args.get('answer')
+    responses = SurveyResponse.query.filter_by(survey_id=survey_id)
+    if question_id and answer:
+        responses = survey_answers.respondents(survey_id, {question_id: answer})
+        analytics = {q.id: {label: n for label, n in survey_answers.answer_counts(q.id, responses) if n}
+                     for q in questions}
+    page = request.args.get('page', 1, type=int)
+    total_responses = responses.count()
+    responses = (responses.order_by(SurveyResponse.completed_at.desc())
+                 .limit(RESPONSES_PER_PAGE).offset((page - 1) * RESPONSES_PER_PAGE).all())
+    return render_template('survey/result.html', survey=survey, questions=questions, analytics=analytics,
+                           by=by, dimensions=survey_stats.DIMENSIONS, crosstab=crosstab, segments=segments,
+                           responses=responses, page=page, per_page=RESPONSES_PER_PAGE,
+                           total_responses=total_responses, question_id=question_id, answer=answer)
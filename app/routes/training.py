@@ -5,17 +5,26 @@ Training module management, user training, and progress tracking routes.
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 from app.models import TrainingModule, UserProgress
-from app import db
+from app import db, upserts
+from app.fragments import conditional, fragment_cache
+from app.remediation import remediation_engine
 
 bp = Blueprint('training', __name__, url_prefix='/training')
 
 @bp.route('/')
 @login_required
+@conditional
 def index():
+    # The list with the user's completed modules marked, cached until modules or progress change
+    module_list = fragment_cache.fragment('training.modules', ('modules', 'progress'), _module_list,
+                                          current_user.id, current_user.role)
+    return render_template('training/index.html', module_list=module_list)
+
+def _module_list():
     modules = TrainingModule.query.all()
     # Get user's completed modules
     completed = {up.module_id for up in UserProgress.query.filter_by(user_id=current_user.id, completed=True).all()}
-    return render_template('training/index.html', modules=modules, completed=completed)
+    return render_template('training/index_modules.html', modules=modules, completed=completed)
 
 @bp.route('/view/<int:module_id>')
 @login_required
@@ -28,13 +37,11 @@ def view(module_id):
 @bp.route('/complete/<int:module_id>', methods=['POST'])
 @login_required
 def complete(module_id):
-    module = TrainingModule.query.get_or_404(module_id)
-    progress = UserProgress.query.filter_by(user_id=current_user.id, module_id=module_id).first()
-    if not progress:
-        progress = UserProgress(user_id=current_user.id, module_id=module_id, completed=True)
-        db.session.add(progress)
-    else:
-        progress.completed = True
+    TrainingModule.query.get_or_404(module_id)
+    # One statement whether or not the user has a progress row yet (app.upserts)
+    upserts.upsert(UserProgress, {'user_id': current_user.id, 'module_id': module_id, 'completed': True},
+                   key=['user_id', 'module_id'], update=['completed'])
+    remediation_engine.complete_module(current_user.id, module_id)
     db.session.commit()
     flash('Module marked as completed.')
     return redirect(url_for('training.view', module_id=module_id))
\ No newline at end of file
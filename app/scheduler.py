@@ -0,0 +1,128 @@
+"""
+Launches phishing campaigns at their scheduled_time.
+
+Pending campaigns are kept in a heap ordered by due time and the scheduler thread sleeps until
+the earliest one is due. The heap is resynced from the database every SCHEDULER_RESYNC_SECONDS
+to pick up campaigns created on other nodes and campaigns whose sending node died, so a campaign
+created outside the scheduler's process launches up to SCHEDULER_RESYNC_SECONDS late. Launching
+goes through app.leases, so running the scheduler on several nodes never sends a campaign twice.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from . import db, leases
+from .mailer import send_engine
+from .tracking_index import tracking_index
+from .models import PhishingCampaign, PhishingTarget
+
+
+def launch_campaign(campaign):
+    """Claim the campaign and queue its unsent targets; False if another node already has it."""
+    if not leases.claim(campaign.id):
+        return False
+    db.session.refresh(campaign)
+    tracking_index.load_campaign(campaign.id)
+    pending = [tid for (tid,) in db.session.query(PhishingTarget.id)
+               .filter_by(campaign_id=campaign.id, email_sent=None)]
+    if not pending:
+        leases.release(campaign.id)
+        return True
+    send_engine.enqueue(campaign, pending, window=(campaign.send_window_minutes or 0) * 60)
+    return True
+
+
+class CampaignScheduler:
+    """Heap of (due time, campaign id) served by one thread."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SCHEDULER_RESYNC_SECONDS', 60)
+        app.config.setdefault('SCHEDULER_LEASE_SECONDS', 600)
+        app.extensions['campaign_scheduler'] = self
+        self.app = app
+
+    def schedule(self, campaign_id, due):
+        """Add a campaign to the heap and wake the scheduler if it is now the earliest."""
+        if self._thread is None:
+            return  # not running in this process; the running scheduler picks it up on its next resync
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), campaign_id))
+            self._cond.notify()
+
+    def resync(self):
+        """Rebuild the heap from the database."""
+        now = datetime.utcnow()
+        due = (db.session.query(PhishingCampaign.id, PhishingCampaign.scheduled_time)
+               .filter(PhishingCampaign.scheduled_time.isnot(None), PhishingCampaign.closed.isnot(True),
+                       leases.claimable())
+               .all())
+        with self._cond:
+            self._heap = [(when if when > now else now, next(self._seq), cid) for cid, when in due]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+        return len(self._heap)
+
+    def start(self):
+        """Run the scheduler on a daemon thread of this process."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='campaign-scheduler', daemon=True)
+            self._thread.start()
+
+    def run(self):
+        self._thread = self._thread or threading.current_thread()
+        with self.app.app_context():
+            interval = self.app.config['SCHEDULER_RESYNC_SECONDS']
+            next_resync = 0
+            while True:
+                if time.monotonic() >= next_resync:
+                    try:
+                        self.resync()
+                    except Exception:
+                        db.session.rollback()
+                        current_app.logger.exception('Failed to resync the campaign scheduler, retrying')
+                    finally:
+                        db.session.remove()
+                    next_resync = time.monotonic() + interval
+                campaign_id = self._wait_for_due(next_resync)
+                if campaign_id is None:
+                    continue
+                try:
+                    campaign = db.session.get(PhishingCampaign, campaign_id)
+                    if campaign is not None and launch_campaign(campaign):
+                        current_app.logger.info('Launched phishing campaign %s', campaign_id)
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception('Failed to launch phishing campaign %s', campaign_id)
+                finally:
+                    db.session.remove()
+
+    def _wait_for_due(self, until):
+        """Pop the next due campaign id, sleeping until it is due; None when `until` comes first."""
+        with self._cond:
+            while True:
+                now = datetime.utcnow()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                timeout = until - time.monotonic()
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                if timeout <= 0:
+                    return None
+                self._cond.wait(timeout)
+
+
+campaign_scheduler = CampaignScheduler()
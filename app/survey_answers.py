@@ -0,0 +1,179 @@
+"""
+Normalized survey answers.
+
+SurveyChoice holds one row per choice of a question and SurveyResponseItem one row per chosen
+answer, written next to the legacy JSON columns. Filtering and segmenting respondents runs in
+SQL on these tables; migrate() fills them from existing JSON.
+"""
+
+import json
+
+from sqlalchemy import and_, func, insert, select, true
+from sqlalchemy.orm import aliased
+
+from . import db, upserts
+from .models import SurveyChoice, SurveyQuestion, SurveyResponse, SurveyResponseItem, User
+
+CHUNK_SIZE = 1000
+EXTRA_POSITION = 1000  # answers that are not in the question's choices list sort last
+
+
+def _labels(value):
+    """Answer value(s) from a JSON blob or a form as a list of choice labels."""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [str(v)[:255] for v in values if v not in (None, '')]
+
+
+def _choice_map(question_ids):
+    return {(qid, label): cid for cid, qid, label in
+            db.session.query(SurveyChoice.id, SurveyChoice.question_id, SurveyChoice.label)
+            .filter(SurveyChoice.question_id.in_(question_ids))}
+
+
+def _ensure_choices(questions, wanted):
+    """{(question_id, label): choice id}, creating choices for any wanted pair that has none."""
+    choices = _choice_map([q.id for q in questions])
+    missing = sorted(set(wanted) - set(choices))
+    if missing:
+        positions = {}
+        for q in questions:
+            for position, label in enumerate(_labels(json.loads(q.choices or '[]'))):
+                positions.setdefault((q.id, label), position)
+        # ON CONFLICT DO NOTHING: a concurrent first answer may create the same choices meanwhile
+        upserts.upsert_many(SurveyChoice, [
+            {'question_id': qid, 'label': label, 'position': positions.get((qid, label), EXTRA_POSITION)}
+            for qid, label in missing
+        ], key=['question_id', 'label'])
+        choices = _choice_map([q.id for q in questions])
+    return choices
+
+
+def sync_choices(questions):
+    """Create SurveyChoice rows for the labels in the questions' JSON choices lists."""
+    return _ensure_choices(questions, [(q.id, label) for q in questions
+                                       for label in _labels(json.loads(q.choices or '[]'))])
+
+
+def _items(questions, rows):
+    """Item dicts for (response id, survey id, user id, answers dict) rows."""
+    wanted = {}
+    for response_id, survey_id, user_id, answers in rows:
+        for q in questions:
+            for label in _labels(answers.get(f'q{q.id}')):
+                wanted[(response_id, q.id, label)] = (survey_id, user_id)
+    choices = _ensure_choices(questions, {(qid, label) for _, qid, label in wanted})
+    return [{'response_id': response_id, 'question_id': qid, 'choice_id': choices[(qid, label)],
+             'survey_id': survey_id, 'user_id': user_id}
+            for (response_id, qid, label), (survey_id, user_id) in wanted.items()]
+
+
+def record_response(response, answers):
+    """Write the items of a new, flushed response (answers as {"q<id>": choice}); the caller commits."""
+    questions = SurveyQuestion.query.filter_by(survey_id=response.survey_id).all()
+    items = _items(questions, [(response.id, response.survey_id, response.user_id, answers)])
+    if items:
+        db.session.execute(insert(SurveyResponseItem), items)
+
+
+def migrate(survey_id=None, chunk_size=CHUNK_SIZE):
+    """Normalize JSON choices and every response without items yet; commits per chunk.
+
+    Safe to re-run. Returns how many responses were read (empty ones are read again each run).
+    """
+    questions = SurveyQuestion.query
+    if survey_id is not None:
+        questions = questions.filter_by(survey_id=survey_id)
+    by_survey = {}
+    for q in questions:
+        by_survey.setdefault(q.survey_id, []).append(q)
+    for survey_questions in by_survey.values():
+        sync_choices(survey_questions)
+    db.session.commit()
+
+    migrated = db.session.query(SurveyResponseItem.response_id)
+    pending = SurveyResponse.query.filter(SurveyResponse.id.notin_(migrated))
+    if survey_id is not None:
+        pending = pending.filter(SurveyResponse.survey_id == survey_id)
+    total = last_id = 0
+    while True:
+        chunk = (pending.with_entities(SurveyResponse.id, SurveyResponse.survey_id, SurveyResponse.user_id,
+                                       SurveyResponse.answers)
+                 .filter(SurveyResponse.id > last_id).order_by(SurveyResponse.id).limit(chunk_size).all())
+        if not chunk:
+            return total
+        rows = {}
+        for response_id, sid, user_id, answers in chunk:
+            try:
+                answers = json.loads(answers or '{}')
+            except ValueError:
+                answers = {}
+            rows.setdefault(sid, []).append((response_id, sid, user_id, answers))
+        for sid, survey_rows in rows.items():
+            items = _items(by_survey.get(sid, []), survey_rows)
+            if items:
+                db.session.execute(insert(SurveyResponseItem), items)
+        db.session.commit()
+        total += len(chunk)
+        last_id = chunk[-1].id
+
+
+# --- Queries ---
+
+def answered(question_id, *labels):
+    """SELECT of the response ids that chose any of the labels for a question."""
+    return (select(SurveyResponseItem.response_id)
+            .join(SurveyChoice, SurveyChoice.id == SurveyResponseItem.choice_id)
+            .where(SurveyResponseItem.question_id == question_id, SurveyChoice.label.in_(labels)))
+
+
+def respondents(survey_id, answers=None):
+    """Query of a survey's responses matching every {question_id: label or [labels]} condition."""
+    query = SurveyResponse.query.filter(SurveyResponse.survey_id == survey_id)
+    for question_id, labels in (answers or {}).items():
+        query = query.filter(SurveyResponse.id.in_(answered(question_id, *_labels(labels))))
+    return query
+
+
+def respondent_users(survey_id, answers=None):
+    """Query of the users behind respondents(survey_id, answers)."""
+    responses = respondents(survey_id, answers).with_entities(SurveyResponse.user_id)
+    return User.query.filter(User.id.in_(responses))
+
+
+def _restrict(responses):
+    if responses is None:
+        return true()
+    return SurveyResponseItem.response_id.in_(responses.with_entities(SurveyResponse.id))
+
+
+def answer_counts(question_id, responses=None):
+    """[(label, count)] in choice order, optionally only over a respondents() query."""
+    return (db.session.query(SurveyChoice.label, func.count(SurveyResponseItem.response_id))
+            .outerjoin(SurveyResponseItem, and_(SurveyResponseItem.choice_id == SurveyChoice.id,
+                                                _restrict(responses)))
+            .filter(SurveyChoice.question_id == question_id)
+            .group_by(SurveyChoice.id, SurveyChoice.label, SurveyChoice.position)
+            .order_by(SurveyChoice.position, SurveyChoice.id)
+            .all())
+
+
+def segment(question_id, by, responses=None):
+    """[(segment, label, count)] for a question, split by a User column or by another question's answer.
+
+    `by` is a column such as User.department, or a question id for an answer-by-answer cross-tab.
+    """
+    query = (db.session.query(SurveyChoice.label, func.count())
+             .select_from(SurveyResponseItem)
+             .join(SurveyChoice, SurveyChoice.id == SurveyResponseItem.choice_id)
+             .filter(SurveyResponseItem.question_id == question_id, _restrict(responses)))
+    if isinstance(by, int):
+        other_item, other_choice = aliased(SurveyResponseItem), aliased(SurveyChoice)
+        key = other_choice.label
+        query = (query.join(other_item, and_(other_item.response_id == SurveyResponseItem.response_id,
+                                             other_item.question_id == by))
+                 .join(other_choice, other_choice.id == other_item.choice_id))
+    else:
+        key = by
+        query = query.join(User, User.id == SurveyResponseItem.user_id)
+    rows = query.add_columns(key).group_by(key, SurveyChoice.label).order_by(key, SurveyChoice.label)
+    return [(seg, label, count) for label, count, seg in rows]
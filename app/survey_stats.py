@@ -0,0 +1,122 @@
+"""
+Survey answer tallies, updated as responses are submitted.
+
+Every answer is counted per question and choice overall ('all') and under the respondent's
+department, role and phishing risk level at the time of answering. The results page and its
+cross-tabs read these counts and never parse the stored JSON responses.
+"""
+
+import json
+from collections import Counter, defaultdict
+
+from . import db, risk, upserts
+from .models import SurveyAnswerCount, SurveyQuestion, SurveyResponse, User
+
+DIMENSIONS = ('department', 'role', 'risk')
+KEY = ('question_id', 'dimension', 'segment', 'choice')
+CHUNK_SIZE = 1000
+
+
+def _segments(department, role, score):
+    return (('all', ''), ('department', department or ''), ('role', role or ''),
+            ('risk', risk.risk_level(score or 0)))
+
+
+def _count(counts, question_ids, answers, segments):
+    for qid in question_ids:
+        choice = answers.get(f'q{qid}')
+        if choice is None:
+            continue
+        for dimension, segment in segments:
+            counts[(qid, dimension, segment, str(choice)[:255])] += 1
+
+
+def _apply(survey_id, counts):
+    """Add {(question_id, dimension, segment, choice): n} to the tally rows, creating missing ones."""
+    if not counts:
+        return
+    # One INSERT ... ON CONFLICT DO UPDATE: concurrent first answers to a survey both land
+    upserts.upsert_many(SurveyAnswerCount,
+                        [dict(zip(KEY, key), survey_id=survey_id, count=n) for key, n in counts.items()],
+                        key=list(KEY), increment=['count'])
+
+
+def _question_ids(survey_id):
+    return [qid for (qid,) in db.session.query(SurveyQuestion.id).filter_by(survey_id=survey_id)]
+
+
+def record_response(survey_id, user, answers):
+    """Count one submitted response (answers as {"q<id>": choice}); the caller commits."""
+    score = risk.scores_for_users([user.id]).get(user.id)
+    counts = Counter()
+    _count(counts, _question_ids(survey_id), answers, _segments(user.department, user.role, score))
+    _apply(survey_id, counts)
+
+
+def backfill(survey_id=None):
+    """Recount tallies from the stored JSON responses; returns how many responses were read."""
+    tallies = db.session.query(SurveyAnswerCount)
+    responses = (db.session.query(SurveyResponse.survey_id, SurveyResponse.answers,
+                                  User.id, User.department, User.role)
+                 .join(User, User.id == SurveyResponse.user_id)
+                 .order_by(SurveyResponse.id))
+    if survey_id is not None:
+        tallies = tallies.filter(SurveyAnswerCount.survey_id == survey_id)
+        responses = responses.filter(SurveyResponse.survey_id == survey_id)
+    tallies.delete(synchronize_session=False)
+
+    counts = defaultdict(Counter)
+    questions = {}
+    total = 0
+
+    def count_chunk(chunk):
+        scores = risk.scores_for_users({row.id for row in chunk})
+        for sid, answers, user_id, department, role in chunk:
+            if sid not in questions:
+                questions[sid] = _question_ids(sid)
+            try:
+                answers = json.loads(answers or '{}')
+            except ValueError:
+                continue
+            _count(counts[sid], questions[sid], answers, _segments(department, role, scores.get(user_id)))
+
+    chunk = []
+    for row in responses.yield_per(CHUNK_SIZE):
+        chunk.append(row)
+        total += 1
+        if len(chunk) == CHUNK_SIZE:
+            count_chunk(chunk)
+            chunk = []
+    count_chunk(chunk)
+
+    for sid, survey_counts in counts.items():
+        _apply(sid, survey_counts)
+    db.session.commit()
+    return total
+
+
+def tallies(survey_id):
+    """{question_id: {choice: count}} over every response."""
+    result = defaultdict(dict)
+    for qid, choice, count in (db.session.query(SurveyAnswerCount.question_id, SurveyAnswerCount.choice,
+                                                SurveyAnswerCount.count)
+                               .filter_by(survey_id=survey_id, dimension='all')
+                               .order_by(SurveyAnswerCount.question_id, SurveyAnswerCount.count.desc())):
+        result[qid][choice] = count
+    return result
+
+
+def crosstab(survey_id, dimension):
+    """({question_id: {choice: {segment: count}}}, sorted segments) for one of DIMENSIONS."""
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown survey dimension: {dimension}")
+    result = defaultdict(lambda: defaultdict(dict))
+    segments = set()
+    for qid, choice, segment, count in (db.session.query(SurveyAnswerCount.question_id,
+                                                         SurveyAnswerCount.choice,
+                                                         SurveyAnswerCount.segment,
+                                                         SurveyAnswerCount.count)
+                                        .filter_by(survey_id=survey_id, dimension=dimension)):
+        result[qid][choice][segment] = count
+        segments.add(segment)
+    return result, sorted(segments)
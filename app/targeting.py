@@ -0,0 +1,58 @@
+"""
+Bulk creation of phishing campaign targets.
+Recipients are chosen by user id list or by selector and inserted in chunks with their
+tracking keys generated in the same pass.
+"""
+
+import uuid
+from collections import namedtuple
+
+from sqlalchemy import insert
+
+from . import aggregates, db
+from .models import PhishingTarget, User
+
+CHUNK_SIZE = 1000
+
+TargetRow = namedtuple('TargetRow', 'campaign_id user_id')
+
+
+def select_users(role=None, department=None, all_active=False):
+    """User id query for a selector: a role, a department (group), or every active user."""
+    query = db.session.query(User.id)
+    if role:
+        query = query.filter(User.role == role)
+    if department:
+        query = query.filter(User.department == department)
+    if all_active:
+        query = query.filter(User.is_active.isnot(False))
+    return query
+
+
+def add_targets(campaign_id, user_ids=None, role=None, department=None, all_active=False,
+                chunk_size=CHUNK_SIZE):
+    """Target the given users (or the selector's users) in a campaign; returns how many were added.
+
+    Users that do not exist or are already targeted by the campaign are skipped.
+    """
+    if user_ids is None and not (role or department or all_active):
+        return 0
+    already = db.session.query(PhishingTarget.user_id).filter(PhishingTarget.campaign_id == campaign_id)
+    if user_ids is not None:
+        wanted = sorted({int(uid) for uid in user_ids})
+        candidates = []
+        for i in range(0, len(wanted), chunk_size):
+            candidates += [uid for (uid,) in db.session.query(User.id).filter(
+                User.id.in_(wanted[i:i + chunk_size]), User.id.notin_(already))]
+    else:
+        query = select_users(role=role, department=department, all_active=all_active)
+        candidates = [uid for (uid,) in query.filter(User.id.notin_(already)).order_by(User.id)]
+
+    for i in range(0, len(candidates), chunk_size):
+        db.session.execute(insert(PhishingTarget), [
+            {'campaign_id': campaign_id, 'user_id': uid, 'tracking_key': str(uuid.uuid4())}
+            for uid in candidates[i:i + chunk_size]
+        ])
+    aggregates.record_targets([TargetRow(campaign_id, uid) for uid in candidates])
+    db.session.commit()
+    return len(candidates)
@@ -0,0 +1,150 @@
+"""
+Write-behind recorder for phishing tracking events (opens, clicks, submissions, reports).
+Hits are queued in memory and written by a background thread in batches.
+"""
+
+import atexit
+import threading
+from collections import deque
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import case, update
+
+from . import db
+from .models import PhishingTarget
+
+# Event kind -> PhishingTarget column stamped by it
+COLUMNS = {
+    'open': 'email_opened',
+    'click': 'link_clicked',
+    'submit': 'data_submitted',
+    'report': 'reported_phish',
+}
+
+
+class EventRecorder:
+    """Buffers tracking events and flushes them every TRACKING_FLUSH_INTERVAL seconds."""
+
+    def __init__(self, app=None):
+        self.app = None
+        # deque.append/popleft are atomic, so request threads never take a lock here
+        self._events = deque()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._subscribers = []
+        self._thread = None
+        self._stopping = False
+        self._failures = 0  # consecutive failed writes of the batch at the head of the queue
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRACKING_FLUSH_INTERVAL', 1.0)
+        app.config.setdefault('TRACKING_BATCH_SIZE', 500)
+        app.config.setdefault('TRACKING_MAX_RETRIES', 5)
+        app.extensions['event_recorder'] = self
+        self.app = app
+
+    def subscribe(self, fn):
+        """Register fn(kind, rows), called inside the flush transaction with newly stamped targets."""
+        if fn not in self._subscribers:
+            self._subscribers.append(fn)
+        return fn
+
+    def record(self, kind, tracking_key):
+        self._events.append((kind, tracking_key, datetime.utcnow()))
+        if self._thread is None:
+            self._start()
+        if len(self._events) >= self.app.config['TRACKING_BATCH_SIZE']:
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._events)
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tracking-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            while not self._stopping:
+                self._wakeup.wait(self.app.config['TRACKING_FLUSH_INTERVAL'])
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    current_app.logger.exception('Failed to flush tracking events')
+                finally:
+                    db.session.remove()
+
+    def flush(self):
+        """Write all queued events; returns the number of events processed."""
+        batch_size = self.app.config['TRACKING_BATCH_SIZE']
+        processed = 0
+        with self._flush_lock:
+            while self._events:
+                batch = []
+                while self._events and len(batch) < batch_size:
+                    batch.append(self._events.popleft())
+                try:
+                    self._apply(batch)
+                except Exception:
+                    db.session.rollback()
+                    self._failures += 1
+                    if self._failures < self.app.config['TRACKING_MAX_RETRIES']:
+                        self._events.extendleft(reversed(batch))
+                    else:
+                        self.app.logger.error('Dropping %d tracking events after %d failed writes: %r',
+                                              len(batch), self._failures, batch)
+                        self._failures = 0
+                    raise
+                self._failures = 0
+                processed += len(batch)
+        return processed
+
+    def _apply(self, batch):
+        first_seen = {kind: {} for kind in COLUMNS}
+        for kind, key, at in batch:
+            first_seen[kind].setdefault(key, at)
+        for kind, stamps in first_seen.items():
+            if not stamps:
+                continue
+            column = getattr(PhishingTarget, COLUMNS[kind])
+            # The IS NULL guard sits in the UPDATE itself: when two processes record the same
+            # first hit, only one stamps the target and passes it on to the subscribers
+            statement = (update(PhishingTarget)
+                         .where(PhishingTarget.tracking_key.in_(stamps), column.is_(None))
+                         .values({column: case(stamps, value=PhishingTarget.tracking_key)})
+                         .returning(PhishingTarget.id, PhishingTarget.user_id,
+                                    PhishingTarget.campaign_id, PhishingTarget.tracking_key)
+                         .execution_options(synchronize_session=False))
+            rows = db.session.execute(statement).all()
+            if not rows:
+                continue
+            for fn in self._subscribers:
+                fn(kind, rows)
+        db.session.commit()
+
+    def shutdown(self):
+        """Stop the writer thread and flush whatever is still queued."""
+        if self.app is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        if self._events:
+            with self.app.app_context():
+                self.flush()
+                db.session.remove()
+        # A later record() starts a new writer
+        self._thread = None
+        self._stopping = False
+
+
+event_recorder = EventRecorder()
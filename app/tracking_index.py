@@ -0,0 +1,180 @@
+"""
+In-memory index of tracking keys for active campaigns, plus a negative cache for unknown keys.
+
+Repeat hits on a known key and hits on junk keys (mail scanners, bots, expired campaigns) are
+answered from memory. Only the first miss for a key goes to the database. Every
+TRACKING_INDEX_RESYNC_SECONDS the index drops the campaigns closed by other processes and loads
+every key of the ones they launched, so valid keys never depend on the Bloom filter, whose false
+positives would otherwise discard their events.
+"""
+
+import hashlib
+import threading
+import time
+
+from sqlalchemy import select
+
+from . import db
+from .models import PhishingCampaign, PhishingTarget
+
+# Event kind -> bit in an index entry; the target id is stored above these bits
+BITS = {'open': 1, 'click': 2, 'submit': 4, 'report': 8}
+COLUMN_BITS = [
+    (PhishingTarget.email_opened, 1),
+    (PhishingTarget.link_clicked, 2),
+    (PhishingTarget.data_submitted, 4),
+    (PhishingTarget.reported_phish, 8),
+]
+SHIFT = 4
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter; cleared once it holds `capacity` keys so the error rate stays bounded."""
+
+    def __init__(self, capacity=100000, bits_per_key=10, hashes=7):
+        self.capacity = capacity
+        self.size = capacity * bits_per_key
+        self.hashes = hashes
+        self._bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self.count = 0
+
+    def add(self, key):
+        if self.count >= self.capacity:
+            self.clear()
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class TrackingIndex:
+    """tracking key -> target id and already-recorded event bits."""
+
+    def __init__(self, app=None):
+        self._entries = {}
+        self._campaign_keys = {}
+        self._loaded = set()  # campaigns with every key indexed, not just the ones hit so far
+        self._lock = threading.Lock()
+        self.negative = BloomFilter()
+        self.resync_seconds = 60
+        self._next_resync = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRACKING_NEGATIVE_CACHE_SIZE', 100000)
+        app.config.setdefault('TRACKING_INDEX_RESYNC_SECONDS', 60)
+        app.extensions['tracking_index'] = self
+        self.negative = BloomFilter(app.config['TRACKING_NEGATIVE_CACHE_SIZE'])
+        self.resync_seconds = app.config['TRACKING_INDEX_RESYNC_SECONDS']
+
+    def _statement(self, *criteria):
+        """(key, target id, campaign id, *event stamps) of targets of open campaigns."""
+        return (select(PhishingTarget.tracking_key, PhishingTarget.id,
+                       PhishingTarget.campaign_id, *[c for c, _ in COLUMN_BITS])
+                .join(PhishingCampaign, PhishingCampaign.id == PhishingTarget.campaign_id)
+                .where(PhishingCampaign.closed.isnot(True), *criteria))
+
+    def _store(self, rows):
+        with self._lock:
+            for key, target_id, campaign_id, *stamps in rows:
+                bits = sum(bit for stamp, (_, bit) in zip(stamps, COLUMN_BITS) if stamp is not None)
+                self._entries[key] = target_id << SHIFT | bits
+                self._campaign_keys.setdefault(campaign_id, set()).add(key)
+
+    def load_campaign(self, campaign_id):
+        """Index every target of a campaign; called when it launches."""
+        statement = self._statement(PhishingTarget.campaign_id == campaign_id)
+        self._store(db.session.execute(statement.execution_options(yield_per=1000)))
+        self._loaded.add(campaign_id)
+
+    def evict_campaign(self, campaign_id):
+        """Forget a closed campaign; its keys then behave like unknown ones."""
+        with self._lock:
+            self._loaded.discard(campaign_id)
+            for key in self._campaign_keys.pop(campaign_id, ()):
+                self._entries.pop(key, None)
+
+    def _closed_statement(self):
+        """Ids of the indexed campaigns that have been closed since."""
+        return select(PhishingCampaign.id).where(PhishingCampaign.id.in_(list(self._campaign_keys)),
+                                                 PhishingCampaign.closed.is_(True))
+
+    def evict_closed(self):
+        """Forget the campaigns closed since they were indexed, by any process; returns how many."""
+        if not self._campaign_keys:
+            return 0
+        closed = db.session.execute(self._closed_statement()).scalars().all()
+        for campaign_id in closed:
+            self.evict_campaign(campaign_id)
+        return len(closed)
+
+    def _launched_statement(self):
+        """Ids of the running campaigns not loaded yet (launched elsewhere or before this process)."""
+        return select(PhishingCampaign.id).where(PhishingCampaign.launched.is_(True),
+                                                 PhishingCampaign.closed.isnot(True),
+                                                 PhishingCampaign.id.notin_(list(self._loaded)))
+
+    def resync(self):
+        """Drop closed campaigns and load newly launched ones, by any process; returns how many were loaded."""
+        self.evict_closed()
+        launched = db.session.execute(self._launched_statement()).scalars().all()
+        for campaign_id in launched:
+            self.load_campaign(campaign_id)
+        if launched:
+            self.negative.clear()  # it may hold, or falsely match, keys of the new campaigns
+        return len(launched)
+
+    def resolve(self, key, confirm=False):
+        """Index entry for a key, or None if it is unknown or expired. Hits the DB only on first miss.
+
+        With confirm, a key the negative cache rejects is looked up anyway, so that a Bloom
+        filter false positive never turns a valid key into a 404.
+        """
+        now = time.monotonic()
+        if now >= self._next_resync:
+            self._next_resync = now + self.resync_seconds
+            self.resync()
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+        if key in self.negative and not confirm:
+            return None
+        return self._found(key, db.session.execute(self._statement(PhishingTarget.tracking_key == key)).first())
+
+    def _found(self, key, row):
+        """Remember the row looked up for a key, or that there is none; returns the entry."""
+        if row is None:
+            self.negative.add(key)
+            return None
+        self._store([row])
+        return self._entries.get(key)
+
+    def first_hit(self, key, kind):
+        """True if this is the first `kind` event for a valid key; marks it as seen."""
+        return self._mark(key, self.resolve(key), kind)
+
+    def _mark(self, key, entry, kind):
+        if entry is None or entry & BITS[kind]:
+            return False
+        self._entries[key] = entry | BITS[kind]
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+tracking_index = TrackingIndex()
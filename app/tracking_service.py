@@ -0,0 +1,265 @@
+"""
+Tracking microservice: the pixel and landing page routes as an asyncio (ASGI) app.
+
+It runs as its own process, apart from the Flask workers of the admin UI, so a burst of mail
+scanner hits never queues admins behind it, and it scales on its own:
+
+    uvicorn tracking_asgi:app --workers 4 --no-access-log
+
+and the proxy sends /phishing/phish/ to it. It serves the same URLs and pages as the phishing
+blueprint and shares its models and tracking machinery:
+
+- keys are resolved from an in-memory tracking index (app.tracking_index), preloaded with the
+  targets of running campaigns; misses are looked up in batches through an async driver
+  (aiosqlite or asyncpg) without blocking the event loop. Every TRACKING_SERVICE_RESYNC_SECONDS
+  closed campaigns are dropped and the keys of newly launched ones loaded;
+- first hits go to the event recorder (app.tracking), which writes them in batches from its own
+  thread, with the same counters, risk scores and remediation as events seen by the Flask app;
+- the landing and thank-you pages are rendered once at startup.
+"""
+
+import asyncio
+from urllib.parse import parse_qs
+
+from flask import render_template
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from . import db
+from .models import PhishingCampaign, PhishingTarget
+from .tracking import event_recorder
+from .tracking_index import BloomFilter, TrackingIndex
+
+PIXEL_PREFIX = '/phishing/phish/pixel/'
+LANDING_PREFIX = '/phishing/phish/'
+# Sync driver -> async driver of the same database
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+LOOKUP_BATCH_SIZE = 500  # keys per lookup query
+MAX_BODY = 64 * 1024
+HTML = [(b'content-type', b'text/html; charset=utf-8')]
+TEXT = [(b'content-type', b'text/plain; charset=utf-8')]
+
+
+def async_url(url):
+    """The URL of the same database through its async driver."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend!r} databases; set TRACKING_ASYNC_DATABASE_URL")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class AsyncTrackingIndex(TrackingIndex):
+    """The tracking index, with database lookups awaited on an async engine.
+
+    Keys missed while a lookup is running are gathered and looked up together by the next one,
+    in a single query, so a burst of unknown keys costs a few queries rather than one each.
+    """
+
+    def __init__(self, engine, negative_cache_size):
+        super().__init__()
+        self.engine = engine
+        self.negative = BloomFilter(negative_cache_size)
+        self._pending = {}  # key -> future of its entry
+        self._lookup = None
+
+    async def preload(self):
+        """Index the targets of every running campaign."""
+        statement = self._statement(PhishingCampaign.launched.is_(True))
+        async with self.engine.connect() as conn:
+            result = await conn.stream(statement)
+            async for rows in result.partitions(1000):
+                self._store(rows)
+        self._loaded.update(self._campaign_keys)
+
+    async def evict_closed(self):
+        """Forget the campaigns closed since they were indexed; returns how many."""
+        if not self._campaign_keys:
+            return 0
+        async with self.engine.connect() as conn:
+            closed = (await conn.execute(self._closed_statement())).scalars().all()
+        for campaign_id in closed:
+            self.evict_campaign(campaign_id)
+        return len(closed)
+
+    async def resync(self):
+        """Drop closed campaigns and load newly launched ones, by any process; returns how many were loaded."""
+        await self.evict_closed()
+        async with self.engine.connect() as conn:
+            launched = (await conn.execute(self._launched_statement())).scalars().all()
+            for campaign_id in launched:
+                result = await conn.stream(self._statement(PhishingTarget.campaign_id == campaign_id))
+                async for rows in result.partitions(1000):
+                    self._store(rows)
+                self._loaded.add(campaign_id)
+        if launched:
+            self.negative.clear()
+        return len(launched)
+
+    async def resolve(self, key, confirm=False):
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+        if key in self.negative and not confirm:
+            return None
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.get_running_loop().create_future()
+            if self._lookup is None:
+                self._lookup = asyncio.create_task(self._look_up_pending())
+        # Shared by every request for the key: one cancelled request must not cancel it for all
+        return await asyncio.shield(future)
+
+    async def _look_up_pending(self):
+        try:
+            while self._pending:
+                batch = {key: self._pending.pop(key) for key in list(self._pending)[:LOOKUP_BATCH_SIZE]}
+                try:
+                    async with self.engine.connect() as conn:
+                        result = await conn.execute(self._statement(PhishingTarget.tracking_key.in_(batch)))
+                        rows = {row.tracking_key: row for row in result}
+                except Exception as e:
+                    for future in batch.values():
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for key, future in batch.items():
+                    entry = self._found(key, rows.get(key))
+                    if not future.done():
+                        future.set_result(entry)
+        finally:
+            self._lookup = None
+
+    async def first_hit(self, key, kind):
+        return self._mark(key, await self.resolve(key), kind)
+
+
+class TrackingService:
+    """ASGI app serving the tracking pixel and landing page of a Flask app's campaigns."""
+
+    def __init__(self, flask_app):
+        from .routes.phishing import PIXEL_GIF, REPORT_THANKS, SUBMIT_THANKS
+
+        flask_app.config.setdefault('TRACKING_ASYNC_DATABASE_URL', None)
+        flask_app.config.setdefault('TRACKING_SERVICE_RESYNC_SECONDS', 60)
+        self.flask_app = flask_app
+        self.index = None
+        self._resync_task = None
+        self.pixel = PIXEL_GIF
+        with flask_app.app_context():
+            self.database_url = flask_app.config['TRACKING_ASYNC_DATABASE_URL'] or async_url(db.engine.url)
+            self.pages = {
+                'landing': render_template('phishing/landing.html').encode(),
+                'report': render_template('phishing/thank_you.html', message=REPORT_THANKS).encode(),
+                'submit': render_template('phishing/thank_you.html', message=SUBMIT_THANKS).encode(),
+            }
+
+    async def startup(self):
+        engine = create_async_engine(self.database_url)
+        self.index = AsyncTrackingIndex(engine, self.flask_app.config['TRACKING_NEGATIVE_CACHE_SIZE'])
+        await self.index.preload()
+        self._resync_task = asyncio.create_task(self._resync())
+
+    async def shutdown(self):
+        if self._resync_task is not None:
+            self._resync_task.cancel()
+        # Queued events are written before the process exits
+        await asyncio.to_thread(event_recorder.shutdown)
+        if self.index is not None:
+            await self.index.engine.dispose()
+
+    async def _resync(self):
+        while True:
+            await asyncio.sleep(self.flask_app.config['TRACKING_SERVICE_RESYNC_SECONDS'])
+            try:
+                await self.index.resync()
+            except Exception:
+                self.flask_app.logger.exception('Failed to resync the tracking index')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        path, method = scope['path'], scope['method']
+        if path.startswith(PIXEL_PREFIX) and path.endswith('.gif'):
+            if method not in ('GET', 'HEAD'):
+                return await _respond(send, 405, b'', [*TEXT, (b'allow', b'GET, HEAD')])
+            return await self._pixel(path[len(PIXEL_PREFIX):-4], method, send)
+        key = path[len(LANDING_PREFIX):]
+        if path.startswith(LANDING_PREFIX) and key and '/' not in key:
+            if method not in ('GET', 'HEAD', 'POST'):
+                return await _respond(send, 405, b'', [*TEXT, (b'allow', b'GET, HEAD, POST')])
+            return await self._landing(key, method, receive, send)
+        if path == '/healthz':
+            return await _respond(send, 200, b'ok')
+        return await _respond(send, 404, b'Not Found')
+
+    async def _pixel(self, key, method, send):
+        if await self.index.first_hit(key, 'open'):
+            event_recorder.record('open', key)
+        headers = [(b'content-type', b'image/gif'), (b'cache-control', b'no-store')]
+        await _respond(send, 200, self.pixel, headers, head=method == 'HEAD')
+
+    async def _landing(self, key, method, receive, send):
+        if await self.index.resolve(key, confirm=True) is None:
+            return await _respond(send, 404, b'Not Found')
+        page = 'landing'
+        if method == 'POST':
+            body = await _read_body(receive)
+            if body is None:
+                # Too large, or the client went away: not a submission, so nothing is recorded
+                return await _respond(send, 413, b'Request Entity Too Large')
+            form = parse_qs(body.decode('latin-1'))
+            page = 'report' if form.get('report_phish') == ['yes'] else 'submit'
+        # Log click (only the first one is kept)
+        if await self.index.first_hit(key, 'click'):
+            event_recorder.record('click', key)
+        if page != 'landing' and await self.index.first_hit(key, page):
+            event_recorder.record(page, key)
+        await _respond(send, 200, self.pages[page], HTML, head=method == 'HEAD')
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    self.flask_app.logger.exception('Tracking service failed to start')
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def _read_body(receive):
+    """The request body; None if the client disconnects or it grows past MAX_BODY."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size <= MAX_BODY:
+            chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks) if size <= MAX_BODY else None
+
+
+async def _respond(send, status, body, headers=TEXT, head=False):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [*headers, (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': b'' if head else body})
+
+
+def create_tracking_app(flask_app=None):
+    """The tracking service for flask_app (by default the one create_app() builds)."""
+    if flask_app is None:
+        from . import create_app
+        flask_app = create_app()
+    return TrackingService(flask_app)
@@ -0,0 +1,67 @@
+"""
+Idempotent writes with INSERT ... ON CONFLICT (SQLite and PostgreSQL).
+
+Replaces "query, then insert or update" for rows with a natural key, such as training progress
+per (user, module) or one acknowledgement per (user, policy). The write is a single statement,
+and concurrent requests can no longer both miss the row and insert duplicates: the unique index
+on the key decides. Core statements skip the session's flush hooks, so the data versions of
+tracked models (app.versioning) are bumped here.
+"""
+
+from sqlalchemy import or_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . import db, versioning
+
+CHUNK_SIZE = 500
+DIALECTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _statement(model, key, update, where, increment=()):
+    dialect = db.session.connection().dialect.name
+    if dialect not in DIALECTS:
+        raise ValueError(f"Upserts need SQLite or PostgreSQL, not {dialect}")
+    table = model.__table__
+    statement = DIALECTS[dialect](table)
+    if increment:
+        return statement.on_conflict_do_update(
+            index_elements=key, index_where=where,
+            set_={name: table.c[name] + statement.excluded[name] for name in increment})
+    if not update:
+        return statement.on_conflict_do_nothing(index_elements=key, index_where=where)
+    # Skip rows that already hold the new values, so the row count only counts real changes
+    changed = or_(*(table.c[name].is_distinct_from(statement.excluded[name]) for name in update))
+    return statement.on_conflict_do_update(index_elements=key, index_where=where,
+                                           set_={name: statement.excluded[name] for name in update},
+                                           where=changed)
+
+
+def _bump(model, rowcount):
+    name = versioning.TRACKED.get(model)
+    if name and rowcount:  # -1 (unknown) counts as a change
+        versioning.bump(name)
+
+
+def upsert(model, values, key, update=(), where=None):
+    """Insert a row unless one with the same key exists; returns 1 if a row was written, else 0.
+
+    key names the columns of a unique index (where: its condition, for a partial index). When
+    update names columns, an existing row gets their new values instead of being left alone.
+    """
+    rowcount = db.session.execute(_statement(model, key, update, where), values).rowcount
+    _bump(model, rowcount)
+    return rowcount
+
+
+def upsert_many(model, rows, key, update=(), where=None, increment=(), chunk_size=CHUNK_SIZE):
+    """upsert() for many rows, one executemany per chunk; returns the rows written (-1 if unknown).
+
+    Columns named in increment are counters: an existing row gets the new values added to them.
+    """
+    statement = _statement(model, key, update, where, increment)
+    written = 0
+    for i in range(0, len(rows), chunk_size):
+        rowcount = db.session.execute(statement, rows[i:i + chunk_size]).rowcount
+        written = -1 if rowcount < 0 or written < 0 else written + rowcount
+    _bump(model, written)
+    return written
@@ -0,0 +1,136 @@
+"""
+Cache for the login manager's user loader.
+
+Users are kept as column snapshots in a per-process TTL + LRU cache, and every request gets its
+own detached User built from the snapshot, so authenticated requests no longer query the user
+table. Updating or deleting a User through the ORM invalidates it once the transaction commits.
+
+Other processes (e.g. gunicorn workers) find out through USER_CACHE_STAMP_DIR when it is set:
+invalidation touches a per-user stamp file there, and a cached entry older than its stamp is
+reloaded. Without it they serve the old snapshot for at most USER_CACHE_TTL seconds.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from . import db
+from .models import User
+
+_PENDING = 'user_cache_invalidate'
+# Filesystems may store coarse mtimes; entries loaded this soon after a stamp count as stale
+STAMP_SLACK_NS = 1_000_000_000
+
+
+class UserCache:
+    """TTL + LRU cache of User column snapshots, keyed by user id."""
+
+    def __init__(self, app=None):
+        self._entries = OrderedDict()  # user id -> (loaded at ns, expires at, column values)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+        self.size = 1024
+        self.ttl = 60
+        self.stamp_dir = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_SIZE', 1024)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        app.config.setdefault('USER_CACHE_STAMP_DIR', None)
+        app.extensions['user_cache'] = self
+        self.size = app.config['USER_CACHE_SIZE']
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.stamp_dir = app.config['USER_CACHE_STAMP_DIR']
+        if self.stamp_dir:
+            os.makedirs(self.stamp_dir, exist_ok=True)
+
+    def _stamp_path(self, user_id):
+        return os.path.join(self.stamp_dir, str(user_id))
+
+    def _stamped_after(self, user_id, loaded_at):
+        if not self.stamp_dir:
+            return False
+        try:
+            return os.stat(self._stamp_path(user_id)).st_mtime_ns >= loaded_at - STAMP_SLACK_NS
+        except FileNotFoundError:
+            return False
+
+    def get(self, user_id):
+        """User with this id (detached when served from the cache), or None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        if entry is not None and entry[1] > time.monotonic() and not self._stamped_after(user_id, entry[0]):
+            self.hits += 1
+            user = User(**entry[2])
+            make_transient_to_detached(user)
+            return user
+
+        self.misses += 1
+        loaded_at = time.time_ns()
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        values = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+        with self._lock:
+            self._entries[user_id] = (loaded_at, time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, *user_ids):
+        """Drop users from this process's cache and stamp them for the other processes."""
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+        self.invalidations += len(user_ids)
+        if self.stamp_dir:
+            for user_id in user_ids:
+                with open(self._stamp_path(user_id), 'a'):
+                    pass
+                os.utime(self._stamp_path(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault(_PENDING, set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    changed = session.info.pop(_PENDING, None)
+    if changed:
+        user_cache.invalidate(*changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop(_PENDING, None)
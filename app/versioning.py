@@ -0,0 +1,49 @@
+"""
+Version counters for cached data sets.
+
+Every flush that touches a tracked model bumps its counter in the same transaction, so any
+cache keyed on current() is invalidated as soon as the change commits, in every worker.
+"""
+
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import (DataVersion, PhishingTemplate, PolicyAcknowledgement, SecurityPolicy,
+                     TrainingModule, User, UserProgress)
+
+# Model -> data set name
+TRACKED = {
+    UserProgress: 'progress',
+    TrainingModule: 'modules',
+    User: 'users',
+    SecurityPolicy: 'policies',
+    PolicyAcknowledgement: 'policy_acks',
+    PhishingTemplate: 'phishing_templates',
+}
+
+
+def bump(*names, connection=None):
+    """Increment the named counters inside the current transaction."""
+    connection = connection or db.session.connection()
+    table = DataVersion.__table__
+    for name in names:
+        result = connection.execute(
+            update(table).where(table.c.name == name).values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(name=name, version=1))
+
+
+def current(*names):
+    """Tuple of the named counters, 0 for data sets never changed."""
+    versions = dict(db.session.query(DataVersion.name, DataVersion.version)
+                    .filter(DataVersion.name.in_(names)))
+    return tuple(versions.get(name, 0) for name in names)
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_changed(session, flush_context):
+    changed = {TRACKED[type(obj)] for obj in (*session.new, *session.dirty, *session.deleted)
+               if type(obj) in TRACKED}
+    if changed:
+        bump(*sorted(changed), connection=session.connection())
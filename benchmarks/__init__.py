@@ -0,0 +1,10 @@
+"""
+Benchmarks of the platform's hot paths.
+
+- dataset.py generates reproducible synthetic data and builds the app on it;
+- bench_hot_paths.py has pytest-benchmark micro-benchmarks of the busiest routes
+  (`cd benchmarks && pytest`);
+- loadgen.py drives a local server over HTTP and writes p50/p99 latency and throughput to JSON,
+  to compare between commits;
+- the other bench_*.py scripts each measure one optimization against what it replaced.
+"""
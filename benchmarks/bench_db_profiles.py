@@ -0,0 +1,117 @@
+"""
+Tracking-hit write throughput per database engine profile (app.database).
+
+Writer threads stamp email_opened one hit per transaction, as tracking does with
+TRACKING_BATCH_SIZE=1, while reader threads keep running the dashboard's funnel query.
+
+    python benchmarks/bench_db_profiles.py --targets 20000 --writers 8 --readers 2
+    python benchmarks/bench_db_profiles.py --postgres-url postgresql://localhost/cybersec_bench
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import bindparam, create_engine, func, select, update
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from app.models import PhishingCampaign, PhishingTarget
+from benchmarks.dataset import make_app
+
+
+def engine_for(url, profile):
+    """The engine of the app create_app() builds with this DB_PROFILE; without a profile, a plain
+    engine with SQLAlchemy's defaults, as the baseline."""
+    if not profile:
+        return create_engine(url)
+    app = make_app(url, DB_PROFILE=profile)
+    with app.app_context():
+        return db.engine
+
+
+def seed(engine, n):
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    keys = [str(uuid.uuid4()) for _ in range(n)]
+    with engine.begin() as connection:
+        campaign_id = connection.execute(
+            PhishingCampaign.__table__.insert().values(name='bench')).inserted_primary_key[0]
+        connection.execute(PhishingTarget.__table__.insert(), [
+            {'campaign_id': campaign_id, 'user_id': i + 1, 'tracking_key': key} for i, key in enumerate(keys)
+        ])
+    return keys
+
+
+def run(engine, keys, writers, readers):
+    table = PhishingTarget.__table__
+    stamp = (update(table)
+             .where(table.c.tracking_key == bindparam('key'), table.c.email_opened.is_(None))
+             .values(email_opened=datetime.utcnow()))
+    funnel = select(func.count(table.c.id), func.count(table.c.email_opened))
+    errors, reads = [0], [0]
+    done = threading.Event()
+
+    def write(chunk):
+        for key in chunk:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(stamp, {'key': key})
+            except OperationalError:
+                errors[0] += 1
+
+    def read():
+        while not done.is_set():
+            with engine.connect() as connection:
+                connection.execute(funnel).one()
+            reads[0] += 1
+
+    threads = [threading.Thread(target=write, args=(keys[i::writers],)) for i in range(writers)]
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    for t in reader_threads:
+        t.start()
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    done.set()
+    for t in reader_threads:
+        t.join()
+    return seconds, errors[0], reads[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--targets', type=int, default=5000)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--postgres-url', help='also benchmark this (empty, disposable) PostgreSQL database')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [
+            ('sqlite default', f"sqlite:///{os.path.join(tmp, 'default.db')}", None),
+            ('sqlite profile', f"sqlite:///{os.path.join(tmp, 'tuned.db')}", 'sqlite'),
+        ]
+        if args.postgres_url:
+            cases.append(('postgresql profile', args.postgres_url, 'postgresql'))
+        for name, url, profile in cases:
+            engine = engine_for(url, profile)
+            keys = seed(engine, args.targets)
+            seconds, errors, reads = run(engine, keys, args.writers, args.readers)
+            engine.dispose()
+            print(f"{name:20s} {args.targets / seconds:8.0f} hits/s  {errors:5d} lock errors  "
+                  f"{reads / seconds:8.0f} funnel reads/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Micro-benchmarks of the busiest routes, through the Flask test client (no HTTP server).
+
+Each call goes through the whole request: routing, login, the queries and rendering. Caches the
+routes use in production (risk scores, report results, tracking index) are warm after the first
+round, as they are on a live server. Run from this directory:
+
+    pytest [--dataset-users N] [--benchmark-json=results.json]
+"""
+
+import itertools
+
+
+def _ok(response):
+    assert response.status_code == 200, response.status_code
+    return response
+
+
+def bench_phishing_dashboard(benchmark, client):
+    _ok(benchmark(client.get, '/phishing/dashboard'))
+
+
+def bench_admin_report(benchmark, client):
+    _ok(benchmark(client.get, '/admin/report'))
+
+
+def bench_survey_results(benchmark, client, ids):
+    _ok(benchmark(client.get, f"/survey/{ids['survey']}/results/"))
+
+
+def bench_campaign_export_csv(benchmark, client, ids):
+    def export():
+        response = _ok(client.get(f"/phishing/campaigns/{ids['campaign']}/export/csv"))
+        return response.get_data()  # the body is streamed: read all of it
+
+    assert benchmark(export).count(b'\n') > 1
+
+
+def bench_pixel(benchmark, client, ids):
+    # Cycling through every key: the first pass records first opens, later ones are repeat hits
+    keys = itertools.cycle(ids['keys'])
+    _ok(benchmark(lambda: client.get(f'/phishing/phish/pixel/{next(keys)}.gif')))
+
+
+def bench_landing(benchmark, client, ids):
+    keys = itertools.cycle(ids['keys'])
+    _ok(benchmark(lambda: client.get(f'/phishing/phish/{next(keys)}')))
@@ -0,0 +1,71 @@
+"""
+Overhead of app.instrumentation on a database-backed page (the training module list).
+
+Runs the same requests against an app without and with METRICS_ENABLED, alternating rounds to
+even out noise, and prints the best per-request time of each and the overhead.
+
+    python benchmarks/bench_instrumentation.py --requests 1000 --rounds 10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import db
+from app.instrumentation import instrumentation
+from app.models import TrainingModule, User, UserProgress
+from benchmarks.dataset import make_app
+
+
+def seed(modules):
+    db.session.add(User(username='bench', password_hash='x', role='employee'))
+    db.session.add_all([TrainingModule(title=f'Module {i}', content='...') for i in range(modules)])
+    db.session.commit()
+    db.session.add_all([UserProgress(user_id=1, module_id=i + 1, completed=True) for i in range(0, modules, 2)])
+    db.session.commit()
+
+
+def run(app, requests):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get('/training/')
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000, help='requests per round')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--modules', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        plain, instrumented = make_app(url, METRICS_ENABLED=False), make_app(url, METRICS_ENABLED=True)
+        with plain.app_context():
+            seed(args.modules)
+        run(plain, 100), run(instrumented, 100)  # warm up
+        timings = {False: [], True: []}
+        for _ in range(args.rounds):
+            timings[False].append(run(plain, args.requests))
+            timings[True].append(run(instrumented, args.requests))
+        off, on = min(timings[False]), min(timings[True])
+        print(f"without {off * 1e6:8.1f} us/request")
+        print(f"with    {on * 1e6:8.1f} us/request")
+        print(f"overhead {(on - off) / off * 100:+.2f}%")
+        stats = instrumentation.snapshot()['training.index']
+        print(f"recorded {sum(stats.statuses.values())} requests, "
+              f"{stats.query_total / sum(stats.statuses.values()):.1f} queries and "
+              f"{stats.rows / sum(stats.statuses.values()):.1f} rows each")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+"""
+Query-plan regression check of the hot lookups (app.query_plans) on the generated dataset.
+
+Fails when a hot query scans a table instead of searching an index, as `flask check-query-plans`
+does on a live database. Run from this directory:
+
+    pytest bench_query_plans.py [--dataset-users N]
+"""
+
+from app.query_plans import check
+
+
+def bench_query_plans(benchmark, bench_app):
+    with bench_app.app_context():
+        results = benchmark(check)
+    scans = {name: plan for name, (plan, scanned) in results.items() if scanned}
+    assert not scans, scans
@@ -0,0 +1,80 @@
+"""
+Worker boot time (import the app and run create_app) against databases of growing size.
+
+Each boot runs in a fresh interpreter, as a new worker would, with SQL statements counted from
+the first import. Booting must not run any SQL at all and must take about as long on the largest
+database as on an empty one; the script exits non-zero otherwise.
+
+    python benchmarks/bench_startup.py --sizes 0 10000 50000 --boots 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import db
+from benchmarks.dataset import generate, make_app
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+BOOT = """
+import json, time
+start = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+from app import create_app
+create_app()
+print(json.dumps({'seconds': time.perf_counter() - start, 'statements': statements}))
+"""
+
+
+def boot(url, cwd):
+    env = dict(os.environ, DATABASE_URL=url, PYTHONPATH=ROOT)
+    env.pop('SCHEDULER_IN_PROCESS', None)
+    output = subprocess.run([sys.executable, '-c', BOOT], env=env, cwd=cwd, capture_output=True, text=True,
+                            check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 10000, 50000], help='users per database')
+    parser.add_argument('--campaigns', type=int, default=4)
+    parser.add_argument('--boots', type=int, default=5, help='boots per database; the median is kept')
+    parser.add_argument('--tolerance', type=float, default=25, help='allowed slowdown (%%) on the largest database')
+    args = parser.parse_args()
+
+    medians, failures = {}, []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            url = f"sqlite:///{os.path.join(tmp, f'bench{size}.db')}"
+            app = make_app(url)
+            with app.app_context():
+                generate(size, campaigns=args.campaigns if size else 0)
+                db.engine.dispose()
+            runs = [boot(url, tmp) for _ in range(args.boots)]
+            medians[size] = statistics.median(run['seconds'] for run in runs)
+            statements = max(len(run['statements']) for run in runs)
+            print(f"{size:8d} users  boot {medians[size] * 1000:8.1f} ms (median of {args.boots})  "
+                  f"{statements} SQL statements")
+            if statements:
+                failures.append(f"{size} users: boot ran SQL: {runs[0]['statements'][:3]}")
+    smallest, largest = medians[min(medians)], medians[max(medians)]
+    slowdown = (largest - smallest) / smallest * 100
+    print(f"largest vs smallest database: {slowdown:+.1f}%")
+    if slowdown > args.tolerance:
+        failures.append(f"boot is {slowdown:.0f}% slower on {max(medians)} users than on {min(medians)}")
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare per-row ORM target creation with app.targeting.add_targets.
+
+    python benchmarks/bench_targeting.py --users 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import aggregates, db, targeting
+from app.models import PhishingCampaign, PhishingTarget, User
+from benchmarks.dataset import make_app
+
+
+def seed_users(n):
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'user{i}@example.com', 'password_hash': '-', 'role': 'user', 'is_active': True}
+        for i in range(n)
+    ])
+    db.session.commit()
+
+
+def per_row(campaign_id, user_ids):
+    # What campaigns_add and campaign_launch used to do
+    targets = []
+    for user_id in user_ids:
+        target = PhishingTarget(campaign_id=campaign_id, user_id=user_id)
+        db.session.add(target)
+        targets.append(target)
+    aggregates.record_targets(targets)
+    db.session.commit()
+    for target in PhishingTarget.query.filter_by(campaign_id=campaign_id):
+        target.tracking_key = str(uuid.uuid4())
+    db.session.commit()
+
+
+def bulk(campaign_id, user_ids):
+    targeting.add_targets(campaign_id, user_ids=user_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        with app.app_context():
+            seed_users(args.users)
+            user_ids = [uid for (uid,) in db.session.query(User.id)]
+            results = {}
+            for name, fn in (('per-row ORM', per_row), ('bulk insert', bulk)):
+                campaign = PhishingCampaign(name=name)
+                db.session.add(campaign)
+                db.session.commit()
+                start = time.perf_counter()
+                fn(campaign.id, user_ids)
+                results[name] = time.perf_counter() - start
+                db.session.expunge_all()
+
+    for name, seconds in results.items():
+        print(f"{name:12s} {seconds:8.2f}s  {args.users / seconds:10.0f} targets/s")
+    print(f"speedup      {results['per-row ORM'] / results['bulk insert']:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Messages rendered per second: per-message Jinja parsing and MIME building vs app.phishing_templates.
+
+    python benchmarks/bench_templates.py --messages 20000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask_mail import Message
+
+from app.models import PhishingTemplate
+from app.phishing_templates import CompiledTemplate
+from benchmarks.dataset import make_app
+
+TEMPLATE = PhishingTemplate(
+    id=1,
+    name='Password expiry',
+    subject='Action required: {{ username }}, your password expires today',
+    body_html=('<p>Hello {{ username }},</p>'
+               '<p>Your password expires in 24 hours. <a href="{{ landing_url }}">Keep it</a>.</p>'
+               + '<p>IT Service Desk &middot; This is an automated message.</p>' * 20),
+    body_text=('Hello {{ username }},\n\nYour password expires in 24 hours: {{ landing_url }}\n'
+               + 'IT Service Desk. This is an automated message.\n' * 20),
+)
+
+
+def fields(i):
+    return dict(username=f'user{i}@example.com',
+                pixel_url=f'https://phish.example.com/phishing/phish/pixel/{i:032x}.gif',
+                landing_url=f'https://phish.example.com/phishing/phish/{i:032x}')
+
+
+def uncached(app, n):
+    # What send_phishing_email used to do for every target
+    env = app.jinja_env
+    for i in range(n):
+        values = fields(i)
+        html = env.from_string(TEMPLATE.body_html).render(**values)
+        html += f'<img src="{values["pixel_url"]}" width="1" height="1" alt="">'
+        Message(subject=env.from_string(TEMPLATE.subject).render(**values),
+                recipients=[values['username']], html=html,
+                body=env.from_string(TEMPLATE.body_text).render(**values)).as_bytes()
+
+
+def compiled(app, n):
+    template = CompiledTemplate(TEMPLATE, app.config['MAIL_DEFAULT_SENDER'])
+    for i in range(n):
+        template.render(**fields(i)).as_bytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=5000)
+    args = parser.parse_args()
+
+    app = make_app('sqlite://', MAIL_DEFAULT_SENDER='it-support@example.com')
+    results = {}
+    with app.app_context():
+        for name, fn in (('uncached', uncached), ('compiled', compiled)):
+            start = time.perf_counter()
+            fn(app, args.messages)
+            results[name] = time.perf_counter() - start
+
+    for name, seconds in results.items():
+        print(f"{name:12s} {seconds:8.2f}s  {args.messages / seconds:10.0f} messages/s")
+    print(f"speedup      {results['uncached'] / results['compiled']:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
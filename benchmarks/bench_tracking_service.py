@@ -0,0 +1,200 @@
+"""
+Load test of the tracking microservice (app.tracking_service): pixel and landing page hits/s.
+
+A dataset (dataset.py) is generated in a temporary SQLite file and hit with pixel requests for
+its tracking keys, a share of landing page views (--landing) and of unknown keys (--junk), as a
+mail scanner burst would. By default the ASGI app is driven in-process by --concurrency asyncio
+clients, which measures the service itself on one core. --http serves it with uvicorn in a
+separate process instead and sends keep-alive HTTP requests from --clients client processes; on a
+single core those clients compete with the server for it.
+
+    python benchmarks/bench_tracking_service.py --users 20000 --duration 10 --min-rate 20000
+    python benchmarks/bench_tracking_service.py --http --clients 2 --duration 10
+
+The events recorded during the run are written as the service shuts down, then counted in the database. The script exits
+non-zero if the rate stays below --min-rate or any hit failed.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import func
+
+from app import db
+from app.models import PhishingTarget
+from app.tracking_service import create_tracking_app
+from benchmarks.dataset import generate, make_app
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def make_paths(keys, count, landing, junk, junk_keys, seed):
+    """count request paths: pixels of random keys, with landing views and unknown keys mixed in.
+
+    Unknown keys come from a pool of junk_keys (expired campaigns, links mangled by a scanner);
+    each costs one database lookup, the first time it is seen.
+    """
+    rng = random.Random(seed)
+    pool = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(junk_keys)]
+    paths = []
+    for _ in range(count):
+        roll = rng.random()
+        key = rng.choice(pool) if roll < junk else rng.choice(keys)
+        paths.append(f'/phishing/phish/{key}' if junk <= roll < junk + landing else f'/phishing/phish/pixel/{key}.gif')
+    return paths
+
+
+async def drive_asgi(service, paths, duration, concurrency):
+    """Call the ASGI app directly for duration seconds; returns (requests, seconds, statuses)."""
+    statuses = Counter()
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses[message['status']] += 1
+
+    async def client(offset, deadline):
+        done = 0
+        while True:
+            for i in range(100):
+                path = paths[(offset + done + i) % len(paths)]
+                await service({'type': 'http', 'method': 'GET', 'path': path}, receive, send)
+            done += 100
+            if time.perf_counter() >= deadline:
+                return done
+
+    await service.startup()
+    try:
+        start = time.perf_counter()
+        step = len(paths) // concurrency
+        counts = await asyncio.gather(*(client(i * step, start + duration) for i in range(concurrency)))
+        seconds = time.perf_counter() - start
+    finally:
+        await service.shutdown()
+    return sum(counts), seconds, statuses
+
+
+async def _http_client(port, paths, offset, deadline):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    statuses, done = Counter(), 0
+    while time.perf_counter() < deadline:
+        path = paths[(offset + done) % len(paths)]
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        length = next(int(line.split(':', 1)[1]) for line in lines if line.lower().startswith('content-length:'))
+        await reader.readexactly(length)
+        statuses[int(lines[0].split()[1])] += 1
+        done += 1
+    writer.close()
+    return statuses
+
+
+def _http_process(port, paths, connections, offset, duration, results):
+    async def run():
+        deadline = time.perf_counter() + duration
+        step = len(paths) // connections
+        return await asyncio.gather(*(_http_client(port, paths, offset + i * step, deadline)
+                                      for i in range(connections)))
+    results.put(sum(asyncio.run(run()), Counter()))
+
+
+def drive_http(url, paths, duration, clients, connections):
+    """Serve the tracking app with uvicorn and hit it over HTTP; returns (requests, seconds, statuses)."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, DATABASE_URL=url, PYTHONPATH=ROOT)
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'tracking_asgi:app', '--port', str(port),
+                               '--no-access-log', '--log-level', 'warning'], cwd=ROOT, env=env)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            sys.exit('uvicorn did not start')
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_http_process,
+                                             args=(port, paths, connections, i * len(paths) // clients,
+                                                   duration, results))
+                     for i in range(clients)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        statuses = sum((results.get() for _ in processes), Counter())
+        seconds = time.perf_counter() - start
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return sum(statuses.values()), seconds, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--campaigns', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load')
+    parser.add_argument('--concurrency', type=int, default=64, help='in-process clients')
+    parser.add_argument('--landing', type=float, default=0.1, help='share of landing page views')
+    parser.add_argument('--junk', type=float, default=0.2, help='share of hits on unknown keys')
+    parser.add_argument('--junk-keys', type=int, default=2000, help='distinct unknown keys')
+    parser.add_argument('--http', action='store_true', help='serve with uvicorn and send real HTTP requests')
+    parser.add_argument('--clients', type=int, default=1, help='HTTP client processes')
+    parser.add_argument('--connections', type=int, default=32, help='keep-alive connections per client')
+    parser.add_argument('--min-rate', type=float, default=0, help='fail below this many hits per second')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        app = make_app(url)
+        with app.app_context():
+            generate(args.users, campaigns=args.campaigns, seed=args.seed)
+            keys = [key for key, in db.session.query(PhishingTarget.tracking_key)]
+            opened_before = db.session.query(func.count(PhishingTarget.email_opened)).scalar()
+            db.engine.dispose()
+        paths = make_paths(keys, 200000, args.landing, args.junk, args.junk_keys, args.seed)
+
+        if args.http:
+            requests, seconds, statuses = drive_http(url, paths, args.duration, args.clients, args.connections)
+        else:
+            service = create_tracking_app(app)
+            requests, seconds, statuses = asyncio.run(drive_asgi(service, paths, args.duration, args.concurrency))
+        with app.app_context():
+            opened = db.session.query(func.count(PhishingTarget.email_opened)).scalar() - opened_before
+
+    rate = requests / seconds
+    mode = f'uvicorn, {args.clients} client process(es)' if args.http else f'in-process, {args.concurrency} clients'
+    print(f"{len(keys)} tracking keys, {os.cpu_count()} CPU(s), {mode}")
+    print(f"{requests} hits in {seconds:.1f} s: {rate:,.0f} hits/s  statuses {dict(statuses)}")
+    print(f"first opens recorded in the database: {opened}")
+    failures = []
+    if rate < args.min_rate:
+        failures.append(f"{rate:,.0f} hits/s is below --min-rate {args.min_rate:,.0f}")
+    if set(statuses) - {200, 404}:
+        failures.append(f"unexpected statuses: {dict(statuses)}")
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Concurrent clicks on the idempotent write endpoints (app.upserts).
+
+Threads keep posting "complete module" and "acknowledge policy" for the same few users, and
+assigning remediation to them, then the script checks that no duplicate rows were written.
+Exits non-zero on duplicates or failed requests. bench_concurrent_upserts runs the same check in
+the benchmark suite, on the generated dataset.
+
+    python benchmarks/bench_upserts.py --threads 16 --requests 200
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import func
+
+from app import db, migrations
+from app.models import (PolicyAcknowledgement, RemediationAssignment, SecurityPolicy, TrainingModule, User,
+                        UserProgress)
+from app.remediation import remediation_engine
+from benchmarks.dataset import make_app
+
+
+def seed(users, items):
+    db.drop_all()
+    migrations.upgrade()
+    db.session.add_all([User(username=f'user{i}', password_hash='x', role='admin') for i in range(users)])
+    db.session.add_all([TrainingModule(title=f'Module {i}', content='...') for i in range(items)])
+    db.session.add_all([SecurityPolicy(title=f'Policy {i}', content='...') for i in range(items)])
+    db.session.commit()
+
+
+def hammer(app, threads, requests, users, items):
+    failures = [0]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        user_id = rng.randint(1, users)
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        for _ in range(requests):
+            item = rng.randint(1, items)
+            action = rng.randrange(3)
+            if action == 0:
+                status = client.post(f'/training/complete/{item}').status_code
+            elif action == 1:
+                status = client.post(f'/policies/{item}/').status_code
+            else:
+                with app.app_context():
+                    remediation_engine.assign([(user_id, remediation_engine.rules[0])])
+                    db.session.commit()
+                status = 302
+            if status != 302:
+                failures[0] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start, failures[0]
+
+
+def duplicates():
+    def count(*columns, where=True):
+        groups = (db.session.query(*columns).filter(where).group_by(*columns)
+                  .having(func.count() > 1).subquery())
+        return db.session.query(func.count()).select_from(groups).scalar()
+
+    return {
+        'user_progress': count(UserProgress.user_id, UserProgress.module_id),
+        'policy_acknowledgement': count(PolicyAcknowledgement.user_id, PolicyAcknowledgement.policy_id),
+        'open remediation': count(RemediationAssignment.user_id, RemediationAssignment.rule,
+                                  where=RemediationAssignment.completed.is_(False)),
+    }
+
+
+def bench_concurrent_upserts(benchmark, bench_app):
+    # The generated dataset numbers users, modules and policies from 1, as seed() does
+    seconds, failures = benchmark.pedantic(hammer, args=(bench_app, 8, 25, 4, 3), rounds=1)
+    with bench_app.app_context():
+        found = duplicates()
+    assert not failures, f'{failures} requests failed'
+    assert not any(found.values()), found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help='requests per thread')
+    parser.add_argument('--users', type=int, default=4, help='few users, so threads collide on the same rows')
+    parser.add_argument('--items', type=int, default=3, help='modules and policies')
+    parser.add_argument('--url', help='database to use instead of a temporary SQLite file (it is emptied)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(args.url or f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        with app.app_context():
+            seed(args.users, args.items)
+        seconds, failures = hammer(app, args.threads, args.requests, args.users, args.items)
+        with app.app_context():
+            found = duplicates()
+            db.engine.dispose()
+    total = args.threads * args.requests
+    print(f"{total} writes from {args.threads} threads in {seconds:.2f}s ({total / seconds:.0f}/s), "
+          f"{failures} failed")
+    for table, groups in found.items():
+        print(f"{table:25s} {groups} duplicated keys")
+    if failures or any(found.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
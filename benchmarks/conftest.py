@@ -0,0 +1,56 @@
+"""
+Fixtures of the micro-benchmarks: one generated dataset per session (see dataset.py).
+
+    pytest --dataset-users 10000 --dataset-campaigns 20 --benchmark-json=results.json
+"""
+
+import pytest
+
+from app import db
+from app.models import PhishingCampaign, PhishingTarget, SecuritySurvey, User
+from app.tracking import event_recorder
+
+from .dataset import ADMIN, generate, make_app
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('dataset', 'synthetic dataset of the benchmarks')
+    group.addoption('--dataset-users', type=int, default=2000)
+    group.addoption('--dataset-modules', type=int, default=20)
+    group.addoption('--dataset-campaigns', type=int, default=10)
+    group.addoption('--dataset-seed', type=int, default=0)
+
+
+@pytest.fixture(scope='session')
+def bench_app(request, tmp_path_factory):
+    options = request.config.option
+    path = tmp_path_factory.mktemp('dataset') / 'bench.db'
+    app = make_app(f'sqlite:///{path}', REPORT_CACHE_DIR=str(path.parent / 'reports'))
+    with app.app_context():
+        generate(options.dataset_users, options.dataset_modules, options.dataset_campaigns, seed=options.dataset_seed)
+    yield app
+    with app.app_context():
+        event_recorder.shutdown()
+        db.engine.dispose()
+
+
+@pytest.fixture(scope='session')
+def ids(bench_app):
+    """Ids and tracking keys of the generated data the routes are called with."""
+    with bench_app.app_context():
+        return {
+            'admin': db.session.query(User.id).filter_by(username=ADMIN[0]).scalar(),
+            'campaign': db.session.query(PhishingCampaign.id).order_by(PhishingCampaign.id.desc()).limit(1).scalar(),
+            'survey': db.session.query(SecuritySurvey.id).order_by(SecuritySurvey.id).limit(1).scalar(),
+            'keys': [key for (key,) in db.session.query(PhishingTarget.tracking_key).order_by(PhishingTarget.id)],
+        }
+
+
+@pytest.fixture
+def client(bench_app, ids):
+    """A test client logged in as the generated admin."""
+    client = bench_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(ids['admin'])
+        session['_fresh'] = True
+    return client
@@ -0,0 +1,172 @@
+"""
+Synthetic data for the benchmarks, and the app it is loaded into.
+
+generate() fills an empty database with N users, M training modules and K launched phishing
+campaigns whose targets opened, clicked, submitted and reported at realistic rates (RATES), plus
+training progress, surveys with responses and policy acknowledgements. The maintained counters
+(phishing funnel, survey tallies, policy bitmaps) are rebuilt afterwards, as on a live install.
+Everything comes from one random seed, so the same arguments always produce the same data.
+
+    python benchmarks/dataset.py --url sqlite:///bench.db --users 10000 --modules 20 --campaigns 10
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+from app import aggregates, compliance, create_app, db, migrations, risk, survey_answers, survey_stats
+from app.models import (PhishingCampaign, PhishingTarget, PhishingTemplate, PolicyAcknowledgement,
+                        SecurityPolicy, SecuritySurvey, SurveyQuestion, SurveyResponse, TrainingModule, User,
+                        UserProgress)
+
+# Share of targets with each event; a click implies an open and a submission a click
+RATES = {'opened': 0.55, 'clicked': 0.18, 'submitted': 0.06, 'reported': 0.12}
+CAMPAIGN_REACH = 0.8  # share of the users each campaign targets
+COMPLETION_RATE = 0.6  # training modules completed per user
+RESPONSE_RATE = 0.4  # users answering each survey
+ACK_RATE = 0.7  # policies acknowledged per user
+DEPARTMENTS = ('Finance', 'Sales', 'Engineering', 'HR', 'Legal', 'Support', 'Operations', 'Marketing')
+CHOICES = ('Yes', 'No', 'Sometimes', "Don't know")
+ADMIN = ('bench-admin', 'bench')  # username and password of the admin generate() creates
+CHUNK_SIZE = 5000
+
+
+def make_app(url, **config):
+    """The app create_app() builds, on the database at url migrated to the latest schema."""
+    app = create_app(dict({'SQLALCHEMY_DATABASE_URI': url, 'MAIL_SUPPRESS_SEND': True,
+                           'SCHEDULER_IN_PROCESS': False}, **config))
+    with app.app_context():
+        migrations.upgrade()
+    return app
+
+
+def _insert(model, rows):
+    """Insert rows (an iterable of dicts) CHUNK_SIZE at a time; returns how many."""
+    total, chunk = 0, []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            db.session.execute(insert(model), chunk)
+            total, chunk = total + len(chunk), []
+    if chunk:
+        db.session.execute(insert(model), chunk)
+    return total + len(chunk)
+
+
+def _targets(rng, campaign_id, launched, user_ids):
+    for user_id in rng.sample(user_ids, int(len(user_ids) * CAMPAIGN_REACH)):
+        sent = launched + timedelta(seconds=rng.randrange(3600))
+        row = {'campaign_id': campaign_id, 'user_id': user_id,
+               'tracking_key': str(uuid.UUID(int=rng.getrandbits(128))), 'email_sent': sent,
+               'email_opened': None, 'link_clicked': None, 'data_submitted': None, 'reported_phish': None}
+        if rng.random() < RATES['opened']:
+            row['email_opened'] = sent + timedelta(minutes=rng.expovariate(1 / 90))
+            if rng.random() < RATES['clicked'] / RATES['opened']:
+                row['link_clicked'] = row['email_opened'] + timedelta(seconds=rng.expovariate(1 / 60))
+                if rng.random() < RATES['submitted'] / RATES['clicked']:
+                    row['data_submitted'] = row['link_clicked'] + timedelta(seconds=rng.expovariate(1 / 45))
+            if not row['data_submitted'] and rng.random() < RATES['reported'] / RATES['opened']:
+                row['reported_phish'] = row['email_opened'] + timedelta(minutes=rng.expovariate(1 / 10))
+        yield row
+
+
+def generate(users=1000, modules=20, campaigns=10, surveys=3, questions=8, policies=10, seed=0):
+    """Fill the (empty) database of the current app; returns {table: rows inserted}."""
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    counts = {}
+    admin_name, admin_password = ADMIN
+    db.session.add(User(username=admin_name, password_hash=generate_password_hash(admin_password), role='admin',
+                        department='IT'))
+    counts['user'] = 1 + _insert(User, ({
+        'username': f'user{i}@example.com', 'password_hash': '-', 'role': 'employee',
+        'department': DEPARTMENTS[rng.randrange(len(DEPARTMENTS))], 'is_active': rng.random() < 0.97,
+    } for i in range(users)))
+    user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.username != admin_name).order_by(User.id)]
+
+    counts['training_module'] = _insert(TrainingModule, (
+        {'title': f'Module {i + 1}', 'content': 'Lorem ipsum dolor sit amet. ' * 40} for i in range(modules)))
+    module_ids = [mid for (mid,) in db.session.query(TrainingModule.id).order_by(TrainingModule.id)]
+    counts['user_progress'] = _insert(UserProgress, (
+        {'user_id': uid, 'module_id': mid, 'completed': True}
+        for uid in user_ids for mid in module_ids if rng.random() < COMPLETION_RATE))
+
+    db.session.add(PhishingTemplate(name='Password expiry', subject='Your password expires today',
+                                    body_html='<p>Hello {{ username }}, <a href="{{ landing_url }}">renew</a></p>',
+                                    body_text='Hello {{ username }}, renew at {{ landing_url }}'))
+    db.session.flush()
+    counts['phishing_campaign'] = counts['phishing_target'] = 0
+    for i in range(campaigns):
+        launched = now - timedelta(days=7 * (campaigns - i))
+        campaign = PhishingCampaign(name=f'Campaign {i + 1}', template_id=1, scheduled_time=launched, launched=True)
+        db.session.add(campaign)
+        db.session.flush()
+        counts['phishing_campaign'] += 1
+        counts['phishing_target'] += _insert(PhishingTarget, _targets(rng, campaign.id, launched, user_ids))
+
+    counts['security_survey'] = counts['survey_question'] = counts['survey_response'] = 0
+    for i in range(surveys):
+        survey = SecuritySurvey(title=f'Security awareness survey {i + 1}', description='Quarterly check-in')
+        db.session.add(survey)
+        db.session.flush()
+        question_ids = []
+        for n in range(questions):
+            question = SurveyQuestion(survey_id=survey.id, question=f'Question {n + 1}?', choices=json.dumps(CHOICES))
+            db.session.add(question)
+            db.session.flush()
+            question_ids.append(question.id)
+        weights = [rng.random() for _ in CHOICES]  # every survey leans its own way
+        counts['security_survey'] += 1
+        counts['survey_question'] += len(question_ids)
+        counts['survey_response'] += _insert(SurveyResponse, (
+            {'survey_id': survey.id, 'user_id': uid, 'completed_at': now - timedelta(minutes=rng.randrange(43200)),
+             'answers': json.dumps({f'q{qid}': rng.choices(CHOICES, weights)[0] for qid in question_ids})}
+            for uid in user_ids if rng.random() < RESPONSE_RATE))
+
+    counts['security_policy'] = _insert(SecurityPolicy, (
+        {'title': f'Policy {i + 1}', 'content': 'Policy text. ' * 100, 'upload_date': now} for i in range(policies)))
+    policy_ids = [pid for (pid,) in db.session.query(SecurityPolicy.id).order_by(SecurityPolicy.id)]
+    counts['policy_acknowledgement'] = _insert(PolicyAcknowledgement, (
+        {'user_id': uid, 'policy_id': pid, 'acknowledged_at': now}
+        for uid in user_ids for pid in policy_ids if rng.random() < ACK_RATE))
+    db.session.commit()
+
+    aggregates.rebuild()
+    survey_answers.migrate()
+    survey_stats.backfill()
+    compliance.rebuild()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', required=True, help='database to fill; it must be empty')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--modules', type=int, default=20)
+    parser.add_argument('--campaigns', type=int, default=10)
+    parser.add_argument('--surveys', type=int, default=3)
+    parser.add_argument('--policies', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = make_app(args.url)
+    with app.app_context():
+        if db.session.query(User.id).first() is not None:
+            parser.error(f'{args.url} already has users')
+        counts = generate(args.users, args.modules, args.campaigns, args.surveys, policies=args.policies,
+                          seed=args.seed)
+    for table, rows in counts.items():
+        print(f"{table:25s} {rows:10d}")
+
+
+if __name__ == '__main__':
+    main()
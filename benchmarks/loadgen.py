@@ -0,0 +1,246 @@
+"""
+HTTP load driver: p50/p99 latency and throughput of the hot routes, written to JSON.
+
+By default it generates a dataset (dataset.py) in a temporary SQLite file and serves it from a
+separate process with the threaded werkzeug server; --url reuses a database filled by
+dataset.py and --base-url targets a server already running on it (e.g. gunicorn). Workers keep
+one connection each, log in as the generated admin, and pick routes by the weights of ROUTES.
+
+    python benchmarks/loadgen.py --concurrency 8 --duration 20 --output HEAD.json
+    python benchmarks/loadgen.py --concurrency 8 --duration 20 --compare HEAD.json
+
+--compare prints the change per route against an earlier run and exits non-zero if a p99 got
+more than --threshold percent slower.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from benchmarks.dataset import ADMIN, generate, make_app
+
+# name: (weight, path), the path formatted with a tracking key, the campaign and the survey
+ROUTES = {
+    'pixel': (40, '/phishing/phish/pixel/{key}.gif'),
+    'landing': (20, '/phishing/phish/{key}'),
+    'phishing_dashboard': (10, '/phishing/dashboard'),
+    'admin_report': (10, '/admin/report'),
+    'survey_results': (10, '/survey/{survey}/results/'),
+    'campaign_export_csv': (2, '/phishing/campaigns/{campaign}/export/csv'),
+}
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def summarize(latencies, errors, seconds):
+    ordered = sorted(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 3)  # noqa: E731
+    return {
+        'requests': len(ordered), 'errors': errors, 'throughput': round(len(ordered) / seconds, 1),
+        'p50_ms': ms(percentile(ordered, 50)), 'p90_ms': ms(percentile(ordered, 90)),
+        'p99_ms': ms(percentile(ordered, 99)), 'max_ms': ms(ordered[-1] if ordered else None),
+    }
+
+
+def serve(url, ports):
+    """Child process: the app on url behind the threaded werkzeug server, on a free port."""
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # no line per request
+    server = make_server('127.0.0.1', 0, make_app(url), threaded=True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def fixtures(url):
+    """Tracking keys, a campaign and a survey of the dataset at url."""
+    from app import db
+    from app.models import PhishingCampaign, PhishingTarget, SecuritySurvey
+    with make_app(url).app_context():
+        return {
+            'keys': [key for (key,) in db.session.query(PhishingTarget.tracking_key)],
+            'campaign': db.session.query(PhishingCampaign.id).order_by(PhishingCampaign.id.desc()).limit(1).scalar(),
+            'survey': db.session.query(SecuritySurvey.id).order_by(SecuritySurvey.id).limit(1).scalar(),
+        }
+
+
+class Worker(threading.Thread):
+    """Sends requests over one keep-alive connection until the deadline."""
+
+    def __init__(self, base_url, data, routes, seed, warmup_until, deadline):
+        super().__init__(daemon=True)
+        self.base = urlsplit(base_url)
+        self.data = data
+        self.names = list(routes)
+        self.weights = [routes[name][0] for name in self.names]
+        self.rng = random.Random(seed)
+        self.warmup_until, self.deadline = warmup_until, deadline
+        self.latencies = {name: [] for name in self.names}
+        self.errors = dict.fromkeys(self.names, 0)
+        self.cookie = ''
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {}, Cookie=self.cookie)
+        for attempt in (1, 2):  # the server may have closed an idle connection
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.base.hostname, self.base.port, timeout=60)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                response.read()
+                return response
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                self.connection = None
+                if attempt == 2:
+                    raise
+
+    def login(self):
+        response = self.request('POST', '/auth/login', urlencode({'username': ADMIN[0], 'password': ADMIN[1]}),
+                                {'Content-Type': 'application/x-www-form-urlencoded'})
+        cookie = response.getheader('Set-Cookie', '')
+        if response.status != 302 or not cookie:
+            raise RuntimeError(f'Could not log in as {ADMIN[0]}: HTTP {response.status}')
+        self.cookie = cookie.split(';', 1)[0]
+
+    def run(self):
+        self.login()
+        while True:
+            name = self.rng.choices(self.names, self.weights)[0]
+            path = ROUTES[name][1].format(key=self.rng.choice(self.data['keys']), campaign=self.data['campaign'],
+                                          survey=self.data['survey'])
+            start = time.perf_counter()
+            try:
+                ok = self.request('GET', path).status == 200
+            except (http.client.HTTPException, OSError):
+                ok = False
+            end = time.perf_counter()
+            if end >= self.deadline:
+                return
+            if start >= self.warmup_until:
+                self.latencies[name].append(end - start)
+                if not ok:
+                    self.errors[name] += 1
+
+
+def run(base_url, data, routes, concurrency, duration, warmup, seed):
+    start = time.perf_counter()
+    warmup_until = start + warmup
+    workers = [Worker(base_url, data, routes, seed + i, warmup_until, warmup_until + duration)
+               for i in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    report = {'routes': {}}
+    for name in routes:
+        report['routes'][name] = summarize([x for w in workers for x in w.latencies[name]],
+                                           sum(w.errors[name] for w in workers), duration)
+    report['total'] = summarize([x for w in workers for xs in w.latencies.values() for x in xs],
+                                sum(sum(w.errors.values()) for w in workers), duration)
+    return report
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, threshold):
+    """Print the change per route; returns the routes whose p99 regressed beyond threshold (%)."""
+    regressed = []
+    print(f"{'':22s} {'p50 ms':>18s} {'p99 ms':>18s} {'req/s':>16s}   vs {baseline.get('commit')}")
+    for name, now in list(report['routes'].items()) + [('total', report['total'])]:
+        before = baseline['routes'].get(name) if name != 'total' else baseline.get('total')
+        if not before or not now['requests'] or not before['requests']:
+            continue
+        change = {key: (now[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+                  for key in ('p50_ms', 'p99_ms', 'throughput')}
+        print(f"{name:22s} {now['p50_ms']:9.2f} {change['p50_ms']:+7.1f}% {now['p99_ms']:9.2f} "
+              f"{change['p99_ms']:+7.1f}% {now['throughput']:8.1f} {change['throughput']:+6.1f}%")
+        if name != 'total' and change['p99_ms'] > threshold:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='database filled by dataset.py (default: generate a temporary one)')
+    parser.add_argument('--base-url', help='server already running on --url (default: start one)')
+    parser.add_argument('--users', type=int, default=2000, help='size of the generated dataset')
+    parser.add_argument('--campaigns', type=int, default=10)
+    parser.add_argument('--modules', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of requests not measured')
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=sorted(ROUTES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=10, help='p99 regression (%%) that fails --compare')
+    args = parser.parse_args()
+    if args.base_url and not args.url:
+        parser.error('--base-url needs the --url of the database the server uses')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url
+        if url is None:
+            url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+            with make_app(url).app_context():
+                generate(args.users, args.modules, args.campaigns, seed=args.seed)
+        data = fixtures(url)
+        server = None
+        base_url = args.base_url
+        if base_url is None:
+            ports = multiprocessing.Queue()
+            server = multiprocessing.Process(target=serve, args=(url, ports), daemon=True)
+            server.start()
+            base_url = f'http://127.0.0.1:{ports.get(timeout=60)}'
+        try:
+            report = run(base_url, data, {name: ROUTES[name] for name in args.routes}, args.concurrency,
+                         args.duration, args.warmup, args.seed)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+
+    report.update(commit=commit(), date=datetime.utcnow().isoformat(timespec='seconds'), base_url=args.base_url,
+                  concurrency=args.concurrency, duration=args.duration,
+                  dataset=None if args.url else {'users': args.users, 'campaigns': args.campaigns,
+                                                 'modules': args.modules, 'seed': args.seed})
+    for name, stats in list(report['routes'].items()) + [('total', report['total'])]:
+        print(f"{name:22s} {stats['requests']:7d} req {stats['throughput']:8.1f}/s  p50 {stats['p50_ms']} ms  "
+              f"p99 {stats['p99_ms']} ms  {stats['errors']} errors")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(report, json.load(f), args.threshold)
+        if regressed:
+            sys.exit(f"p99 regressed by more than {args.threshold:g}%: {', '.join(regressed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,13 @@ setup(
         'Flask',
         'Flask-Login',
         'Flask-SQLAlchemy',
+        'Flask-Mail',
     ],
+    extras_require={
+        'reports': ['WeasyPrint', 'openpyxl'],
+        'postgresql': ['psycopg2-binary'],
+        'tracking': ['uvicorn[standard]', 'SQLAlchemy[asyncio]', 'aiosqlite', 'asyncpg'],
+    },
     entry_points={
         'console_scripts': [
             'cybersec-platform=run:main',
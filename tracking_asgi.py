@@ -0,0 +1,7 @@
+"""
+Entry point for the tracking microservice (ASGI): `uvicorn tracking_asgi:app`.
+"""
+
+from app.tracking_service import create_tracking_app
+
+app = create_tracking_app()
\ No newline at end of file